@@ -526,6 +526,66 @@ def parseSegmentXML(data, templates = {}):
 	
 	return seg
 
+def parseSegmentBinary(data, templates = {}):
+	"""
+	Parse a typed binary segment (see binary_segment.py) for its boxes. This
+	uses the packed values directly, so only attributes that were kept as
+	strings or come from templates need to be parsed.
+	"""
+	
+	import binary_segment
+	
+	segment = data if isinstance(data, binary_segment.BinarySegment) else binary_segment.BinarySegment.fromBytes(data)
+	elements = segment.elements["box"]
+	boxes = []
+	
+	seg = SegmentInfo(segment.attrib, templates, boxes)
+	
+	present = elements.present
+	values = elements.values
+	
+	# Parsed strings, since most missing attributes use the same default
+	parsed = {}
+	
+	def get(name, i, width, parse, default):
+		# Packed value if there is one, otherwise from the string or template
+		if (present[name][i]):
+			return values[name][i * width:(i + 1) * width]
+		
+		string = getFromTemplate(elements.extras[i], templates, elements.extras[i].get("template", None), name, default)
+		
+		# Vectors (parse is None) can't be shared between boxes
+		if (parse == None):
+			return Vector3.fromString(string, name == "color")
+		
+		key = (name, string)
+		
+		if (key not in parsed):
+			parsed[key] = tuple(parse(string))
+		
+		return parsed[key]
+	
+	for i in range(elements.count):
+		if (get("visible", i, 1, lambda s: [0 if s == "0" else 1], "1")[0] == 0):
+			continue
+		
+		pos = get("pos", i, 3, None, "0 0 0")
+		size = get("size", i, 3, None, "0.5 0.5 0.5")
+		colour = get("color", i, 9, None, "1 1 1")
+		tile = get("tile", i, 3, parseIntTriplet, "0")
+		tileSize = get("tileSize", i, 3, parseFloatTriplet, "1")
+		tileRot = get("tileRot", i, 3, parseIntTriplet, "1")
+		glow = get("glow", i, 1, lambda s: [float(s)], "0")[0]
+		
+		# Packed values need to be made into the types that Box uses
+		if (type(pos) != Vector3): pos = Vector3(pos[0], pos[1], pos[2])
+		if (type(size) != Vector3): size = Vector3(size[0], size[1], size[2])
+		if (type(colour) == type(values["color"])): colour = [Vector3(colour[0], colour[1], colour[2]), Vector3(colour[3], colour[4], colour[5]), Vector3(colour[6], colour[7], colour[8])]
+		
+		boxes.append(Box(seg, pos, size, colour, tuple(tile), tuple(tileSize), tuple(tileRot), glow))
+	
+	return seg
+
 def getFromTemplate(boxattr, template_list, template, attr, default):
 	"""
 	Get an attribute from the template or object
@@ -869,15 +929,24 @@ def generateMeshData(data, seg = None, progress = None):
 ## =============================================================================
 ## =============================================================================
 
-def bakeMesh(data, templates_path = None, progress = None):
+def bakeMesh(data, templates_path = None, progress = None, templates = None):
 	"""
 	Bake a mesh from Smash Hit segment and return data
 	
-	data: Segment data as a string
+	data: Segment data as a string, or a typed binary segment as bytes
 	templates_path: Path to the templates file
+	templates: Already parsed templates, used instead of templates_path if given
 	"""
 	
-	seg = parseSegmentXML(data, parseTemplatesXml(templates_path) if templates_path else {})
+	if (templates == None):
+		templates = parseTemplatesXml(templates_path) if templates_path else {}
+	
+	# Typed binary segments (see binary_segment.py), which is only imported for
+	# them so the baker still runs on its own
+	if (type(data) in [bytes, bytearray, memoryview] and bytes(data[:4]) == b"SHSB"):
+		seg = parseSegmentBinary(data, templates)
+	else:
+		seg = parseSegmentXML(data, templates)
 	boxes = seg.boxes
 	
 	meshData = []
@@ -906,6 +975,35 @@ def bakeMeshToFile(data, output_file, template_file = None, progress = None):
 	f.write(mesh_data)
 	f.close()
 
+def bakeMeshJob(data, output_file, templates = None, options = None):
+	"""
+	Bake a mesh file from segment data with the given settings and return the
+	time it took. This is meant to be submitted to a process pool, so all of
+	the configuration is passed in instead of set on the module beforehand.
+	
+	options: Dict with any of "BAKE_UNSEEN_FACES", "ABMIENT_OCCLUSION_ENABLED"
+	and "LIGHTING_ENABLED"
+	"""
+	
+	import time
+	
+	global BAKE_UNSEEN_FACES, ABMIENT_OCCLUSION_ENABLED, LIGHTING_ENABLED
+	
+	start = time.perf_counter()
+	
+	options = options if options != None else {}
+	
+	BAKE_UNSEEN_FACES = options.get("BAKE_UNSEEN_FACES", False)
+	ABMIENT_OCCLUSION_ENABLED = options.get("ABMIENT_OCCLUSION_ENABLED", True)
+	LIGHTING_ENABLED = options.get("LIGHTING_ENABLED", False)
+	
+	mesh_data = bakeMesh(data, templates = templates)
+	
+	with open(output_file, "wb") as f:
+		f.write(mesh_data)
+	
+	return time.perf_counter() - start
+
 def main(input_file, output_file, template_file = None):
 	f = open(input_file, "r")
 	data = f.read()
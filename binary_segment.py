@@ -0,0 +1,499 @@
+#!/usr/bin/env python
+"""
+Typed binary segment format
+
+Unlike BinaryXML, the attributes that the known element types use (positions,
+sizes, colours, tiles and so on) are stored as packed float32 and uint8 arrays
+instead of text, with one array for each attribute of each element type. Tools
+can use them without parsing any numbers. Anything else, like templates and
+obstacle types, is kept as strings.
+
+Format (little endian):
+
+<bytes: "SHSB"> <u32: version>
+<u32: count> (<u32: length> <bytes: string>)* -- String table
+<u32: count> (<u32: name> <u32: value>)* -- Segment attributes
+<u32: count> <u8: type>* -- Type of each element, in document order
+For each type in TYPES:
+	<u32: count>
+	For each attribute in its schema:
+		<u8: present>[count] -- 1 if the element has the attribute
+		<f32 or u8: value>[count * width] -- Zero if not present
+	<u16: extra count>[count] (<u32: name> <u32: value>)* -- Other attributes
+<u32: count> (<u32: tag> <u16: count> (<u32: name> <u32: value>)*)* -- Elements of other types
+
+Strings are referenced by their index in the string table.
+
+Shorthand values that the mesh baker expands are expanded when they are
+stored, so a box colour with three values is stored as three colours and a box
+tile with one value as three tiles. Values that don't fit the schema are kept
+as strings, so they mean the same thing as they do in XML.
+"""
+
+import xml.etree.ElementTree as et
+import sys, pathlib, time, struct, math
+from array import array
+
+MAGIC = b"SHSB"
+VERSION = 1
+
+# Known element types, the index of a type is used in the element order list
+TYPES = ["box", "obstacle", "decal", "powerup", "water"]
+
+# Type index for elements that are not one of TYPES
+TYPE_OTHER = 255
+
+# Attributes that are stored as typed arrays for each type of element, as
+# (name, array typecode, number of values)
+SCHEMA = {
+	"box": [("pos", "f", 3), ("size", "f", 3), ("color", "f", 9), ("tile", "B", 3), ("tileSize", "f", 3), ("tileRot", "B", 3), ("visible", "B", 1), ("hidden", "B", 1), ("reflection", "B", 1), ("glow", "f", 1)],
+	"obstacle": [("pos", "f", 3), ("rot", "f", 3), ("hidden", "B", 1), ("mode", "B", 1)],
+	"decal": [("pos", "f", 3), ("rot", "f", 3), ("hidden", "B", 1), ("tile", "B", 1), ("size", "f", 2), ("color", "f", 4), ("blend", "f", 1)],
+	"powerup": [("pos", "f", 3), ("hidden", "B", 1)],
+	"water": [("pos", "f", 3), ("hidden", "B", 1), ("size", "f", 2)],
+}
+
+# Attributes that the mesh baker fills out by repeating a shorter value, and
+# how many values are repeated. A box colour of "r g b" is the same colour on
+# every side, but "0.5" is (0.5, 0, 0) and not grey, so it is not expanded.
+SHORTHANDS = {
+	("box", "color"): 3,
+	("box", "tile"): 1,
+	("box", "tileSize"): 1,
+	("box", "tileRot"): 1,
+}
+
+def parse_values(string, typecode, width, repeat = None):
+	"""
+	Parse an attribute into a list of width values that can be stored in an
+	array of the given typecode, or return None if it can't be. If repeat is
+	given then that many values are repeated to make width values.
+	"""
+	
+	try:
+		if (typecode == "f"):
+			values = [float(v) for v in string.split()]
+		else:
+			values = [int(v) for v in string.split()]
+	except ValueError:
+		return None
+	
+	if (repeat and len(values) == repeat):
+		values = values * (width // repeat)
+	
+	if (len(values) != width):
+		return None
+	
+	if (typecode == "f"):
+		if (not all(math.isfinite(v) and abs(v) < 3.0e38 for v in values)):
+			return None
+	elif (not all(0 <= v <= 255 for v in values)):
+		return None
+	
+	return values
+
+def format_values(values):
+	"""
+	Format values from an array as an attribute string
+	"""
+	
+	return " ".join(f"{v:.7g}" if type(v) == float else str(v) for v in values)
+
+class ElementArrays:
+	"""
+	The elements of one type in struct of arrays form. For each attribute in
+	the type's schema there is an array of values and a bytes object that says
+	if each element has that attribute. extras has a dict of any other
+	attributes for each element.
+	"""
+	
+	def __init__(self, kind):
+		self.kind = kind
+		self.count = 0
+		self.values = {name: array(typecode) for name, typecode, width in SCHEMA[kind]}
+		self.widths = {name: width for name, typecode, width in SCHEMA[kind]}
+		self.present = {name: bytearray() for name, typecode, width in SCHEMA[kind]}
+		self.extras = []
+	
+	def append(self, attrib):
+		"""
+		Add an element given its attributes
+		"""
+		
+		extras = dict(attrib)
+		
+		for name, typecode, width in SCHEMA[self.kind]:
+			values = parse_values(extras[name], typecode, width, SHORTHANDS.get((self.kind, name), None)) if name in extras else None
+			
+			if (values != None):
+				del extras[name]
+				self.values[name].extend(values)
+				self.present[name].append(1)
+			else:
+				self.values[name].extend([0] * width)
+				self.present[name].append(0)
+		
+		self.extras.append(extras)
+		self.count += 1
+	
+	def get(self, name, i):
+		"""
+		Get the values of attribute name for element i as a tuple, or None if
+		it does not have them as typed values
+		"""
+		
+		if (not self.present[name][i]):
+			return None
+		
+		width = self.widths[name]
+		
+		return tuple(self.values[name][i * width:(i + 1) * width])
+	
+	def attrib(self, i):
+		"""
+		Get the attributes of element i as strings
+		"""
+		
+		result = {}
+		
+		for name, typecode, width in SCHEMA[self.kind]:
+			values = self.get(name, i)
+			
+			if (values != None):
+				result[name] = format_values(values)
+		
+		result.update(self.extras[i])
+		
+		return result
+
+class BinarySegment:
+	"""
+	A segment in the typed binary format
+	"""
+	
+	def __init__(self):
+		self.attrib = {}
+		self.order = bytearray()
+		self.elements = {kind: ElementArrays(kind) for kind in TYPES}
+		self.others = []
+	
+	@classmethod
+	def fromTree(self, root):
+		"""
+		Make a binary segment from an XML tree
+		"""
+		
+		segment = BinarySegment()
+		segment.attrib = dict(root.attrib)
+		
+		for e in root:
+			if (e.tag in segment.elements):
+				segment.order.append(TYPES.index(e.tag))
+				segment.elements[e.tag].append(e.attrib)
+			else:
+				segment.order.append(TYPE_OTHER)
+				segment.others.append((e.tag, dict(e.attrib)))
+		
+		return segment
+	
+	def toTree(self):
+		"""
+		Make an XML tree from the segment. Elements are in the same order as
+		they were in the original.
+		"""
+		
+		root = et.Element("segment", self.attrib)
+		index = {kind: 0 for kind in TYPES}
+		others = iter(self.others)
+		
+		for t in self.order:
+			if (t == TYPE_OTHER):
+				tag, attrib = next(others)
+				et.SubElement(root, tag, attrib)
+			else:
+				kind = TYPES[t]
+				et.SubElement(root, kind, self.elements[kind].attrib(index[kind]))
+				index[kind] += 1
+		
+		return root
+	
+	def toBytes(self):
+		"""
+		Encode the segment
+		"""
+		
+		strings = {}
+		
+		def ref(string):
+			index = strings.get(string, None)
+			
+			if (index == None):
+				index = len(strings)
+				strings[string] = index
+			
+			return index
+		
+		def pairs(attrib):
+			return array("I", [ref(s) for kv in attrib.items() for s in kv])
+		
+		# Everything after the string table, which has to be made first
+		body = bytearray()
+		
+		body += struct.pack("<I", len(self.attrib)) + littleEndian(pairs(self.attrib)).tobytes()
+		body += struct.pack("<I", len(self.order)) + self.order
+		
+		for kind in TYPES:
+			elements = self.elements[kind]
+			body += struct.pack("<I", elements.count)
+			
+			for name, typecode, width in SCHEMA[kind]:
+				body += elements.present[name]
+				body += littleEndian(elements.values[name]).tobytes()
+			
+			body += littleEndian(array("H", [len(e) for e in elements.extras])).tobytes()
+			
+			for extras in elements.extras:
+				body += littleEndian(pairs(extras)).tobytes()
+		
+		body += struct.pack("<I", len(self.others))
+		
+		for tag, attrib in self.others:
+			body += struct.pack("<IH", ref(tag), len(attrib)) + littleEndian(pairs(attrib)).tobytes()
+		
+		# Header and string table
+		data = bytearray(MAGIC + struct.pack("<II", VERSION, len(strings)))
+		
+		for string in strings:
+			string = string.encode("utf-8")
+			data += struct.pack("<I", len(string)) + string
+		
+		data += body
+		
+		return bytes(data)
+	
+	@classmethod
+	def fromBytes(self, data):
+		"""
+		Decode a segment
+		"""
+		
+		data = memoryview(data)
+		
+		if (bytes(data[:4]) != MAGIC):
+			raise ValueError("Not a binary segment")
+		
+		version, count = struct.unpack_from("<II", data, 4)
+		
+		if (version != VERSION):
+			raise ValueError(f"Unsupported binary segment version {version}")
+		
+		pos = 12
+		
+		def read_array(typecode, count):
+			nonlocal pos
+			result = array(typecode)
+			size = result.itemsize * count
+			result.frombytes(data[pos:pos + size])
+			pos += size
+			return littleEndian(result)
+		
+		def read_pairs(count):
+			refs = read_array("I", count * 2)
+			return {strings[refs[i]]: strings[refs[i + 1]] for i in range(0, len(refs), 2)}
+		
+		def read_u32():
+			nonlocal pos
+			pos += 4
+			return struct.unpack_from("<I", data, pos - 4)[0]
+		
+		# String table
+		strings = []
+		
+		for i in range(count):
+			length = read_u32()
+			strings.append(str(data[pos:pos + length], "utf-8"))
+			pos += length
+		
+		segment = BinarySegment()
+		segment.attrib = read_pairs(read_u32())
+		
+		count = read_u32()
+		segment.order = bytearray(data[pos:pos + count])
+		pos += count
+		
+		for kind in TYPES:
+			elements = segment.elements[kind]
+			elements.count = read_u32()
+			
+			for name, typecode, width in SCHEMA[kind]:
+				elements.present[name] = bytes(data[pos:pos + elements.count])
+				pos += elements.count
+				elements.values[name] = read_array(typecode, elements.count * width)
+			
+			elements.extras = [read_pairs(c) for c in read_array("H", elements.count)]
+		
+		for i in range(read_u32()):
+			tag, count = struct.unpack_from("<IH", data, pos)
+			pos += 6
+			segment.others.append((strings[tag], read_pairs(count)))
+		
+		return segment
+
+def littleEndian(values):
+	"""
+	Convert an array between native and little endian order, which makes a
+	swapped copy on big endian machines
+	"""
+	
+	if (sys.byteorder == "big"):
+		values = array(values.typecode, values)
+		values.byteswap()
+	
+	return values
+
+def from_string(string):
+	"""
+	Encode an XML segment string into the typed binary format
+	"""
+	
+	return BinarySegment.fromTree(et.fromstring(string)).toBytes()
+
+def to_string(data):
+	"""
+	Decode a typed binary segment into an XML string
+	"""
+	
+	return et.tostring(BinarySegment.fromBytes(data).toTree(), encoding = "unicode")
+
+def benchmark(folder, repeat = 5, check = 10):
+	"""
+	Compare parsing segments for the mesh baker from XML and from the binary
+	format, and check that the meshes baked from the first few are the same
+	"""
+	
+	import bake_mesh, binaryxml
+	
+	texts = [binaryxml.load_segment_text(path) for path in binaryxml.find_segments(folder)]
+	
+	if (not texts):
+		print(f"No segments found in {folder}")
+		return 1
+	
+	binaries = [from_string(t) for t in texts]
+	
+	xml_size = sum(len(t.encode("utf-8")) for t in texts)
+	print(f"{len(texts)} segments, {xml_size} bytes of XML, {sum(len(b) for b in binaries)} bytes binary")
+	
+	def best(function, items):
+		total = None
+		
+		for i in range(repeat):
+			start = time.perf_counter()
+			
+			for item in items:
+				function(item)
+			
+			total = min(total, time.perf_counter() - start) if total else time.perf_counter() - start
+		
+		return total
+	
+	print(f"parseSegmentXML: {best(bake_mesh.parseSegmentXML, texts):.3f}s")
+	print(f"parseSegmentBinary: {best(bake_mesh.parseSegmentBinary, binaries):.3f}s")
+	
+	# The values are rounded to float32, so the meshes might not be exactly the
+	# same. Baking is slow so only some are checked.
+	checked = list(zip(texts, binaries))[:check]
+	same = sum(bake_mesh.bakeMesh(t) == bake_mesh.bakeMesh(b) for t, b in checked)
+	print(f"{same} of {len(checked)} baked meshes are exactly the same")
+	
+	return 0
+
+# Boxes that use shorthands and other values that the baker reads in its own
+# way, which have to bake the same from both formats
+CHECK_SEGMENTS = [
+	'<segment size="12 10 8"><box pos="0 0 -2" size="1" color="0.5" tile="3"/></segment>',
+	'<segment size="12 10 8"><box pos="0 0 -2" size="1 0.5 2" color="0.5 0.6 0.7" tile="3" tileSize="2" tileRot="1"/></segment>',
+	'<segment size="12 10 8"><box pos="0 0 -2" size="1 0.5 2" color="1" tile="3 4" tileSize="2 1"/></segment>',
+	'<segment size="12 10 8"><box pos="0 0 -2 1" size="1 0.5 2" color="0.1 0.2 0.3 0.5" tile="1 2 3 4"/></segment>',
+	'<segment size="12 10 8"><box pos="1 1" size="0.5 0.5 0.5 9" color="0.1 0.2 0.3 0.4 0.5 0.6 0.7 0.8 0.9" tile="2 3 4" visible="1"/><box pos="0 0 -4" visible="0"/></segment>',
+]
+
+def round_to_float32(text):
+	"""
+	Round each number in the float attributes of a segment to float32, without
+	changing how many values there are, so it bakes the same as the binary
+	format would if the values mean the same thing
+	"""
+	
+	root = et.fromstring(text)
+	
+	def rounded(value):
+		try:
+			return repr(struct.unpack("<f", struct.pack("<f", float(value)))[0])
+		except (ValueError, OverflowError):
+			return value
+	
+	for e in root:
+		for name, typecode, width in SCHEMA.get(e.tag, []):
+			if (typecode == "f" and name in e.attrib):
+				e.attrib[name] = " ".join(rounded(v) for v in e.attrib[name].split())
+	
+	return et.tostring(root, encoding = "unicode")
+
+def check(folder = None):
+	"""
+	Bake each segment in folder (if given) and the segments in CHECK_SEGMENTS
+	from XML and from the binary format, and check that the meshes are the
+	same. Returns 1 if any of them are not.
+	"""
+	
+	import bake_mesh, binaryxml
+	
+	texts = [(f"CHECK_SEGMENTS[{i}]", t) for i, t in enumerate(CHECK_SEGMENTS)]
+	
+	if (folder):
+		texts += [(path, binaryxml.load_segment_text(path)) for path in binaryxml.find_segments(folder)]
+	
+	failed = 0
+	
+	for name, text in texts:
+		# The binary format only has float32 precision
+		xml_mesh = bake_mesh.bakeMesh(round_to_float32(text))
+		binary_mesh = bake_mesh.bakeMesh(from_string(text))
+		
+		if (xml_mesh != binary_mesh):
+			print(f"{name}: baked {len(xml_mesh)} bytes from XML but {len(binary_mesh)} bytes from binary")
+			failed += 1
+	
+	print(f"{len(texts) - failed} of {len(texts)} segments bake the same from both formats")
+	
+	return 1 if failed else 0
+
+def print_usage_and_exit():
+	print(f"Usage:")
+	print(f"{sys.argv[0]} to_bin [input] [output]")
+	print(f"{sys.argv[0]} from_bin [input] [output]")
+	print(f"{sys.argv[0]} benchmark [folder with segments]")
+	print(f"{sys.argv[0]} check [folder with segments]")
+	sys.exit(1)
+
+def main():
+	if (len(sys.argv) == 2 and sys.argv[1] == "check"):
+		sys.exit(check())
+	
+	if (len(sys.argv) < 3):
+		print_usage_and_exit()
+	
+	if (sys.argv[1] == "to_bin" and len(sys.argv) == 4):
+		pathlib.Path(sys.argv[3]).write_bytes(from_string(pathlib.Path(sys.argv[2]).read_text()))
+	elif (sys.argv[1] == "from_bin" and len(sys.argv) == 4):
+		pathlib.Path(sys.argv[3]).write_text(to_string(pathlib.Path(sys.argv[2]).read_bytes()))
+	elif (sys.argv[1] == "benchmark" and len(sys.argv) == 3):
+		sys.exit(benchmark(sys.argv[2]))
+	elif (sys.argv[1] == "check" and len(sys.argv) == 3):
+		sys.exit(check(sys.argv[2]))
+	else:
+		print_usage_and_exit()
+
+if (__name__ == "__main__"):
+	main()
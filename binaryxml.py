@@ -12,16 +12,44 @@ Format:
 0x03 <nulstring: text> -- Text in tag
 0xff <eof> -- End of stream
 
-Currently this only converts to the format. This is really just meant to
-be a bake only format that you implement on the side of the other app!
+Format 2 stores every tag and attribute name, and any value that is used more
+than once, in a string table at the start so each one is only stored once.
+Numbers are unsigned LEB128 varints. A string reference is 0 followed by an
+inline string, or the index of a string in the table plus one.
+
+<nulstring: "\x00BinaryXML format 2.0 (by Knot126)"> -- Header
+<varint: count> (<varint: length> <bytes: string>)* -- String table
+0x01 <ref: tag name> <varint: count> (<ref: attrib> <ref: value>)* -- Start of tag
+0x02 -- End of the last tag that was started
+0x03 <ref: text> -- Text in tag
+0xff <eof> -- End of stream
+
+Inline strings are <varint: length> <bytes: string>.
+
+Both formats can be decoded back into an ElementTree, mostly so that baked
+files can be checked. The format is really just meant to be a bake only format
+that you implement on the side of the other app!
 """
 
 import xml.etree.ElementTree as et
-import sys, os, pathlib
+import sys, os, pathlib, time, gzip, mmap, hashlib, json
+
+FORMAT_1_HEADER = b"\x00BinaryXML format 1.0 (by Knot126)\x00"
+FORMAT_2_HEADER = b"\x00BinaryXML format 2.0 (by Knot126)\x00"
+
+# When writing to a file, data is written out in chunks of about this size
+CHUNK_SIZE = 1 << 16
+
+# Name of the manifest file in the output folder of a directory conversion
+MANIFEST_NAME = "binaryxml-manifest.json"
 
 def print_usage_and_exit():
 	print(f"Usage:")
-	print(f"{sys.argv[0]} to_bin [input] [output]")
+	print(f"{sys.argv[0]} to_bin [input] [output] [format version, default 1]")
+	print(f"{sys.argv[0]} to_bin_dir [input folder] [output folder] [format version, default 1]")
+	print(f"{sys.argv[0]} from_bin [input] [output]")
+	print(f"{sys.argv[0]} benchmark [folder with segments]")
+	print(f"{sys.argv[0]} validate [folder with segments]")
 	sys.exit(1)
 
 def node_to_bin(node):
@@ -55,29 +83,638 @@ def node_to_bin(node):
 	
 	return data
 
-def from_string(string):
+def varint(value):
 	"""
-	Bake an XML string into a BinaryXML byte string
+	Encode an unsigned LEB128 number
 	"""
 	
-	root = et.fromstring(string)
-	
 	data = bytearray()
-	data += b"\x00BinaryXML format 1.0 (by Knot126)\x00"
 	
-	data += node_to_bin(root)
+	while (value >= 0x80):
+		data.append((value & 0x7f) | 0x80)
+		value >>= 7
+	
+	data.append(value)
+	
+	return bytes(data)
+
+SMALL_VARINTS = [bytes([i]) for i in range(0x80)]
+
+def make_string_table(root):
+	"""
+	Make the string table for a tree, returning the list of strings and a dict
+	of strings to their reference number. All tag and attribute names are in
+	the table, and values and text are only in it if they are used more than
+	once.
+	"""
+	
+	names = {}
+	counts = {}
+	
+	for node in root.iter():
+		names[node.tag] = None
+		
+		for a, v in node.attrib.items():
+			names[a] = None
+			counts[v] = counts.get(v, 0) + 1
+		
+		if (node.text):
+			counts[node.text] = counts.get(node.text, 0) + 1
+	
+	strings = list(names) + [v for v, c in counts.items() if c > 1 and v not in names]
+	
+	return strings, {string: i + 1 for i, string in enumerate(strings)}
+
+def tree_to_bin_v1(root, out = None):
+	"""
+	Convert an XML tree to format 1 binary. This makes the same data as
+	node_to_bin, but uses its own stack instead of recursion. If out is a file
+	then the data is written to it as it is made and the size is returned.
+	"""
+	
+	data = bytearray(FORMAT_1_HEADER)
+	written = 0
+	
+	# The stack has each open node and an iterator over its children
+	stack = [(None, iter([root]))]
+	
+	while (stack):
+		node = next(stack[-1][1], None)
+		
+		# No more children so the node is done
+		if (node == None):
+			node = stack.pop()[0]
+			
+			if (node != None):
+				if (node.text):
+					data += b"\x03" + node.text.encode('utf-8') + b"\x00"
+				
+				data += b"\x02" + node.tag.encode('utf-8') + b"\x00"
+			
+			continue
+		
+		data += b"\x01" + node.tag.encode('utf-8') + b"\x00"
+		
+		for a, v in node.attrib.items():
+			data += b"\x01" + a.encode('utf-8') + b"\x00" + v.encode('utf-8') + b"\x00"
+		
+		data += b"\x00"
+		
+		stack.append((node, iter(node)))
+		
+		if (out and len(data) >= CHUNK_SIZE):
+			written += out.write(data)
+			data.clear()
 	
 	data += b"\xff"
 	
+	if (out):
+		return written + out.write(data)
+	
+	return data
+
+def tree_to_bin_v2(root, out = None):
+	"""
+	Convert an XML tree to format 2 binary. This writes into one buffer and
+	uses its own stack instead of recursion, so each node is only written once.
+	If out is a file then the data is written to it as it is made and the size
+	is returned.
+	"""
+	
+	strings, refs = make_string_table(root)
+	
+	# The encoded reference for each string, since most are used many times
+	encoded = {}
+	
+	def ref(string):
+		result = encoded.get(string, None)
+		
+		if (result == None):
+			index = refs.get(string, 0)
+			
+			if (index):
+				result = varint(index)
+			else:
+				value = string.encode('utf-8')
+				result = b"\x00" + varint(len(value)) + value
+			
+			encoded[string] = result
+		
+		return result
+	
+	data = bytearray(FORMAT_2_HEADER)
+	written = 0
+	
+	# String table
+	data += varint(len(strings))
+	
+	for string in strings:
+		string = string.encode('utf-8')
+		data += varint(len(string))
+		data += string
+	
+	# Nodes, the stack has an iterator over the children of each open node
+	stack = [iter([root])]
+	
+	while (stack):
+		node = next(stack[-1], None)
+		
+		# No more children so the node is done
+		if (node == None):
+			stack.pop()
+			
+			if (stack):
+				data.append(0x02)
+			
+			continue
+		
+		attrib = node.attrib
+		
+		data.append(0x01)
+		data += encoded.get(node.tag) or ref(node.tag)
+		data += varint(len(attrib)) if len(attrib) >= 0x80 else SMALL_VARINTS[len(attrib)]
+		
+		for a, v in attrib.items():
+			data += encoded.get(a) or ref(a)
+			data += encoded.get(v) or ref(v)
+		
+		if (node.text):
+			data.append(0x03)
+			data += encoded.get(node.text) or ref(node.text)
+		
+		stack.append(iter(node))
+		
+		if (out and len(data) >= CHUNK_SIZE):
+			written += out.write(data)
+			data.clear()
+	
+	data.append(0xff)
+	
+	if (out):
+		return written + out.write(data)
+	
 	return data
 
+def tree_to_bin(root, version = 1, out = None):
+	"""
+	Convert an XML tree into a BinaryXML byte string with the given format
+	version, or write it to the file out and return the size
+	"""
+	
+	if (version == 2):
+		return tree_to_bin_v2(root, out)
+	
+	return tree_to_bin_v1(root, out)
+
+def from_string(string, version = 1):
+	"""
+	Bake an XML string into a BinaryXML byte string with the given format
+	version
+	"""
+	
+	return tree_to_bin(et.fromstring(string), version)
+
+def read_varint(data, pos):
+	"""
+	Read an unsigned LEB128 number at pos, returning it and the position after
+	it
+	"""
+	
+	value = 0
+	shift = 0
+	
+	while (True):
+		byte = data[pos]
+		pos += 1
+		value |= (byte & 0x7f) << shift
+		
+		if (byte < 0x80):
+			return value, pos
+		
+		shift += 7
+
+def iter_events_v1(data, pos):
+	"""
+	Yield the events in format 1 data starting at pos
+	"""
+	
+	def read_string():
+		nonlocal pos
+		end = data.find(b"\x00", pos)
+		
+		if (end < 0):
+			raise ValueError(f"Unterminated string at {pos}")
+		
+		string = data[pos:end].decode('utf-8')
+		pos = end + 1
+		
+		return string
+	
+	while (True):
+		op = data[pos]
+		pos += 1
+		
+		if (op == 0x01):
+			tag = read_string()
+			attrib = {}
+			
+			while (data[pos] == 0x01):
+				pos += 1
+				name = read_string()
+				attrib[name] = read_string()
+			
+			pos += 1
+			
+			yield ("start", tag, attrib)
+		elif (op == 0x02):
+			yield ("end", read_string(), None)
+		elif (op == 0x03):
+			yield ("text", read_string(), None)
+		elif (op == 0x00):
+			yield ("comment", read_string(), None)
+		elif (op == 0xff):
+			return
+		else:
+			raise ValueError(f"Unknown opcode 0x{op:02x} at {pos - 1}")
+
+def iter_events_v2(data, pos):
+	"""
+	Yield the events in format 2 data starting at pos, which is just after the
+	header
+	"""
+	
+	# String table
+	count, pos = read_varint(data, pos)
+	strings = [None]
+	
+	for i in range(count):
+		length, pos = read_varint(data, pos)
+		strings.append(data[pos:pos + length].decode('utf-8'))
+		pos += length
+	
+	def read_ref():
+		nonlocal pos
+		index, pos = read_varint(data, pos)
+		
+		if (index):
+			return strings[index]
+		
+		length, pos = read_varint(data, pos)
+		string = data[pos:pos + length].decode('utf-8')
+		pos += length
+		
+		return string
+	
+	# The end tags don't have the tag name, so keep track of them
+	tags = []
+	
+	while (True):
+		op = data[pos]
+		pos += 1
+		
+		if (op == 0x01):
+			tag = read_ref()
+			count, pos = read_varint(data, pos)
+			attrib = {}
+			
+			for i in range(count):
+				name = read_ref()
+				attrib[name] = read_ref()
+			
+			tags.append(tag)
+			
+			yield ("start", tag, attrib)
+		elif (op == 0x02):
+			yield ("end", tags.pop(), None)
+		elif (op == 0x03):
+			yield ("text", read_ref(), None)
+		elif (op == 0xff):
+			# The root node's end is implied
+			while (tags):
+				yield ("end", tags.pop(), None)
+			
+			return
+		else:
+			raise ValueError(f"Unknown opcode 0x{op:02x} at {pos - 1}")
+
+def iter_events(data):
+	"""
+	Yield the events in BinaryXML data of either format, which can be bytes or
+	a memory mapped file. Events are tuples of ("start", tag, attrib),
+	("end", tag, None), ("text", text, None) or ("comment", text, None).
+	"""
+	
+	if (data[:len(FORMAT_2_HEADER)] == FORMAT_2_HEADER):
+		return iter_events_v2(data, len(FORMAT_2_HEADER))
+	else:
+		return iter_events_v1(data, 0)
+
+def to_tree(data):
+	"""
+	Decode BinaryXML data into an ElementTree element
+	"""
+	
+	root = None
+	stack = []
+	
+	for kind, value, attrib in iter_events(data):
+		if (kind == "start"):
+			node = et.SubElement(stack[-1], value, attrib) if stack else et.Element(value, attrib)
+			
+			if (root == None):
+				root = node
+			
+			stack.append(node)
+		elif (kind == "end"):
+			stack.pop()
+		elif (kind == "text"):
+			stack[-1].text = value
+	
+	if (root == None):
+		raise ValueError("There is no root node")
+	
+	return root
+
+def load(path):
+	"""
+	Decode a BinaryXML file into an ElementTree element, memory mapping the
+	file instead of reading all of it
+	"""
+	
+	with open(path, "rb") as f:
+		with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as data:
+			return to_tree(data)
+
+def to_string(data):
+	"""
+	Decode BinaryXML data into an XML string
+	"""
+	
+	return et.tostring(to_tree(data), encoding = "unicode")
+
+def trees_equal(a, b):
+	"""
+	Check if two trees have the same tags, attributes and text, returning None
+	if they do or a description of the first difference if they don't
+	"""
+	
+	stack = [(a, b)]
+	
+	while (stack):
+		a, b = stack.pop()
+		
+		if (a.tag != b.tag):
+			return f"tag {a.tag} is {b.tag}"
+		
+		if (a.attrib != b.attrib):
+			return f"attributes of {a.tag} are {b.attrib} instead of {a.attrib}"
+		
+		if ((a.text or "") != (b.text or "")):
+			return f"text of {a.tag} is {b.text!r} instead of {a.text!r}"
+		
+		if (len(a) != len(b)):
+			return f"{a.tag} has {len(b)} children instead of {len(a)}"
+		
+		stack.extend(zip(a, b))
+	
+	return None
+
+def binary_name(path):
+	"""
+	Get the name of the binary file for a segment file, like "a.xml.mp3" to
+	"a.bin"
+	"""
+	
+	head, tail = os.path.split(path)
+	
+	return os.path.join(head, tail[:tail.index(".xml")] + ".bin")
+
+def convert_file_job(source, dest, version, old_hash):
+	"""
+	Convert one XML file to a BinaryXML file, unless the hash of the source is
+	old_hash. The output is streamed to a temporary file which replaces dest
+	when it is done. This is meant to be run in a process pool.
+	
+	Returns a tuple of (source hash, source size, output size or None if it
+	was skipped, error or None).
+	"""
+	
+	try:
+		data = pathlib.Path(source).read_bytes()
+		digest = hashlib.sha256(data).hexdigest()
+		
+		if (digest == old_hash):
+			return (digest, len(data), None, None)
+		
+		if (data[:2] == b"\x1f\x8b"):
+			data = gzip.decompress(data)
+		
+		root = et.fromstring(data)
+		
+		os.makedirs(os.path.dirname(dest) or ".", exist_ok = True)
+		
+		with open(dest + ".tmp", "wb") as f:
+			size = tree_to_bin(root, version, f)
+		
+		os.replace(dest + ".tmp", dest)
+		
+		return (digest, len(data), size, None)
+	except Exception as e:
+		return (None, 0, None, str(e))
+
+def convert_directory(source, dest, version = 1, workers = None):
+	"""
+	Convert every segment in the source folder to BinaryXML files in the dest
+	folder, with the same folder layout, in parallel worker processes.
+	
+	A manifest of the hashes of the source files is kept in the dest folder,
+	and files that have not changed since they were last converted are
+	skipped. Returns 0 on success and 1 if any files failed.
+	"""
+	
+	from concurrent.futures import ProcessPoolExecutor
+	
+	start = time.perf_counter()
+	
+	manifest_path = os.path.join(dest, MANIFEST_NAME)
+	
+	try:
+		old_manifest = json.loads(pathlib.Path(manifest_path).read_text())
+	except (OSError, ValueError):
+		old_manifest = {}
+	
+	# Work out what needs to be converted
+	jobs = []
+	
+	for path in find_segments(source):
+		name = os.path.relpath(path, source).replace(os.sep, "/")
+		output = os.path.join(dest, binary_name(name))
+		entry = old_manifest.get(name, {})
+		
+		# Only skip if the old output is still there and in the same format
+		old_hash = entry.get("hash", None) if entry.get("version", None) == version and os.path.exists(output) else None
+		
+		jobs.append((name, path, output, old_hash))
+	
+	manifest = {}
+	converted = skipped = failed = 0
+	converted_bytes = 0
+	
+	with ProcessPoolExecutor(max_workers = workers) as pool:
+		results = pool.map(convert_file_job, [j[1] for j in jobs], [j[2] for j in jobs], [version] * len(jobs), [j[3] for j in jobs], chunksize = 8)
+		
+		for (name, path, output, old_hash), (digest, size, output_size, error) in zip(jobs, results):
+			if (error):
+				print(f"{path}: {error}")
+				failed += 1
+				continue
+			
+			manifest[name] = {"hash": digest, "version": version}
+			
+			if (output_size == None):
+				skipped += 1
+			else:
+				converted += 1
+				converted_bytes += size
+	
+	# Write the manifest so it is never half written
+	os.makedirs(dest, exist_ok = True)
+	pathlib.Path(manifest_path + ".tmp").write_text(json.dumps(manifest, indent = "\t"))
+	os.replace(manifest_path + ".tmp", manifest_path)
+	
+	total = time.perf_counter() - start
+	
+	print(f"Converted {converted}, skipped {skipped} unchanged, {failed} failed in {total:.3f}s ({converted_bytes / total / 1e6:.1f} MB/s of XML)")
+	
+	return 1 if failed else 0
+
+def load_segment_text(path):
+	"""
+	Load a segment's XML text, which might be gzip compressed
+	"""
+	
+	data = pathlib.Path(path).read_bytes()
+	
+	if (data[:2] == b"\x1f\x8b"):
+		data = gzip.decompress(data)
+	
+	return data.decode('utf-8')
+
+def find_segments(folder):
+	"""
+	Find the segment files in a folder and its subfolders
+	"""
+	
+	return sorted(str(p) for p in pathlib.Path(folder).rglob("*") if p.is_file() and (p.name.endswith(".xml") or ".xml." in p.name))
+
+def benchmark(folder, repeat = 5):
+	"""
+	Compare the size and encoding time of format 1 and format 2 for all the
+	segments in a folder. Times are the best of repeat runs.
+	"""
+	
+	texts = [load_segment_text(path) for path in find_segments(folder)]
+	
+	if (not texts):
+		print(f"No segments found in {folder}")
+		return 1
+	
+	xml_size = sum(len(t.encode('utf-8')) for t in texts)
+	
+	# Parsing is the same for both, so only the encoding is timed
+	start = time.perf_counter()
+	trees = [et.fromstring(t) for t in texts]
+	total = time.perf_counter() - start
+	
+	print(f"{len(texts)} segments, {xml_size} bytes of XML, parsed in {total:.3f}s")
+	
+	for version in [1, 2]:
+		total = None
+		
+		for i in range(repeat):
+			start = time.perf_counter()
+			results = [tree_to_bin(t, version) for t in trees]
+			total = min(total, time.perf_counter() - start) if total else time.perf_counter() - start
+		
+		size = sum(len(r) for r in results)
+		compressed = sum(len(gzip.compress(r)) for r in results)
+		
+		print(f"format {version}: {size} bytes ({size / xml_size * 100:.1f}% of XML), {compressed} bytes gzipped, encoded in {total:.3f}s ({xml_size / total / 1e6:.1f} MB/s of XML)")
+	
+	return 0
+
+def validate(folder, repeat = 5):
+	"""
+	Check that every segment in a folder is the same after being encoded and
+	decoded in both formats, and compare decoding speed with parsing the XML.
+	Returns 0 if they all match and 1 otherwise.
+	"""
+	
+	paths = find_segments(folder)
+	texts = [load_segment_text(path) for path in paths]
+	
+	if (not texts):
+		print(f"No segments found in {folder}")
+		return 1
+	
+	xml_size = sum(len(t.encode('utf-8')) for t in texts)
+	failed = 0
+	
+	# Round trip
+	trees = [et.fromstring(t) for t in texts]
+	encoded = {version: [tree_to_bin(t, version) for t in trees] for version in [1, 2]}
+	
+	for version in [1, 2]:
+		for path, tree, data in zip(paths, trees, encoded[version]):
+			difference = trees_equal(tree, to_tree(bytes(data)))
+			
+			if (difference):
+				print(f"{path}: format {version}: {difference}")
+				failed += 1
+	
+	print(f"{len(texts)} segments: {failed} round trip failures")
+	
+	# Decoding speed
+	def best(function, items):
+		total = None
+		
+		for i in range(repeat):
+			start = time.perf_counter()
+			
+			for item in items:
+				function(item)
+			
+			total = min(total, time.perf_counter() - start) if total else time.perf_counter() - start
+		
+		return total
+	
+	total = best(et.fromstring, texts)
+	print(f"et.fromstring: {total:.3f}s ({xml_size / total / 1e6:.1f} MB/s of XML)")
+	
+	for version in [1, 2]:
+		total = best(to_tree, [bytes(d) for d in encoded[version]])
+		print(f"format {version} to_tree: {total:.3f}s ({xml_size / total / 1e6:.1f} MB/s of XML)")
+	
+	return 1 if failed else 0
+
 def main():
-	if (len(sys.argv) != 4):
+	if (len(sys.argv) < 3):
 		print_usage_and_exit()
 	
 	# Convert to bin
-	if (sys.argv[1] == "to_bin"):
-		pathlib.Path(sys.argv[3]).write_bytes(from_string(pathlib.Path(sys.argv[2]).read_text()))
+	if (sys.argv[1] == "to_bin" and len(sys.argv) in [4, 5]):
+		version = int(sys.argv[4]) if len(sys.argv) == 5 else 1
+		pathlib.Path(sys.argv[3]).write_bytes(from_string(pathlib.Path(sys.argv[2]).read_text(), version))
+	elif (sys.argv[1] == "to_bin_dir" and len(sys.argv) in [4, 5]):
+		sys.exit(convert_directory(sys.argv[2], sys.argv[3], int(sys.argv[4]) if len(sys.argv) == 5 else 1))
+	elif (sys.argv[1] == "from_bin" and len(sys.argv) == 4):
+		tree = load(sys.argv[2])
+		et.indent(tree, space = "\t")
+		pathlib.Path(sys.argv[3]).write_text(et.tostring(tree, encoding = "unicode"))
+	elif (sys.argv[1] == "benchmark" and len(sys.argv) == 3):
+		sys.exit(benchmark(sys.argv[2]))
+	elif (sys.argv[1] == "validate" and len(sys.argv) == 3):
+		sys.exit(validate(sys.argv[2]))
 	else:
 		print_usage_and_exit()
 
@@ -154,6 +154,51 @@ class sh_export_auto(bpy.types.Operator):
 def sh_draw_export_auto(self, context):
 	self.layout.operator("sh.export_auto", text="SHBT: Export to APK")
 
+class sh_export_batch(Operator):
+	"""
+	Export all segments in the blend file to the APK
+	"""
+	
+	bl_idname = "sh.export_batch"
+	bl_label = "Export All Segments to APK"
+	
+	use_collections: BoolProperty(
+		name = "Use collections",
+		description = "Export each collection in the current scene as a segment named after the collection, instead of exporting each scene as a segment",
+		default = False,
+	)
+	
+	push_to_server: BoolProperty(
+		name = "Send to test server",
+		description = "Also send the segments to the quick test server, which will serve a room that cycles through all of them",
+		default = False,
+	)
+	
+	def execute(self, context):
+		segment_export.setCursor(context, 'WAIT')
+		
+		try:
+			report, total = segment_export.sh_export_all_segments(
+				context,
+				use_collections = self.use_collections,
+				templates_path = segment_export.tryTemplatesPath(),
+				push_to_server = self.push_to_server,
+			)
+		finally:
+			segment_export.setCursor(context, 'DEFAULT')
+		
+		failed = len([entry for entry in report if entry["error"]])
+		
+		if (failed):
+			self.report({'WARNING'}, f"Exported {len(report) - failed} segments in {total:.2f} seconds, {failed} failed (see the console)")
+		else:
+			self.report({'INFO'}, f"Exported {len(report)} segments in {total:.2f} seconds")
+		
+		return {'FINISHED'}
+
+def sh_draw_export_batch(self, context):
+	self.layout.operator("sh.export_batch", text="SHBT: Export All Segments to APK")
+
 class sh_export_test(Operator):
 	"""
 	Compressed segment export
@@ -231,8 +276,20 @@ class sh_import(bpy.types.Operator, segment_export.ExportHelper2):
 	filename_ext = ".xml.mp3"
 	filter_glob = bpy.props.StringProperty(default='*.xml.mp3', options={'HIDDEN'}, maxlen=255)
 	
+	use_proxy: BoolProperty(
+		name = "Box proxy",
+		description = "Load all boxes into a single proxy object instead of one object per box, which makes importing very large segments much faster. Select faces of the proxy in edit mode and use Realise Selected Boxes to make them into normal boxes",
+		default = False,
+	)
+	
+	use_shared_meshes: BoolProperty(
+		name = "Obstacle meshes",
+		description = "Import obstacles and decals as objects that share one mesh for each obstacle type or decal tile instead of as empties. Each one is still its own object with its own properties",
+		default = False,
+	)
+	
 	def execute(self, context):
-		return segment_import.sh_import_segment(self.filepath, context)
+		return segment_import.sh_import_segment(self.filepath, context, proxy = self.use_proxy, shared_meshes = self.use_shared_meshes)
 
 def sh_draw_import(self, context):
 	self.layout.operator("sh.import", text="Segment (.xml.mp3)")
@@ -249,12 +306,65 @@ class sh_import_gz(bpy.types.Operator, segment_export.ExportHelper2):
 	filename_ext = ".xml.gz.mp3"
 	filter_glob = bpy.props.StringProperty(default='*.xml.gz.mp3', options={'HIDDEN'}, maxlen=255)
 	
+	use_proxy: BoolProperty(
+		name = "Box proxy",
+		description = "Load all boxes into a single proxy object instead of one object per box, which makes importing very large segments much faster. Select faces of the proxy in edit mode and use Realise Selected Boxes to make them into normal boxes",
+		default = False,
+	)
+	
+	use_shared_meshes: BoolProperty(
+		name = "Obstacle meshes",
+		description = "Import obstacles and decals as objects that share one mesh for each obstacle type or decal tile instead of as empties. Each one is still its own object with its own properties",
+		default = False,
+	)
+	
 	def execute(self, context):
-		return segment_import.sh_import_segment(self.filepath, context, True)
+		return segment_import.sh_import_segment(self.filepath, context, True, proxy = self.use_proxy, shared_meshes = self.use_shared_meshes)
 
 def sh_draw_import_gz(self, context):
 	self.layout.operator("sh.import_gz", text="Compressed Segment (.xml.gz.mp3)")
 
+class sh_realise_boxes(Operator):
+	"""
+	Make the boxes that have a face selected in a box proxy into normal boxes
+	"""
+	
+	bl_idname = "sh.realise_boxes"
+	bl_label = "Realise Selected Boxes"
+	
+	@classmethod
+	def poll(self, context):
+		return context.object is not None and common.PROXY_BOXES_PROPERTY in context.object
+	
+	def execute(self, context):
+		objects = segment_import.sh_realise_proxy_boxes(context.object)
+		
+		self.report({'INFO'}, f"Realised {len(objects)} boxes")
+		
+		return {'FINISHED'}
+
+class sh_import_room(bpy.types.Operator, segment_export.ExportHelper2):
+	"""
+	Import all segments in a room, or in a folder, side by side
+	"""
+	
+	bl_idname = "sh.import_room"
+	bl_label = "Import Room"
+	
+	check_extension = False
+	filename_ext = ".lua.mp3"
+	filter_glob = bpy.props.StringProperty(default='*.lua.mp3;*.lua;*.xml.mp3;*.xml.gz.mp3', options={'HIDDEN'}, maxlen=255)
+	
+	def execute(self, context):
+		count, total = segment_import.sh_import_room(self.filepath, context)
+		
+		self.report({'INFO'}, f"Imported {count} segments in {total:.2f} seconds")
+		
+		return {'FINISHED'}
+
+def sh_draw_import_room(self, context):
+	self.layout.operator("sh.import_room", text="Room or Folder of Segments (.lua.mp3)")
+
 ## EDITOR
 ## The following things are more related to the editor and are not specifically
 ## for exporting or importing segments.
@@ -294,6 +404,12 @@ class sh_SceneProperties(PropertyGroup):
 		max = 1024.0,
 	) 
 	
+	sh_export_collection: PointerProperty(
+		name = "Collection",
+		description = "Only export the objects in this collection. If this is not set, all of the objects in the current scene are exported",
+		type = bpy.types.Collection,
+	)
+	
 	sh_box_bake_mode: EnumProperty(
 		name = "Box bake mode",
 		description = "This will control how the boxes should be exported. Hover over each option for an explation of how it works",
@@ -902,6 +1018,7 @@ class sh_SegmentPanel(Panel):
 		sub = layout.box()
 		sub.label(text = "Segment data", icon = "SCENE_DATA")
 		sub.prop(sh_properties, "sh_len")
+		sub.prop(sh_properties, "sh_export_collection")
 		sub.prop(sh_properties, "sh_box_bake_mode")
 		sub.prop(sh_properties, "sh_template")
 		sub.prop(sh_properties, "sh_softshadow")
@@ -964,6 +1081,14 @@ class sh_ObstaclePanel(Panel):
 		object = context.object
 		sh_properties = object.sh_properties
 		
+		# Box proxies stand in for many boxes, so they don't have properties
+		# of their own
+		if (common.PROXY_BOXES_PROPERTY in object):
+			layout.label(text = "Box proxy", icon = "MESH_CUBE")
+			layout.operator("sh.realise_boxes")
+			layout.prop(sh_properties, "sh_export")
+			return
+		
 		# All objects will have all properties, but only some will be used for
 		# each of obstacle there is.
 		layout.prop(sh_properties, "sh_type")
@@ -1104,6 +1229,13 @@ class sh_ShowMessage(Operator):
 		return self.execute(context)
 
 def run_updater():
+	# Put back the old files if Blender was closed while updating
+	try:
+		if (updater.rollback_delta_update()):
+			print(f"Smash Hit Tools: Rolled back an update that did not finish")
+	except Exception as e:
+		print(f"Smash Hit Tools: updater.rollback_delta_update(): {e}")
+	
 	try:
 		global bl_info
 		updater.check_for_updates(bl_info["version"])
@@ -1121,10 +1253,13 @@ classes = (
 	sh_export,
 	sh_export_gz,
 	sh_export_auto,
+	sh_export_batch,
 	sh_export_binary,
 	sh_export_test,
 	sh_import,
 	sh_import_gz,
+	sh_import_room,
+	sh_realise_boxes,
 )
 
 def register():
@@ -1140,12 +1275,14 @@ def register():
 	bpy.types.TOPBAR_MT_file_export.append(sh_draw_export)
 	bpy.types.TOPBAR_MT_file_export.append(sh_draw_export_gz)
 	bpy.types.TOPBAR_MT_file_export.append(sh_draw_export_auto)
+	bpy.types.TOPBAR_MT_file_export.append(sh_draw_export_batch)
 	# bpy.types.TOPBAR_MT_file_export.append(sh_draw_export_binary)
 	bpy.types.TOPBAR_MT_file_export.append(sh_draw_export_test)
 	
 	# Add import operators to menu
 	bpy.types.TOPBAR_MT_file_import.append(sh_draw_import)
 	bpy.types.TOPBAR_MT_file_import.append(sh_draw_import_gz)
+	bpy.types.TOPBAR_MT_file_import.append(sh_draw_import_room)
 	
 	# Start server
 	global g_process_test_server
@@ -1153,7 +1290,7 @@ def register():
 	if (g_process_test_server and bpy.context.preferences.addons["blender_tools"].preferences.enable_quick_test_server):
 		g_process_test_server = server.runServerProcess()
 	
-	# Check for updates
+	# Check for updates, in the background
 	run_updater()
 
 def unregister():
@@ -1167,5 +1304,5 @@ def unregister():
 	# Shutdown server
 	global g_process_test_server
 	
-	if (g_process_test_server):
-		g_process_test_server.terminate()
+	if (g_process_test_server and g_process_test_server != True):
+		server.stopServerProcess(g_process_test_server)
@@ -29,6 +29,11 @@ Max length for property strings
 """
 MAX_STRING_LENGTH = 512
 
+"""
+Name of the custom property that box proxies store their boxes in
+"""
+PROXY_BOXES_PROPERTY = "shbt_proxy_boxes"
+
 """
 Update info URL
 """
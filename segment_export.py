@@ -6,12 +6,16 @@ import common
 import xml.etree.ElementTree as et
 import bpy
 import gzip
+import json
 import os
 import os.path as ospath
 import pathlib
 import tempfile
+import traceback
 import bake_mesh
 import obstacle_db
+import segment_import
+import server
 import util
 
 from bpy.props import (StringProperty, BoolProperty, IntProperty, IntVectorProperty, FloatProperty, FloatVectorProperty, EnumProperty, PointerProperty)
@@ -177,181 +181,335 @@ def sh_create_root(scene, params):
 	
 	return level_root
 
-def sh_add_object(level_root, scene, obj, params):
+def formatVector(values):
 	"""
-	This will add an obstacle to level_root
+	Format a list of numbers as a space seperated string, like "1.0 2.0 3.0"
 	"""
 	
-	# These positions are swapped
-	position = {"X": obj.location[1], "Y": obj.location[2], "Z": obj.location[0]}
-	
-	# VR Multiply setting
-	sh_vrmultiply = params.get("sh_vrmultiply", 1.0)
-	
-	if (sh_vrmultiply != 1.0):
-		position["Z"] = position["Z"] * sh_vrmultiply
-	
-	# The only gaurrented to exsist is pos
-	properties = {
-		"pos": str(position["X"]) + " " + str(position["Y"]) + " " + str(position["Z"]),
-	}
-	
-	# Shorthand for obj.sh_properties.sh_type
-	sh_type = obj.sh_properties.sh_type
+	return " ".join(map(str, values))
+
+class ObjectRecord:
+	"""
+	Plain snapshot of the properties of an object that are needed to export it.
 	
-	# Type for obstacles
-	if (sh_type == "OBS"):
-		properties["type"] = obj.sh_properties.sh_obstacle_chooser if obj.sh_properties.sh_use_chooser else obj.sh_properties.sh_obstacle
+	Every RNA property is read exactly once here, and only the properties that
+	the type of object actually uses are read. Everything after this works on
+	plain python values.
+	"""
 	
-	# Type for power-ups
-	if (sh_type == "POW"):
-		properties["type"] = obj.sh_properties.sh_powerup
+	def __init__(self, obj):
+		props = obj.sh_properties
+		sh_type = props.sh_type
 		
-	# Hidden for all types
-	if (obj.sh_properties.sh_hidden):
-		properties["hidden"] = "1"
-	else:
-		properties["hidden"] = "0"
-	
-	# Add size for boxes
-	if (sh_type == "BOX"):
-		# Again, swapped becuase of Smash Hit's demensions
-		size = {"X": obj.dimensions[1] / 2, "Y": obj.dimensions[2] / 2, "Z": obj.dimensions[0] / 2}
+		self.sh_type = sh_type
+		self.location = tuple(obj.location)
+		self.hidden = props.sh_hidden
+		self.template = props.sh_template
 		
-		# VR Multiply setting
-		if (sh_vrmultiply != 1.0 and (abs(size["Z"]) > 2.0)):
-			size["Z"] = size["Z"] * sh_vrmultiply
+		if (sh_type == "BOX"):
+			self.dimensions = tuple(obj.dimensions)
+			self.visible = props.sh_visible
+			self.reflective = props.sh_reflective
+			self.glow = props.sh_glow
+			self.decal = props.sh_decal
+			self.tint = tuple(props.sh_tint)
+			
+			if (self.visible):
+				self.use_multitint = props.sh_use_multitint
+				
+				if (self.use_multitint):
+					self.tints = (tuple(props.sh_tint1), tuple(props.sh_tint2), tuple(props.sh_tint3))
+				
+				self.use_multitile = props.sh_use_multitile
+				
+				if (self.use_multitile):
+					self.tiles = (props.sh_tile1, props.sh_tile2, props.sh_tile3)
+				else:
+					self.tile = props.sh_tile
+				
+				self.tilesize = tuple(props.sh_tilesize)
+				self.tilerot = tuple(props.sh_tilerot)
+		
+		elif (sh_type == "OBS"):
+			self.rotation = tuple(obj.rotation_euler)
+			self.obstacle = props.sh_obstacle_chooser if props.sh_use_chooser else props.sh_obstacle
+			self.mode = props.sh_mode
+			self.params = (props.sh_param0, props.sh_param1, props.sh_param2, props.sh_param3, props.sh_param4, props.sh_param5, props.sh_param6, props.sh_param7, props.sh_param8, props.sh_param9, props.sh_param10, props.sh_param11)
+		
+		elif (sh_type == "DEC"):
+			self.rotation = tuple(obj.rotation_euler)
+			self.decal = props.sh_decal
+			self.size = tuple(props.sh_size)
+			self.havetint = props.sh_havetint
+			self.tint = tuple(props.sh_tint)
+			self.blend = props.sh_blend
 		
-		properties["size"] = str(size["X"]) + " " + str(size["Y"]) + " " + str(size["Z"])
+		elif (sh_type == "POW"):
+			self.powerup = props.sh_powerup
+		
+		elif (sh_type == "WAT"):
+			self.dimensions = tuple(obj.dimensions)
+
+class ProxyBoxRecord:
+	"""
+	Snapshot of a box in a box proxy, with the same fields as the ObjectRecord
+	of a box so it is exported the same way.
+	"""
 	
-	# Add rotation paramater if any rotation has been done
-	if (sh_type == "OBS" or sh_type == "DEC"):
-		if (obj.rotation_euler[1] != 0.0 or obj.rotation_euler[2] != 0.0 or obj.rotation_euler[0] != 0.0):
-			properties["rot"] = str(obj.rotation_euler[1]) + " " + str(obj.rotation_euler[2]) + " " + str(obj.rotation_euler[0])
+	def __init__(self, attrib, matrix):
+		record = segment_import.transformProxyBox(segment_import.parseElement("box", attrib), matrix)
+		colour = record["colour"]
+		tile = record["tile"]
+		
+		self.sh_type = "BOX"
+		self.location = tuple(record["pos"])
+		self.dimensions = tuple(size * 2 for size in record["size"])
+		self.hidden = record["hidden"]
+		self.template = record["template"]
+		self.visible = record["visible"]
+		self.reflective = record["reflective"]
+		self.glow = record["glow"]
+		self.decal = record["decal"]
+		self.tint = tuple(colour[0]) + (1.0,)
+		self.use_multitint = (len(colour) > 1)
+		self.tints = tuple(tuple(c) + (1.0,) for c in colour)
+		self.use_multitile = (len(tile) > 1)
+		self.tiles = tuple(tile)
+		self.tile = tile[0]
+		self.tilesize = tuple(record["tilesize"])
+		self.tilerot = tuple(record["tilerot"])
+
+def formatPosition(record, sh_vrmultiply):
+	"""
+	Format the position of a record, swapping axes to Smash Hit's order
+	"""
 	
-	# Add template for all types of objects
-	# HACK: We don't export with a template value if the visible attribute is checked. There is a bug somewhere in the meshbaker that I can't fix right now which causes this.
-	# NOTE I think it's fixed, but it's still pointless to export the template in this case.
-	if (obj.sh_properties.sh_template and ((not obj.sh_properties.sh_visible) or (sh_type != "BOX"))):
-		properties["template"] = obj.sh_properties.sh_template
+	loc = record.location
 	
-	# Add mode appearance tag
-	if (sh_type == "OBS"):
-		mask = 0b0
-		
-		for v in [("training", 1), ("classic", 2), ("expert", 4), ("versus", 16), ("coop", 32)]:
-			if (v[0] in obj.sh_properties.sh_mode):
-				mask |= v[1]
-		
-		if (mask != 0b110111):
-			properties["mode"] = str(mask)
+	return formatVector((loc[1], loc[2], loc[0] * sh_vrmultiply if sh_vrmultiply != 1.0 else loc[0]))
+
+def formatRotation(record, properties):
+	"""
+	Add the rotation attribute if any rotation has been done
+	"""
 	
-	# Add reflection property for boxes if not default
-	if (sh_type == "BOX" and obj.sh_properties.sh_reflective):
-		properties["reflection"] = "1"
+	rot = record.rotation
 	
-	# Add glow property for boxes if not default
-	if (sh_type == "BOX" and obj.sh_properties.sh_glow != 0.0):
-		properties["glow"] = str(obj.sh_properties.sh_glow)
+	if (rot[1] != 0.0 or rot[2] != 0.0 or rot[0] != 0.0):
+		properties["rot"] = formatVector((rot[1], rot[2], rot[0]))
+
+def formatBox(record, sh_vrmultiply):
+	"""
+	Get the attributes for a box record
+	"""
 	
-	# Add decal number if this is a decal
-	if (sh_type == "DEC"):
-		properties["tile"] = str(obj.sh_properties.sh_decal)
+	properties = {
+		"pos": formatPosition(record, sh_vrmultiply),
+		"hidden": "1" if record.hidden else "0",
+	}
 	
-	# Add decal size if this is a decal (based on sh_size)
-	if (sh_type == "DEC"):
-		properties["size"] = str(obj.sh_properties.sh_size[0]) + " " + str(obj.sh_properties.sh_size[1])
+	# Again, swapped becuase of Smash Hit's demensions
+	dim = record.dimensions
+	size_z = dim[0] / 2
 	
-	# Add water size if this is a water (based on physical plane properties)
-	if (sh_type == "WAT"):
-		size = {"X": obj.dimensions[1] / 2, "Z": obj.dimensions[0] / 2}
-		
-		properties["size"] = str(size["X"]) + " " + str(size["Z"])
+	# VR Multiply setting
+	if (sh_vrmultiply != 1.0 and (abs(size_z) > 2.0)):
+		size_z = size_z * sh_vrmultiply
 	
-	# Set each of the tweleve paramaters if they are needed.
-	if (sh_type == "OBS"):
-		for i in range(12):
-			val = getattr(obj.sh_properties, "sh_param" + str(i))
-			
-			if (val):
-				properties["param" + str(i)] = val
+	properties["size"] = formatVector((dim[1] / 2, dim[2] / 2, size_z))
 	
-	# Set tint for decals
-	if (sh_type == "DEC" and obj.sh_properties.sh_havetint):
-		properties["color"] = str(obj.sh_properties.sh_tint[0]) + " " + str(obj.sh_properties.sh_tint[1]) + " " + str(obj.sh_properties.sh_tint[2]) + " " + str(obj.sh_properties.sh_tint[3])
+	# HACK: We don't export with a template value if the visible attribute is checked. There is a bug somewhere in the meshbaker that I can't fix right now which causes this.
+	# NOTE I think it's fixed, but it's still pointless to export the template in this case.
+	if (record.template and not record.visible):
+		properties["template"] = record.template
 	
-	# Set blend for decals
-	if (sh_type == "DEC" and obj.sh_properties.sh_blend != 1.0):
-		properties["blend"] = str(obj.sh_properties.sh_blend)
+	if (record.reflective):
+		properties["reflection"] = "1"
 	
-	if (sh_type == "BOX"):
-		if (obj.sh_properties.sh_visible):
-			properties["visible"] = "1"
-		else:
-			if (not obj.sh_properties.sh_template):
-				properties["visible"] = "0"
+	if (record.glow != 0.0):
+		properties["glow"] = str(record.glow)
 	
-	# Set tile info for boxes if visible and there is no template specified
-	if (sh_type == "BOX" and obj.sh_properties.sh_visible):
+	if (record.visible):
+		properties["visible"] = "1"
+	elif (not record.template):
+		properties["visible"] = "0"
+	
+	# Set tile info for boxes if visible
+	if (record.visible):
 		# Depending on if colour per side is selected
-		if (not obj.sh_properties.sh_use_multitint):
-			properties["color"] = str(obj.sh_properties.sh_tint[0]) + " " + str(obj.sh_properties.sh_tint[1]) + " " + str(obj.sh_properties.sh_tint[2])
+		if (not record.use_multitint):
+			properties["color"] = formatVector(record.tint[:3])
 		else:
-			properties["color"] = str(obj.sh_properties.sh_tint1[0]) + " " + str(obj.sh_properties.sh_tint1[1]) + " " + str(obj.sh_properties.sh_tint1[2]) + " " + str(obj.sh_properties.sh_tint2[0]) + " " + str(obj.sh_properties.sh_tint2[1]) + " " + str(obj.sh_properties.sh_tint2[2]) + " " + str(obj.sh_properties.sh_tint3[0]) + " " + str(obj.sh_properties.sh_tint3[1]) + " " + str(obj.sh_properties.sh_tint3[2])
+			properties["color"] = formatVector(record.tints[0][:3] + record.tints[1][:3] + record.tints[2][:3])
 		
 		# Depnding on if tile per side is selected
-		if (not obj.sh_properties.sh_use_multitile):
-			properties["tile"] = str(obj.sh_properties.sh_tile)
+		if (not record.use_multitile):
+			properties["tile"] = str(record.tile)
 		else:
-			properties["tile"] = str(obj.sh_properties.sh_tile1) + " " + str(obj.sh_properties.sh_tile2) + " " + str(obj.sh_properties.sh_tile3)
+			properties["tile"] = formatVector(record.tiles)
 		
 		# Tile size for boxes
-		if (obj.sh_properties.sh_tilesize[0] != 1.0 or obj.sh_properties.sh_tilesize[1] != 1.0 or obj.sh_properties.sh_tilesize[2] != 1.0):
-			properties["tileSize"] = str(obj.sh_properties.sh_tilesize[0]) + " " + str(obj.sh_properties.sh_tilesize[1]) + " " + str(obj.sh_properties.sh_tilesize[2])
+		tilesize = record.tilesize
+		
+		if (tilesize[0] != 1.0 or tilesize[1] != 1.0 or tilesize[2] != 1.0):
+			properties["tileSize"] = formatVector(tilesize)
 		
 		# Tile rotation
-		if (obj.sh_properties.sh_tilerot[1] > 0.0 or obj.sh_properties.sh_tilerot[2] > 0.0 or obj.sh_properties.sh_tilerot[0] > 0.0):
-			properties["tileRot"] = str(obj.sh_properties.sh_tilerot[0]) + " " + str(obj.sh_properties.sh_tilerot[1]) + " " + str(obj.sh_properties.sh_tilerot[2])
-	
-	# Set the tag name
-	element_type = "entity"
-	
-	if (sh_type == "BOX"):
-		element_type = "box"
-	elif (sh_type == "OBS"):
-		element_type = "obstacle"
-	elif (sh_type == "DEC"):
-		element_type = "decal"
-	elif (sh_type == "POW"):
-		element_type = "powerup"
-	elif (sh_type == "WAT"):
-		element_type = "water"
+		tilerot = record.tilerot
+		
+		if (tilerot[1] > 0.0 or tilerot[2] > 0.0 or tilerot[0] > 0.0):
+			properties["tileRot"] = formatVector(tilerot)
+	
+	return properties
+
+def formatObstacle(record, sh_vrmultiply):
+	"""
+	Get the attributes for an obstacle record
+	"""
+	
+	properties = {
+		"pos": formatPosition(record, sh_vrmultiply),
+		"type": record.obstacle,
+		"hidden": "1" if record.hidden else "0",
+	}
+	
+	formatRotation(record, properties)
+	
+	if (record.template):
+		properties["template"] = record.template
+	
+	# Add mode appearance tag
+	mask = 0b0
+	
+	for v in MODE_BITS:
+		if (v[0] in record.mode):
+			mask |= v[1]
+	
+	if (mask != 0b110111):
+		properties["mode"] = str(mask)
+	
+	# Set each of the tweleve paramaters if they are needed.
+	for i, val in enumerate(record.params):
+		if (val):
+			properties[PARAM_NAMES[i]] = val
+	
+	return properties
+
+def formatDecal(record, sh_vrmultiply):
+	"""
+	Get the attributes for a decal record
+	"""
+	
+	properties = {
+		"pos": formatPosition(record, sh_vrmultiply),
+		"hidden": "1" if record.hidden else "0",
+	}
+	
+	formatRotation(record, properties)
+	
+	if (record.template):
+		properties["template"] = record.template
+	
+	properties["tile"] = str(record.decal)
+	properties["size"] = formatVector(record.size)
+	
+	if (record.havetint):
+		properties["color"] = formatVector(record.tint)
+	
+	if (record.blend != 1.0):
+		properties["blend"] = str(record.blend)
+	
+	return properties
+
+def formatPowerup(record, sh_vrmultiply):
+	"""
+	Get the attributes for a power-up record
+	"""
+	
+	properties = {
+		"pos": formatPosition(record, sh_vrmultiply),
+		"type": record.powerup,
+		"hidden": "1" if record.hidden else "0",
+	}
+	
+	if (record.template):
+		properties["template"] = record.template
+	
+	return properties
+
+def formatWater(record, sh_vrmultiply):
+	"""
+	Get the attributes for a water record
+	"""
+	
+	properties = {
+		"pos": formatPosition(record, sh_vrmultiply),
+		"hidden": "1" if record.hidden else "0",
+	}
+	
+	if (record.template):
+		properties["template"] = record.template
+	
+	# Water size is based on physical plane properties
+	dim = record.dimensions
+	properties["size"] = formatVector((dim[1] / 2, dim[0] / 2))
+	
+	return properties
+
+def formatEntity(record, sh_vrmultiply):
+	"""
+	Get the attributes for a record of a type without its own formatter
+	"""
+	
+	properties = {
+		"pos": formatPosition(record, sh_vrmultiply),
+		"hidden": "1" if record.hidden else "0",
+	}
+	
+	if (record.template):
+		properties["template"] = record.template
+	
+	return properties
+
+# Mode names and their bits in the mode mask
+MODE_BITS = [("training", 1), ("classic", 2), ("expert", 4), ("versus", 16), ("coop", 32)]
+
+# Names of the obstacle parameter attributes
+PARAM_NAMES = ["param" + str(i) for i in range(12)]
+
+# Tag name and attribute formatter for each type of object
+RECORD_FORMATTERS = {
+	"BOX": ("box", formatBox),
+	"OBS": ("obstacle", formatObstacle),
+	"DEC": ("decal", formatDecal),
+	"POW": ("powerup", formatPowerup),
+	"WAT": ("water", formatWater),
+}
+
+def sh_add_record(level_root, scene, record, params):
+	"""
+	This will add the element(s) for a snapshotted object to level_root
+	"""
+	
+	sh_vrmultiply = params.get("sh_vrmultiply", 1.0)
+	element_type, formatter = RECORD_FORMATTERS.get(record.sh_type, ("entity", formatEntity))
 	
 	# Add the element to the document
-	el = et.SubElement(level_root, element_type, properties)
-	el.tail = "\n\t"
-	if (params["isLast"]): # Fixes the issues with the last line of the file
-		el.tail = "\n"
+	et.SubElement(level_root, element_type, formatter(record, sh_vrmultiply))
 	
-	if (params.get("sh_box_bake_mode", "Mesh") == "StoneHack" and sh_type == "BOX" and obj.sh_properties.sh_visible):
+	if (params.get("sh_box_bake_mode", "Mesh") == "StoneHack" and record.sh_type == "BOX" and record.visible):
 		"""
 		Export a fake obstacle that will represent stone in the level.
 		"""
 		
-		el.tail = "\n\t\t"
-		
-		size = {"X": obj.dimensions[1] / 2, "Y": obj.dimensions[2] / 2, "Z": obj.dimensions[0] / 2}
-		position = {"X": obj.location[1], "Y": obj.location[2], "Z": obj.location[0]}
-		
-		# VR Multiply setting
-		if (sh_vrmultiply != 1.0):
-			position["Z"] = position["Z"] * sh_vrmultiply
+		dim = record.dimensions
+		size = {"X": dim[1] / 2, "Y": dim[2] / 2, "Z": dim[0] / 2}
 		
 		if (sh_vrmultiply != 1.0 and ((scene.sh_len[2] / 2) - 0.5) < abs(size["Z"])):
 			size["Z"] = size["Z"] * sh_vrmultiply
 		
 		properties = {
-			"pos": str(position["X"]) + " " + str(position["Y"]) + " " + str(position["Z"]),
+			"pos": formatPosition(record, sh_vrmultiply),
 			"type": "stone",
 			"param9": "sizeX=" + str(size["X"]),
 			"param10": "sizeY=" + str(size["Y"]),
@@ -359,40 +517,70 @@ def sh_add_object(level_root, scene, obj, params):
 			"IMPORT_IGNORE": "STONEHACK_IGNORE",
 		}
 		
-		if (obj.sh_properties.sh_template):
-			properties["template"] = obj.sh_properties.sh_template
+		if (record.template):
+			properties["template"] = record.template
 		else:
-			properties["param7"] = "tile=" + str(obj.sh_properties.sh_decal)
-			properties["param8"] = "color=" + str(obj.sh_properties.sh_tint[0]) + " " + str(obj.sh_properties.sh_tint[1]) + " " + str(obj.sh_properties.sh_tint[2])
+			properties["param7"] = "tile=" + str(record.decal)
+			properties["param8"] = "color=" + formatVector(record.tint[:3])
 		
-		el_stone = et.SubElement(level_root, "obstacle", properties)
-		el_stone.tail = "\n\t"
-		if (params["isLast"]):
-			el_stone.tail = "\n"
+		et.SubElement(level_root, "obstacle", properties)
+
+def getExportObjects(context, params = None):
+	"""
+	Get the objects that should be exported for the current segment.
+	
+	These are the objects in the export collection if one is given (either by
+	the "sh_collection" param or the scene's export collection), otherwise the
+	objects in the scene. The scene is the "sh_scene" param if it is given or
+	the current scene otherwise. Objects with export disabled are left out.
+	"""
+	
+	params = params if params != None else {}
+	b_scene = params.get("sh_scene", None) or context.scene
+	collection = params.get("sh_collection", None) or b_scene.sh_properties.sh_export_collection
+	objects = collection.all_objects if collection else b_scene.objects
+	
+	return [obj for obj in objects if obj.sh_properties.sh_export]
 
 def createSegmentText(context, params):
 	"""
 	Export the XML part of a segment to a string
 	"""
 	
-	scene = context.scene.sh_properties
-	b_scene = context.scene
+	scene = (params.get("sh_scene", None) or context.scene).sh_properties
 	level_root = sh_create_root(scene, params)
 	
-	# Export each object to XML node
-	for i in range(len(bpy.data.objects)):
-		obj = bpy.data.objects[i]
-		
-		if (not obj.sh_properties.sh_export):
-			continue
-		
-		params["isLast"] = False
-		
-		# HACK: This hack doesn't work if the last object isn't visible.
-		if (i == (len(bpy.data.objects) - 1)):
-			params["isLast"] = True
+	# Snapshot each object that will be exported
+	records = []
+	proxies = []
+	
+	for obj in getExportObjects(context, params):
+		if (common.PROXY_BOXES_PROPERTY in obj):
+			proxies.append(obj)
+		else:
+			records.append(ObjectRecord(obj))
+	
+	# The boxes that are still in box proxies are exported like normal boxes,
+	# after the other objects like they were before
+	for obj in proxies:
+		matrix = obj.matrix_world.copy()
 		
-		sh_add_object(level_root, scene, obj, params)
+		for attrib in json.loads(obj[common.PROXY_BOXES_PROPERTY]):
+			# Realised boxes are exported as normal objects
+			if (attrib != None):
+				records.append(ProxyBoxRecord(attrib, matrix))
+	
+	# Export each record to XML node
+	for record in records:
+		sh_add_record(level_root, scene, record, params)
+	
+	# Indent the elements now that they all exist; the last one closes the
+	# segment tag on its own line
+	for el in level_root:
+		el.tail = "\n\t"
+	
+	if (len(level_root)):
+		level_root[-1].tail = "\n"
 	
 	# Add file header with version
 	file_header = "<!-- Exporter: Smash Hit Tools v" + str(common.BL_INFO["version"][0]) + "." + str(common.BL_INFO["version"][1]) + "." + str(common.BL_INFO["version"][2]) + " -->\n"
@@ -402,6 +590,52 @@ def createSegmentText(context, params):
 	
 	return content
 
+def benchmarkSegmentText(context, count = 5000):
+	"""
+	Time createSegmentText over a generated scene with count objects of every
+	type. This needs to be run inside of Blender, for example:
+	
+	blender -b --python-expr "import segment_export, bpy; segment_export.benchmarkSegmentText(bpy.context)"
+	"""
+	
+	import time
+	
+	# Build the fixture scene; all objects share one mesh
+	mesh = bpy.data.meshes.new("shbt-benchmark")
+	scene = bpy.data.scenes.new("shbt-benchmark")
+	kinds = ["BOX", "BOX", "BOX", "OBS", "DEC", "POW", "WAT"]
+	objects = []
+	
+	for i in range(count):
+		kind = kinds[i % len(kinds)]
+		obj = bpy.data.objects.new("shbt-benchmark", mesh if kind in ("BOX", "WAT") else None)
+		obj.location = ((i % 7) - 3.0, (i % 5) - 2.0, -(i * 0.1))
+		obj.sh_properties.sh_type = kind
+		obj.sh_properties.sh_visible = (i % 2 == 0)
+		obj.sh_properties.sh_obstacle = "scoretop"
+		obj.sh_properties.sh_param0 = "color=1 0 0" if (i % 3 == 0) else ""
+		scene.collection.objects.link(obj)
+		objects.append(obj)
+	
+	try:
+		start = time.perf_counter()
+		records = [ObjectRecord(obj) for obj in objects]
+		snapshot_time = time.perf_counter() - start
+		
+		start = time.perf_counter()
+		content = createSegmentText(context, {"sh_vrmultiply": 1.0, "sh_box_bake_mode": "Mesh", "sh_collection": scene.collection})
+		total_time = time.perf_counter() - start
+	finally:
+		for obj in objects:
+			bpy.data.objects.remove(obj)
+		
+		bpy.data.meshes.remove(mesh)
+		bpy.data.scenes.remove(scene)
+	
+	print(f"Smash Hit Tools: Benchmark: {count} objects, snapshot {snapshot_time:.3f}s, createSegmentText {total_time:.3f}s ({count / total_time:.0f} objects/s, {len(content)} chars)")
+	
+	return total_time
+
 def parseTemplatesXml(path):
 	"""
 	Load templates from a file
@@ -448,6 +682,65 @@ def solveTemplates(segment_text, templates = {}):
 	# Back to a string!
 	return et.tostring(root).decode('utf-8')
 
+def getAutoExportPath(props, apk = None, segment = None):
+	"""
+	Get the path that the segment with the given scene properties should be
+	exported to in the open APK, and make the folders for it. The APK path and
+	segment name are found automatically if they are not given.
+	"""
+	
+	if (not apk):
+		apk = util.find_apk()
+	
+	if (not apk):
+		raise FileNotFoundError("There is currently no APK open in APK Editor Studio. Please open a Smash Hit APK with a valid structure and try again.")
+	
+	segment = segment if segment else props.sh_segment
+	
+	if (not props.sh_level or not props.sh_room or not segment):
+		raise FileNotFoundError("You have not set one of the level, room or segment name properties needed to use auto export to apk feature. Please set these in the scene tab and try again.")
+	
+	filepath = apk + "/segments/" + props.sh_level + "/" + props.sh_room + "/" + segment + ".xml.gz.mp3"
+	
+	util.prepare_folders(filepath)
+	
+	return filepath
+
+def getMeshPath(filepath, compress = False):
+	"""
+	Get the path of the mesh file that goes with a segment file
+	"""
+	
+	meshfile = ospath.splitext(ospath.splitext(filepath)[0])[0]
+	
+	if (compress):
+		meshfile = ospath.splitext(meshfile)[0]
+	
+	return meshfile + ".mesh.mp3"
+
+def getExportParams(props):
+	"""
+	Get the export params that come from a scene's segment properties, the same
+	way that the export operators set them
+	"""
+	
+	return {
+		"sh_vrmultiply": props.sh_vrmultiply,
+		"sh_box_bake_mode": props.sh_box_bake_mode,
+		"bake_menu_segment": props.sh_menu_segment,
+		"bake_vertex_light": props.sh_ambient_occlusion,
+		"lighting_enabled": props.sh_lighting,
+	}
+
+def setCursor(context, cursor):
+	"""
+	Set the mouse cursor if there is a window to set it on, which there is not
+	when running in the background
+	"""
+	
+	if (context.window):
+		context.window.cursor_set(cursor)
+
 def MB_progress_update_callback(value):
 	bpy.context.window_manager.progress_update(value)
 
@@ -457,25 +750,12 @@ def sh_export_segment(filepath, context, *, compress = False, params = {}):
 	"""
 	
 	# Set wait cursor
-	context.window.cursor_set('WAIT')
+	setCursor(context, 'WAIT')
 	
 	# If the filepath is None, then find it from the apk and force enable
 	# compression
 	if (filepath == None and params.get("auto_find_filepath", False)):
-		props = context.scene.sh_properties
-		
-		filepath = util.find_apk()
-		
-		if (not filepath):
-			raise FileNotFoundError("There is currently no APK open in APK Editor Studio. Please open a Smash Hit APK with a valid structure and try again.")
-		
-		if (not props.sh_level or not props.sh_room or not props.sh_segment):
-			raise FileNotFoundError("You have not set one of the level, room or segment name properties needed to use auto export to apk feature. Please set these in the scene tab and try again.")
-		
-		filepath += "/segments/" + props.sh_level + "/" + props.sh_room + "/" + props.sh_segment + ".xml.gz.mp3"
-		
-		util.prepare_folders(filepath)
-		
+		filepath = getAutoExportPath(context.scene.sh_properties)
 		compress = True
 	
 	# Export to xml string
@@ -505,30 +785,36 @@ def sh_export_segment(filepath, context, *, compress = False, params = {}):
 		if (templates):
 			content = solveTemplates(content, parseTemplatesXml(templates))
 		
-		# Make dirs
-		tempdir = tempfile.gettempdir() + "/shbt-testserver"
-		os.makedirs(tempdir, exist_ok = True)
-		
-		# Delete old mesh file
-		if (ospath.exists(tempdir + "/segment.mesh")):
-			os.remove(tempdir + "/segment.mesh")
-		
 		context.window_manager.progress_begin(0.0, 1.0)
 		
-		# Write mesh if needed
+		# Bake mesh if needed
+		mesh = None
+		
 		if (params.get("sh_box_bake_mode", "Mesh") == "Mesh"):
 			bake_mesh.BAKE_UNSEEN_FACES = params.get("bake_menu_segment", False)
 			bake_mesh.ABMIENT_OCCLUSION_ENABLED = params.get("bake_vertex_light", True)
 			bake_mesh.LIGHTING_ENABLED = params.get("lighting_enabled", False)
-			bake_mesh.bakeMeshToFile(content, tempdir + "/segment.mesh", templates, bake_mesh.BakeProgressInfo(MB_progress_update_callback))
+			mesh = bytes(bake_mesh.bakeMesh(content, templates, bake_mesh.BakeProgressInfo(MB_progress_update_callback)))
 		
 		context.window_manager.progress_end()
 		
-		# Write XML
-		with open(tempdir + "/segment.xml", "w") as f:
-			f.write(content)
+		# Send it straight to the server, or write the files for a server that
+		# was started on its own if we don't have one
+		if (not server.pushSegment(content.encode("utf-8"), mesh)):
+			tempdir = tempfile.gettempdir() + "/shbt-testserver"
+			os.makedirs(tempdir, exist_ok = True)
+			
+			# Write or delete old mesh file
+			if (mesh != None):
+				pathlib.Path(tempdir + "/segment.mesh").write_bytes(mesh)
+			elif (ospath.exists(tempdir + "/segment.mesh")):
+				os.remove(tempdir + "/segment.mesh")
+			
+			# Write XML
+			with open(tempdir + "/segment.xml", "w") as f:
+				f.write(content)
 		
-		context.window.cursor_set('DEFAULT')
+		setCursor(context, 'DEFAULT')
 		
 		return {'FINISHED'}
 	
@@ -541,10 +827,7 @@ def sh_export_segment(filepath, context, *, compress = False, params = {}):
 	# Cook the mesh if we need to
 	if (params.get("sh_box_bake_mode", "Mesh") == "Mesh"):
 		# Find file name
-		meshfile = ospath.splitext(ospath.splitext(filepath)[0])[0]
-		if (compress):
-			meshfile = ospath.splitext(meshfile)[0]
-		meshfile += ".mesh.mp3"
+		meshfile = getMeshPath(filepath, compress)
 		
 		# Set properties
 		# (TODO: maybe this should be passed to the function instead of just setting global vars?)
@@ -567,6 +850,186 @@ def sh_export_segment(filepath, context, *, compress = False, params = {}):
 	
 	context.window_manager.progress_update(1.0)
 	context.window_manager.progress_end()
-	context.window.cursor_set('DEFAULT')
+	setCursor(context, 'DEFAULT')
 	
 	return {"FINISHED"}
+
+def getBatchSegments(context, use_collections = False):
+	"""
+	List the segments in the blend file as (scene, collection, segment name).
+	
+	Normally every scene is one segment. If use_collections is set then every
+	collection directly in the current scene is a segment named after it
+	instead.
+	"""
+	
+	if (use_collections):
+		scene = context.scene
+		return [(scene, c, c.name) for c in scene.collection.children]
+	else:
+		return [(s, None, s.sh_properties.sh_segment) for s in bpy.data.scenes]
+
+def sh_export_all_segments(context, *, use_collections = False, templates_path = None, workers = None, apk = None, push_to_server = False):
+	"""
+	Export every segment in the blend file to the open APK.
+	
+	The segment XML is made in this process since it needs Blender, but the
+	meshes are baked in parallel in a pool of worker processes. The templates
+	file is only parsed once and shared with every bake.
+	
+	The segments are exported to the given assets folder, or the open APK if
+	there is none. If push_to_server is set then they are also sent to the
+	quick test server, which serves a room that cycles through all of them.
+	
+	A segment that fails to export does not stop the others from being
+	exported. The error is printed and kept in its report entry.
+	
+	Returns a tuple of (report, total time) where the report has a dict with the
+	segment name, path (None if it could not be made), XML and mesh times and
+	error (None if it was exported) for each segment.
+	"""
+	
+	import time
+	import multiprocessing
+	from concurrent.futures import ProcessPoolExecutor
+	
+	start = time.perf_counter()
+	
+	if (not apk):
+		apk = util.find_apk()
+	
+	if (not apk):
+		raise FileNotFoundError("There is currently no APK open in APK Editor Studio. Please open a Smash Hit APK with a valid structure and try again.")
+	
+	templates = bake_mesh.parseTemplatesXml(templates_path) if templates_path else {}
+	
+	report = []
+	bakes = []
+	pushed = []
+	
+	# NOTE Blender can't be forked, so the workers need to be spawned
+	with ProcessPoolExecutor(max_workers = workers, mp_context = multiprocessing.get_context("spawn")) as pool:
+		for scene, collection, segment in getBatchSegments(context, use_collections):
+			props = scene.sh_properties
+			
+			# Skip scenes that are not set up to be exported
+			if (not props.sh_level or not props.sh_room or not segment):
+				print(f"Smash Hit Tools: Batch export: Skipping \"{scene.name}\" since it does not have a level, room or segment name.")
+				continue
+			
+			seg_start = time.perf_counter()
+			
+			entry = {"segment": props.sh_level + "/" + props.sh_room + "/" + segment, "path": None, "xml": 0.0, "mesh": 0.0, "error": None}
+			report.append(entry)
+			
+			try:
+				# This makes the folders for the segment, which can fail too
+				entry["path"] = getAutoExportPath(props, apk, segment)
+				
+				params = getExportParams(props)
+				params["sh_scene"] = scene
+				params["sh_collection"] = collection
+				
+				content = createSegmentText(context, params)
+				
+				with gzip.open(entry["path"], "wb") as f:
+					f.write(content.encode())
+			except Exception as e:
+				print(f"Smash Hit Tools: Batch export: Failed to export {entry['segment']}:")
+				traceback.print_exc()
+				entry["error"] = str(e)
+				continue
+			
+			entry["xml"] = time.perf_counter() - seg_start
+			
+			# The test server needs the templates solved since the game won't
+			# have them
+			if (push_to_server):
+				pushed.append((entry, solveTemplates(content, templates) if templates else content, params["sh_box_bake_mode"] == "Mesh"))
+			
+			# Queue the mesh bake
+			if (params["sh_box_bake_mode"] == "Mesh"):
+				options = {
+					"BAKE_UNSEEN_FACES": params["bake_menu_segment"],
+					"ABMIENT_OCCLUSION_ENABLED": params["bake_vertex_light"],
+					"LIGHTING_ENABLED": params["lighting_enabled"],
+				}
+				
+				bakes.append((entry, pool.submit(bake_mesh.bakeMeshJob, content, getMeshPath(entry["path"], True), templates, options)))
+		
+		# Wait for the bakes to finish
+		for entry, bake in bakes:
+			try:
+				entry["mesh"] = bake.result()
+			except Exception as e:
+				print(f"Smash Hit Tools: Batch export: Failed to bake the mesh for {entry['segment']}:")
+				traceback.print_exc()
+				entry["error"] = str(e)
+	
+	# Send everything to the test server at once
+	pushed = [p for p in pushed if not p[0]["error"]]
+	
+	if (pushed):
+		segments = [(entry["segment"], content.encode("utf-8"), pathlib.Path(getMeshPath(entry["path"], True)).read_bytes() if has_mesh else None) for entry, content, has_mesh in pushed]
+		
+		if (not server.pushSegments(segments)):
+			print("Smash Hit Tools: Batch export: The quick test server is not running, so the segments were not sent to it.")
+	
+	total = time.perf_counter() - start
+	
+	# Print timing report
+	for entry in report:
+		if (entry["error"]):
+			print(f"Smash Hit Tools: Batch export: {entry['segment']}: failed: {entry['error']}")
+		else:
+			print(f"Smash Hit Tools: Batch export: {entry['segment']}: xml {entry['xml']:.3f}s, mesh {entry['mesh']:.3f}s")
+	
+	failed = len([entry for entry in report if entry["error"]])
+	
+	print(f"Smash Hit Tools: Batch export: Exported {len(report) - failed} segments in {total:.3f}s" + (f", {failed} failed" if failed else ""))
+	
+	return (report, total)
+
+def exportHeadless(apk = None, templates_path = None, use_collections = False):
+	"""
+	Export all segments in the open blend file without using any of Blender's
+	UI, for example from a build script:
+	
+	blender -b level.blend --addons blender_tools --python-expr "import sys, segment_export; sys.exit(segment_export.exportHeadless('path/to/assets'))"
+	
+	This uses the same params as the export operators and prints the time taken
+	for each segment. Returns 0 if every segment was exported and 1 if any of
+	them failed, so the result can be used as the exit status.
+	"""
+	
+	if (not hasattr(bpy.types.Scene, "sh_properties")):
+		print("Smash Hit Tools: Headless export: The add-on is not enabled. Please run Blender with --addons blender_tools.")
+		return 1
+	
+	# Prefer the templates that come with the assets we export to
+	if (not templates_path and apk and ospath.exists(apk + "/templates.xml.mp3")):
+		templates_path = apk + "/templates.xml.mp3"
+	
+	try:
+		report, total = sh_export_all_segments(
+			bpy.context,
+			use_collections = use_collections,
+			templates_path = templates_path if templates_path else tryTemplatesPath(),
+			apk = apk,
+		)
+	except Exception as e:
+		print(f"Smash Hit Tools: Headless export failed: {e}")
+		traceback.print_exc()
+		return 1
+	
+	if (not report):
+		print("Smash Hit Tools: Headless export: There were no segments to export.")
+		return 1
+	
+	failed = [entry["segment"] for entry in report if entry["error"]]
+	
+	if (failed):
+		print(f"Smash Hit Tools: Headless export: {len(failed)} of {len(report)} segments failed: {', '.join(failed)}")
+		return 1
+	
+	return 0
@@ -5,7 +5,12 @@ Smash Hit Blender Tools segment import
 import common
 import xml.etree.ElementTree as et
 import bpy
+import mathutils
 import gzip
+import json
+import os
+import pathlib
+import re
 
 ## IMPORT
 ## The following things are related to the importer, which is not complete.
@@ -21,9 +26,100 @@ def removeEverythingEqualTo(array, value):
 		except ValueError:
 			return array
 
-def sh_add_box(pos, size):
+# Name of the mesh shared by every imported box
+UNIT_CUBE_MESH_NAME = "shbt-unit-cube"
+
+def getSharedMesh(name, verts, faces):
+	"""
+	Get the mesh with the given name, creating it from the verts and faces if
+	it does not exist yet
+	"""
+	
+	mesh = bpy.data.meshes.get(name)
+	
+	if (mesh == None):
+		mesh = bpy.data.meshes.new(name)
+		mesh.from_pydata(verts, [], faces)
+		mesh.update()
+	
+	return mesh
+
+# Corners and faces of a cube, with corners in the order -x to +x, -y to +y
+# then -z to +z
+CUBE_CORNERS = [(x, y, z) for x in (-1.0, 1.0) for y in (-1.0, 1.0) for z in (-1.0, 1.0)]
+CUBE_FACES = [(0, 1, 3, 2), (4, 6, 7, 5), (0, 4, 5, 1), (2, 3, 7, 6), (0, 2, 6, 4), (1, 5, 7, 3)]
+
+def getUnitCubeMesh():
+	"""
+	Get the unit cube mesh that imported boxes share. Boxes are sized by their
+	scale instead of their mesh.
+	"""
+	
+	verts = [(x * 0.5, y * 0.5, z * 0.5) for x, y, z in CUBE_CORNERS]
+	
+	return getSharedMesh(UNIT_CUBE_MESH_NAME, verts, CUBE_FACES)
+
+# Start of the names of the meshes shared by imported obstacles of the same
+# type and decals of the same tile
+OBSTACLE_MESH_PREFIX = "shbt-obstacle:"
+DECAL_MESH_PREFIX = "shbt-decal:"
+
+def getObstacleMesh(obstacle):
+	"""
+	Get the mesh shared by every imported obstacle of the given type. It starts
+	as a unit cube, and changing it changes how all of them look.
+	"""
+	
+	verts = [(x * 0.5, y * 0.5, z * 0.5) for x, y, z in CUBE_CORNERS]
+	
+	return getSharedMesh(OBSTACLE_MESH_PREFIX + obstacle, verts, CUBE_FACES)
+
+def getDecalMesh(tile):
+	"""
+	Get the mesh shared by every imported decal with the given tile, which is a
+	unit plane that faces the player like the decal does
+	"""
+	
+	verts = [(0.0, -0.5, -0.5), (0.0, 0.5, -0.5), (0.0, 0.5, 0.5), (0.0, -0.5, 0.5)]
+	
+	return getSharedMesh(DECAL_MESH_PREFIX + str(tile), verts, [(0, 1, 2, 3)])
+
+def sh_add_box(pos, size, name = "box", collection = None):
+	"""
+	Add a box to the scene (or the given collection) and return reference to it
+	
+	This makes the object directly with bpy.data instead of using an operator,
+	which avoids an undo push and depsgraph update for every box.
+	"""
+	
+	b = bpy.data.objects.new(name, getUnitCubeMesh())
+	
+	b.location = (pos[0], pos[1], pos[2])
+	b.scale = (size[0] * 2, size[1] * 2, size[2] * 2)
+	
+	(collection if collection else bpy.context.scene.collection).objects.link(b)
+	
+	return b
+
+def sh_add_shared(mesh, collection = None):
+	"""
+	Add an object that shows a shared mesh as a wireframe to the scene (or the
+	given collection) and return a reference to it. Obstacles and decals are
+	exported from their own sh_properties, so the mesh is only what they look
+	like.
+	"""
+	
+	o = bpy.data.objects.new(mesh.name, mesh)
+	o.display_type = "WIRE"
+	
+	(collection if collection else bpy.context.scene.collection).objects.link(o)
+	
+	return o
+
+def sh_add_box_op(pos, size):
 	"""
-	Add a box to the scene and return reference to it
+	Add a box to the scene using the cube operator and return reference to it.
+	This is the old way of adding boxes, it is only kept for benchmarking.
 	
 	See: https://blender.stackexchange.com/questions/2285/how-to-get-reference-to-objects-added-by-an-operator
 	"""
@@ -32,14 +128,15 @@ def sh_add_box(pos, size):
 	
 	return bpy.context.active_object
 
-def sh_add_empty():
+def sh_add_empty(collection = None):
 	"""
-	Add an empty object and return a reference to it
+	Add an empty object to the scene (or the given collection) and return a
+	reference to it
 	"""
 	
 	o = bpy.data.objects.new("empty", None)
 	
-	bpy.context.scene.collection.objects.link(o)
+	(collection if collection else bpy.context.scene.collection).objects.link(o)
 	
 	o.empty_display_size = 1
 	o.empty_display_type = "PLAIN_AXES"
@@ -111,24 +208,28 @@ def show_message(title = "Info", message = "", icon = "INFO"):
 	
 	bpy.context.window_manager.popup_menu(draw, title = title, icon = icon)
 	
-def sh_import_segment(fp, context, compressed = False):
+class ImportNotAllowed(Exception):
 	"""
-	Load a Smash Hit segment into blender
+	Raised when a segment's creator has asked for it to not be imported
 	"""
 	
-	root = None
-	
-	if (not compressed):
-		with open(fp, "r") as f:
-			root = f.read()
-	else:
-		with gzip.open(fp, "rb") as f:
-			root = f.read().decode()
+	pass
+
+def sh_parse_vector(s, default):
+	"""
+	Parse a position, rotation or size string, swapping axes from Smash Hit's
+	order to Blender's
+	"""
 	
-	root = et.fromstring(root)
+	v = s.split(" ") if s else default.split(" ")
 	
-	scene = context.scene.sh_properties
-	segattr = root.attrib
+	return (float(v[2]), float(v[0]), float(v[1]))
+
+def parseSegmentAttributes(segattr):
+	"""
+	Parse the attributes of the segment tag into a plain dict of the values for
+	the scene properties
+	"""
 	
 	# Check segment protection and enforce it
 	# 
@@ -136,211 +237,704 @@ def sh_import_segment(fp, context, compressed = False):
 	# segments, but it should stop someone from casually copying segments.
 	drm = segattr.get("drm", None)
 	
-	if (drm):
-		drm = drm.split(" ")
-		
-		for d in drm:
-			if (d == "NoImport"):
-				show_message("Import error", "The creator of this segment has requested that it not be imported. We encourage you to respect this request.")
-				return {"FINISHED"}
+	if (drm and "NoImport" in drm.split(" ")):
+		raise ImportNotAllowed("The creator of this segment has requested that it not be imported. We encourage you to respect this request.")
 	
-	# Segment length
 	seg_size = segattr.get("size", "12 10 0").split(" ")
-	scene.sh_len = (float(seg_size[0]), float(seg_size[1]), float(seg_size[2]))
+	lighting_ambient = segattr.get("ambient", None)
 	
-	# Segment template
-	scene.sh_template = segattr.get("template", "")
+	return {
+		"sh_len": (float(seg_size[0]), float(seg_size[1]), float(seg_size[2])),
+		"sh_template": segattr.get("template", ""),
+		"sh_softshadow": float(segattr.get("softshadow", "-0.0001")),
+		"sh_light_left": float(segattr.get("lightLeft", "1")),
+		"sh_light_right": float(segattr.get("lightRight", "1")),
+		"sh_light_top": float(segattr.get("lightTop", "1")),
+		"sh_light_bottom": float(segattr.get("lightBottom", "1")),
+		"sh_light_front": float(segattr.get("lightFront", "1")),
+		"sh_light_back": float(segattr.get("lightBack", "1")),
+		"sh_lighting": bool(lighting_ambient),
+		"sh_lighting_ambient": sh_parse_colour(lighting_ambient)[0] if lighting_ambient else None,
+	}
+
+def parseStoneHackDecal(properties):
+	"""
+	Get the decal of the box that a StoneHack obstacle was exported for, which
+	is only kept in the obstacle's param7 as "tile=<decal>". Returns None if
+	it is not a StoneHack obstacle or has no decal.
+	"""
 	
-	# Soft shadow
-	scene.sh_softshadow = float(segattr.get("softshadow", "-0.0001"))
+	if (properties.get("IMPORT_IGNORE") != "STONEHACK_IGNORE"):
+		return None
 	
-	# Lights
-	scene.sh_light_left = float(segattr.get("lightLeft", "1"))
-	scene.sh_light_right = float(segattr.get("lightRight", "1"))
-	scene.sh_light_top = float(segattr.get("lightTop", "1"))
-	scene.sh_light_bottom = float(segattr.get("lightBottom", "1"))
-	scene.sh_light_front = float(segattr.get("lightFront", "1"))
-	scene.sh_light_back = float(segattr.get("lightBack", "1"))
+	param = properties.get("param7", "")
 	
-	# ambient, if lighting is enabled
-	lighting_ambient = segattr.get("ambient", None)
+	if (not param.startswith("tile=")):
+		return None
 	
-	if (lighting_ambient):
-		scene.sh_lighting = True
-		scene.sh_lighting_ambient = sh_parse_colour(lighting_ambient)[0]
-	else:
-		scene.sh_lighting = False
+	try:
+		return int(param[5:])
+	except ValueError:
+		return None
+
+def parseElement(kind, properties):
+	"""
+	Parse the attributes of an element in a segment into a plain dict record
+	that has everything needed to create the object. Returns None if the
+	element should not be imported.
+	"""
+	
+	# Ignore obstacles exported with IMPORT_IGNORE="STONEHACK_IGNORE"
+	if (properties.get("IMPORT_IGNORE") == "STONEHACK_IGNORE" or properties.get("type") == "stone"):
+		return None
+	
+	record = {
+		"kind": kind,
+		"pos": sh_parse_vector(properties.get("pos"), "0 0 0"),
+		"rot": sh_parse_vector(properties.get("rot"), "0 0 0"),
+		"hidden": (properties.get("hidden", "0") == "1"),
+	}
 	
-	for obj in root:
-		kind = obj.tag
-		properties = obj.attrib
+	# Boxes
+	if (kind == "box"):
+		template = properties.get("template", "")
 		
-		# Ignore obstacles exported with IMPORT_IGNORE="STONEHACK_IGNORE"
-		if (properties.get("IMPORT_IGNORE") == "STONEHACK_IGNORE" or properties.get("type") == "stone"):
-			continue
+		record["size"] = sh_parse_vector(properties.get("size"), "0.5 0.5 0.5")
+		record["template"] = template
+		record["reflective"] = (properties.get("reflection", "0") == "1")
 		
-		# Object position
-		pos = properties.get("pos", "0 0 0").split(" ")
-		pos = (float(pos[2]), float(pos[0]), float(pos[1]))
+		# NOTE: Extra template logic is here because built-in box baking tools will only
+		# inherit visible from template when visible is not set at all, and since
+		# it is not possible to tell blender tools to explicitly inherit from
+		# a template we need to settle with less than ideal but probably the most
+		# intuitive behaviour in order to have box templates work: we do not
+		# include visible if there is a template and visible is not set.
+		record["visible"] = (properties.get("visible", "1") == "1" and not template)
 		
-		# Object rotation
-		rot = properties.get("rot", "0 0 0").split(" ")
-		rot = (float(rot[2]), float(rot[0]), float(rot[1]))
+		# NOTE: The older format colorX/Y/Z is no longer supported, should it be readded?
+		record["colour"] = sh_parse_colour(properties.get("color", "0.5 0.5 0.5"))
 		
-		# Boxes
-		if (kind == "box"):
-			# Size for boxes
-			size = properties.get("size", "0.5 0.5 0.5").split(" ")
-			size = (float(size[2]), float(size[0]), float(size[1]))
-			
-			# Add the box; zero size boxes are treated as points
-			b = None
-			if (size[0] <= 0.0 or size[1] <= 0.0 or size[2] <= 0.0):
-				b = sh_add_empty()
-				b.location = pos
-			else:
-				b = sh_add_box(pos, size)
-			
-			# Boxes can (and often do) have templates
-			b.sh_properties.sh_template = properties.get("template", "")
-			
-			# Reflective property
-			b.sh_properties.sh_reflective = (properties.get("reflection", "0") == "1")
-			
-			# visible, colour, tile for boxes
-			# NOTE: Tile size and rotation are not supported those are not imported yet
-			# NOTE: Extra template logic is here because built-in box baking tools will only
-			# inherit visible from template when visible is not set at all, and since
-			# it is not possible to tell blender tools to explicitly inherit from
-			# a template we need to settle with less than ideal but probably the most
-			# intuitive behaviour in order to have box templates work: we do not
-			# include visible if there is a template and visible is not set.
-			b.sh_properties.sh_visible = (properties.get("visible", "1") == "1" and not b.sh_properties.sh_template)
-			
-			# NOTE: The older format colorX/Y/Z is no longer supported, should it be readded?
-			colour = sh_parse_colour(properties.get("color", "0.5 0.5 0.5"))
-			
-			if (len(colour) == 1):
-				b.sh_properties.sh_tint = (colour[0][0], colour[0][1], colour[0][2], 1.0)
-			else:
-				b.sh_properties.sh_use_multitint = True
-				b.sh_properties.sh_tint1 = (colour[0][0], colour[0][1], colour[0][2], 1.0)
-				b.sh_properties.sh_tint2 = (colour[1][0], colour[1][1], colour[1][2], 1.0)
-				b.sh_properties.sh_tint3 = (colour[2][0], colour[2][1], colour[2][2], 1.0)
-			
-			# NOTE: The older format tileX/Y/Z is no longer supported, should it be readded?
-			tile = sh_parse_tile(properties.get("tile", "0"))
-			
-			if (len(tile) == 1):
-				b.sh_properties.sh_tile = tile[0]
-			else:
-				b.sh_properties.sh_use_multitile = True
-				b.sh_properties.sh_tile1 = tile[0]
-				b.sh_properties.sh_tile2 = tile[1]
-				b.sh_properties.sh_tile3 = tile[2]
-			
-			# Tile size
-			tileSize = sh_parse_tile_size(properties.get("tileSize", "1"))
-			tileSizeLen = len(tileSize)
-			
-			# Clever trick to parse the tile sizes; for 1 tilesize this applies
-			# to all sides, for 3 tilesize this applies each tilesize to their
-			# proper demension. (If there are two, they are assigned "X Y" -> X Y Y
-			# but that should never happen)
-			for i in range(3):
-				b.sh_properties.sh_tilesize[i] = tileSize[min(i, tileSizeLen - 1)]
-			
-			# TODO: I'm not adding sh_parse_tilerot for now...
-			tileRot = sh_parse_tile(properties.get("tileRot", "0"))
-			tileRotLen = len(tileRot)
-			
-			for i in range(3):
-				b.sh_properties.sh_tilerot[i] = tileRot[min(i, tileRotLen - 1)] % 4 # HACK: ... so I'm doing this :)
-			
-			# Glow for lighting
-			b.sh_properties.sh_glow = float(properties.get("glow", "0"))
-		
-		# Obstacles
-		elif (kind == "obstacle"):
-			# Create obstacle and set pos/rot
-			o = sh_add_empty()
-			o.location = pos
-			o.rotation_euler = rot
-			
-			# Set type and add the attributes
-			o.sh_properties.sh_type = "OBS"
-			o.sh_properties.sh_obstacle = properties.get("type", "")
-			o.sh_properties.sh_template = properties.get("template", "")
-			o.sh_properties.sh_mode = sh_import_modes(properties.get("mode", "55"))
-			o.sh_properties.sh_param0 = properties.get("param0", "")
-			o.sh_properties.sh_param1 = properties.get("param1", "")
-			o.sh_properties.sh_param2 = properties.get("param2", "")
-			o.sh_properties.sh_param3 = properties.get("param3", "")
-			o.sh_properties.sh_param4 = properties.get("param4", "")
-			o.sh_properties.sh_param5 = properties.get("param5", "")
-			o.sh_properties.sh_param6 = properties.get("param6", "")
-			o.sh_properties.sh_param7 = properties.get("param7", "")
-			o.sh_properties.sh_param8 = properties.get("param8", "")
-			o.sh_properties.sh_param9 = properties.get("param9", "")
-			o.sh_properties.sh_param10 = properties.get("param10", "")
-			o.sh_properties.sh_param11 = properties.get("param11", "")
-			if (properties.get("hidden", "0") == "1"): o.sh_properties.sh_hidden = True
-		
-		# Decals
-		elif (kind == "decal"):
-			# Create obstacle and set pos/rot
-			o = sh_add_empty()
-			o.location = pos
-			o.rotation_euler = rot
-			
-			# Set type and tile number
-			o.sh_properties.sh_type = "DEC"
-			o.sh_properties.sh_decal = int(properties.get("tile", "0"))
-			
-			# Set the colourisation of the decal
-			colour = properties.get("color", None)
-			if (colour):
-				o.sh_properties.sh_havetint = True
-				colour = colour.split(" ")
-				colour = (float(colour[0]), float(colour[1]), float(colour[2]), float(colour[3]) if len(colour) == 4 else 1.0)
-				o.sh_properties.sh_tint = colour
-			else:
-				o.sh_properties.sh_havetint = False
-			
-			# Blend mode
-			o.sh_properties.sh_blend = float(properties.get("blend", "1"))
-			
-			# Set the hidden flag
-			if (properties.get("hidden", "0") == "1"): o.sh_properties.sh_hidden = True
-			
-			# Size
-			o.sh_properties.sh_size = sh_parse_tile_size(properties.get("size", "1 1"))
-		
-		# Power-ups
-		elif (kind == "powerup"):
-			# Create obstacle and set pos
-			o = sh_add_empty()
-			o.location = pos
-			
-			# Set type and powerup kind
-			o.sh_properties.sh_type = "POW"
-			o.sh_properties.sh_powerup = properties.get("type", "ballfrenzy")
-			
-			# Set hidden
-			if (properties.get("hidden", "0") == "1"): o.sh_properties.sh_hidden = True
-		
-		# Water
-		elif (kind == "water"):
-			# Create obstacle and set pos
-			size = properties.get("size", "1 1").split(" ")
-			size = (float(size[1]), float(size[0]), 0.0)
+		# NOTE: The older format tileX/Y/Z is no longer supported, should it be readded?
+		record["tile"] = sh_parse_tile(properties.get("tile", "0"))
+		
+		# Clever trick to parse the tile sizes; for 1 tilesize this applies
+		# to all sides, for 3 tilesize this applies each tilesize to their
+		# proper demension. (If there are two, they are assigned "X Y" -> X Y Y
+		# but that should never happen)
+		tileSize = sh_parse_tile_size(properties.get("tileSize", "1"))
+		record["tilesize"] = [tileSize[min(i, len(tileSize) - 1)] for i in range(3)]
+		
+		# TODO: I'm not adding sh_parse_tilerot for now...
+		tileRot = sh_parse_tile(properties.get("tileRot", "0"))
+		record["tilerot"] = [tileRot[min(i, len(tileRot) - 1)] % 4 for i in range(3)] # HACK: ... so I'm doing this :)
+		
+		# Glow for lighting
+		record["glow"] = float(properties.get("glow", "0"))
+		
+		# Boxes don't have a decal in segments, it is only exported in their
+		# StoneHack obstacle, which parseSegmentFile copies here
+		record["decal"] = int(properties.get("decal", "1"))
+	
+	# Obstacles
+	elif (kind == "obstacle"):
+		record["type"] = properties.get("type", "")
+		record["template"] = properties.get("template", "")
+		record["mode"] = sh_import_modes(properties.get("mode", "55"))
+		record["params"] = [properties.get("param" + str(i), "") for i in range(12)]
+	
+	# Decals
+	elif (kind == "decal"):
+		record["tile"] = int(properties.get("tile", "0"))
+		
+		colour = properties.get("color", None)
+		
+		if (colour):
+			colour = colour.split(" ")
+			colour = (float(colour[0]), float(colour[1]), float(colour[2]), float(colour[3]) if len(colour) == 4 else 1.0)
+		
+		record["colour"] = colour
+		record["blend"] = float(properties.get("blend", "1"))
+		record["size"] = sh_parse_tile_size(properties.get("size", "1 1"))
+	
+	# Power-ups
+	elif (kind == "powerup"):
+		record["type"] = properties.get("type", "ballfrenzy")
+	
+	# Water
+	elif (kind == "water"):
+		size = properties.get("size", "1 1").split(" ")
+		record["size"] = (float(size[1]), float(size[0]), 0.0)
+	
+	# Unknown elements
+	else:
+		return None
+	
+	return record
+
+def parseSegmentFile(fp, compressed = False, keep_box_attributes = False):
+	"""
+	Parse a segment file into the scene properties and a list of element
+	records without creating anything in Blender.
+	
+	The file is streamed with iterparse (straight from the gzip stream for
+	compressed segments) and each element is thrown away once it has been
+	parsed, so the whole document is never in memory.
+	
+	If keep_box_attributes is set, box records also keep their original XML
+	attributes in "attrib", along with "decal" if the box had one.
+	"""
+	
+	segment = None
+	records = []
+	root = None
+	depth = 0
+	
+	# Position of the box that was just parsed, if the last element was a box
+	box_pos = None
+	
+	with (gzip.open(fp, "rb") if compressed else open(fp, "rb")) as f:
+		for event, elem in et.iterparse(f, events = ("start", "end")):
+			if (event == "start"):
+				depth += 1
+				
+				# Check the segment attributes as soon as possible so we don't
+				# parse segments that are not allowed to be imported
+				if (depth == 1):
+					root = elem
+					segment = parseSegmentAttributes(elem.attrib)
+				
+				continue
 			
-			o = sh_add_box(pos, size)
+			depth -= 1
 			
-			# Set the type
-			o.sh_properties.sh_type = "WAT"
+			if (depth == 1):
+				record = parseElement(elem.tag, elem.attrib)
+				
+				# The StoneHack obstacle for a box comes straight after it, at
+				# the same position
+				decal = parseStoneHackDecal(elem.attrib) if (elem.tag == "obstacle" and box_pos != None and elem.attrib.get("pos") == box_pos) else None
+				
+				if (decal != None):
+					records[-1]["decal"] = decal
+					
+					if (keep_box_attributes):
+						records[-1]["attrib"]["decal"] = str(decal)
+				
+				box_pos = elem.attrib.get("pos") if (record and record["kind"] == "box") else None
+				
+				if (record):
+					if (keep_box_attributes and record["kind"] == "box"):
+						record["attrib"] = dict(elem.attrib)
+					
+					records.append(record)
+				
+				root.remove(elem)
+	
+	return (segment, records)
+
+def sh_apply_segment(scene, segment):
+	"""
+	Set the scene properties from parsed segment attributes
+	"""
+	
+	scene.sh_len = segment["sh_len"]
+	scene.sh_template = segment["sh_template"]
+	scene.sh_softshadow = segment["sh_softshadow"]
+	scene.sh_light_left = segment["sh_light_left"]
+	scene.sh_light_right = segment["sh_light_right"]
+	scene.sh_light_top = segment["sh_light_top"]
+	scene.sh_light_bottom = segment["sh_light_bottom"]
+	scene.sh_light_front = segment["sh_light_front"]
+	scene.sh_light_back = segment["sh_light_back"]
+	
+	# ambient, if lighting is enabled
+	scene.sh_lighting = segment["sh_lighting"]
+	
+	if (segment["sh_lighting"]):
+		scene.sh_lighting_ambient = segment["sh_lighting_ambient"]
+
+def sh_create_object(record, collection = None, shared_meshes = False):
+	"""
+	Create the Blender object for an element record in the scene (or the given
+	collection) and return it
+	
+	If shared_meshes is set, obstacles and decals are objects that share one
+	mesh for each obstacle type or decal tile instead of empties. Each one is
+	still its own object with its own properties, but Blender only has to keep
+	one mesh for each type to draw them.
+	"""
+	
+	kind = record["kind"]
+	pos = record["pos"]
+	
+	# Boxes
+	if (kind == "box"):
+		size = record["size"]
+		
+		# Add the box; zero size boxes are treated as points
+		if (size[0] <= 0.0 or size[1] <= 0.0 or size[2] <= 0.0):
+			b = sh_add_empty(collection)
+			b.location = pos
+		else:
+			b = sh_add_box(pos, size, collection = collection)
+		
+		props = b.sh_properties
+		props.sh_template = record["template"]
+		props.sh_reflective = record["reflective"]
+		props.sh_visible = record["visible"]
+		
+		colour = record["colour"]
+		
+		if (len(colour) == 1):
+			props.sh_tint = (colour[0][0], colour[0][1], colour[0][2], 1.0)
+		else:
+			props.sh_use_multitint = True
+			props.sh_tint1 = (colour[0][0], colour[0][1], colour[0][2], 1.0)
+			props.sh_tint2 = (colour[1][0], colour[1][1], colour[1][2], 1.0)
+			props.sh_tint3 = (colour[2][0], colour[2][1], colour[2][2], 1.0)
+		
+		tile = record["tile"]
+		
+		if (len(tile) == 1):
+			props.sh_tile = tile[0]
+		else:
+			props.sh_use_multitile = True
+			props.sh_tile1 = tile[0]
+			props.sh_tile2 = tile[1]
+			props.sh_tile3 = tile[2]
+		
+		props.sh_tilesize = record["tilesize"]
+		props.sh_tilerot = record["tilerot"]
+		props.sh_glow = record["glow"]
+		props.sh_decal = record["decal"]
+		
+		return b
+	
+	# Obstacles
+	elif (kind == "obstacle"):
+		o = sh_add_shared(getObstacleMesh(record["type"]), collection) if shared_meshes else sh_add_empty(collection)
+		o.location = pos
+		o.rotation_euler = record["rot"]
+		
+		props = o.sh_properties
+		props.sh_type = "OBS"
+		props.sh_obstacle = record["type"]
+		props.sh_template = record["template"]
+		props.sh_mode = record["mode"]
+		
+		for i, param in enumerate(record["params"]):
+			setattr(props, "sh_param" + str(i), param)
+		
+		if (record["hidden"]): props.sh_hidden = True
+		
+		return o
+	
+	# Decals
+	elif (kind == "decal"):
+		o = sh_add_shared(getDecalMesh(record["tile"]), collection) if shared_meshes else sh_add_empty(collection)
+		o.location = pos
+		o.rotation_euler = record["rot"]
+		
+		props = o.sh_properties
+		props.sh_type = "DEC"
+		props.sh_decal = record["tile"]
+		
+		# Set the colourisation of the decal
+		if (record["colour"]):
+			props.sh_havetint = True
+			props.sh_tint = record["colour"]
+		else:
+			props.sh_havetint = False
+		
+		props.sh_blend = record["blend"]
+		
+		if (record["hidden"]): props.sh_hidden = True
+		
+		props.sh_size = record["size"]
+		
+		return o
+	
+	# Power-ups
+	elif (kind == "powerup"):
+		o = sh_add_empty(collection)
+		o.location = pos
+		
+		o.sh_properties.sh_type = "POW"
+		o.sh_properties.sh_powerup = record["type"]
+		
+		if (record["hidden"]): o.sh_properties.sh_hidden = True
+		
+		return o
+	
+	# Water
+	elif (kind == "water"):
+		o = sh_add_box(pos, record["size"], "water", collection)
+		
+		o.sh_properties.sh_type = "WAT"
+		
+		if (record["hidden"]): o.sh_properties.sh_hidden = True
+		
+		return o
+
+def buildProxyMesh(mesh, records):
+	"""
+	Fill a mesh with a cube for each of the box records in a box proxy,
+	replacing anything that was already in it. Boxes that have been realised
+	are None.
+	
+	Each face has the index of its box in the "shbt_box" attribute and the
+	colour of the box in the "shbt_colour" attribute, which are set with
+	foreach_set.
+	"""
+	
+	verts = []
+	faces = []
+	box_index = []
+	colours = []
+	
+	for i, record in enumerate(records):
+		# Already realised
+		if (record == None):
+			continue
+		
+		pos = record["pos"]
+		size = record["size"]
+		colour = record["colour"][0]
+		base = len(verts)
+		
+		for x, y, z in CUBE_CORNERS:
+			verts.append((pos[0] + x * size[0], pos[1] + y * size[1], pos[2] + z * size[2]))
+		
+		for face in CUBE_FACES:
+			faces.append((base + face[0], base + face[1], base + face[2], base + face[3]))
+		
+		box_index += [i] * 6
+		colours += (colour[0], colour[1], colour[2], 1.0) * 6
+	
+	mesh.clear_geometry()
+	
+	# from_pydata knows which polygon properties this version of Blender needs
+	# to have set
+	mesh.from_pydata(verts, [], faces)
+	
+	for name, kind, prop, values in (("shbt_box", "INT", "value", box_index), ("shbt_colour", "FLOAT_COLOR", "color", colours)):
+		attribute = mesh.attributes.get(name)
+		
+		if (attribute == None):
+			attribute = mesh.attributes.new(name, kind, "FACE")
+		
+		attribute.data.foreach_set(prop, values)
+	
+	mesh.update()
+
+def sh_add_box_proxy(records, collection = None):
+	"""
+	Add a single box proxy object for the given box records and return it.
+	
+	The proxy stores the original attributes of its boxes, so it is exported
+	like the boxes it stands in for without any of them being real objects.
+	"""
+	
+	boxes = [record["attrib"] for record in records]
+	
+	mesh = bpy.data.meshes.new("box proxy")
+	buildProxyMesh(mesh, records)
+	
+	o = bpy.data.objects.new("box proxy", mesh)
+	o[common.PROXY_BOXES_PROPERTY] = json.dumps(boxes)
+	
+	(collection if collection else bpy.context.scene.collection).objects.link(o)
+	
+	return o
+
+def transformProxyBox(record, matrix):
+	"""
+	Move and scale a box record from a box proxy by the proxy's world matrix,
+	so it is where it is shown. Boxes can't be rotated, so only the location
+	and scale of the proxy are used.
+	"""
+	
+	pos = matrix @ mathutils.Vector(record["pos"])
+	scale = matrix.to_scale()
+	
+	record["pos"] = (pos[0], pos[1], pos[2])
+	record["size"] = [record["size"][i] * abs(scale[i]) for i in range(3)]
+	
+	return record
+
+def sh_realise_proxy_boxes(proxy):
+	"""
+	Turn the boxes that have a face selected in a box proxy into real box
+	objects, and remove them from the proxy. Returns the new objects.
+	"""
+	
+	mode = proxy.mode
+	
+	# Selection is only written to the mesh when leaving edit mode
+	if (mode == "EDIT"):
+		bpy.ops.object.mode_set(mode = "OBJECT")
+	
+	mesh = proxy.data
+	count = len(mesh.polygons)
+	
+	selected = [False] * count
+	mesh.polygons.foreach_get("select", selected)
+	
+	box_index = [0] * count
+	mesh.attributes["shbt_box"].data.foreach_get("value", box_index)
+	
+	boxes = json.loads(proxy[common.PROXY_BOXES_PROPERTY])
+	realised = sorted(set(box_index[i] for i in range(count) if selected[i]))
+	objects = []
+	
+	if (realised):
+		records = [parseElement("box", attrib) if attrib != None else None for attrib in boxes]
+		
+		for i in realised:
+			objects.append(sh_create_object(transformProxyBox(records[i], proxy.matrix_world), collection = proxy.users_collection[0]))
 			
-			# Set hidden
-			if (properties.get("hidden", "0") == "1"): o.sh_properties.sh_hidden = True
+			# Keep the indexes of the other boxes the same
+			boxes[i] = None
+			records[i] = None
+		
+		proxy[common.PROXY_BOXES_PROPERTY] = json.dumps(boxes)
+		buildProxyMesh(mesh, records)
+	
+	# Go back to the mode the user was in
+	if (mode == "EDIT"):
+		bpy.ops.object.mode_set(mode = "EDIT")
+	
+	return objects
+
+def sh_import_segment(fp, context, compressed = False, proxy = False, shared_meshes = False):
+	"""
+	Load a Smash Hit segment into blender
+	
+	This first parses the whole file into plain records, then creates and
+	configures all of the Blender objects in one go.
+	
+	If proxy is set, all of the boxes are loaded into a single box proxy object
+	instead of being made into objects. They can be made into real objects
+	later with sh_realise_proxy_boxes. See sh_create_object for what
+	shared_meshes does.
+	"""
+	
+	import time
+	
+	start = time.perf_counter()
+	
+	try:
+		segment, records = parseSegmentFile(fp, compressed, proxy)
+	except ImportNotAllowed as e:
+		show_message("Import error", str(e))
+		return {"FINISHED"}
+	
+	parse_time = time.perf_counter() - start
+	
+	sh_apply_segment(context.scene.sh_properties, segment)
+	
+	count = len(records)
+	
+	if (proxy):
+		sh_add_box_proxy([record for record in records if record["kind"] == "box"])
+		records = [record for record in records if record["kind"] != "box"]
+	
+	for record in records:
+		sh_create_object(record, shared_meshes = shared_meshes)
+	
+	total = time.perf_counter() - start
+	
+	print(f"Smash Hit Tools: Imported {count} elements in {total:.3f}s ({count / max(total, 1e-9):.0f} elements/s, parse {parse_time:.3f}s)")
 	
 	return {"FINISHED"}
+
+# File name endings of segment files
+SEGMENT_FILE_ENDINGS = (".xml.mp3", ".xml.gz.mp3", ".xml", ".xml.gz")
+
+def isCompressedSegment(path):
+	"""
+	Check if a segment file is gzip compressed from its name
+	"""
+	
+	return path.endswith(".gz.mp3") or path.endswith(".gz")
+
+def findSegmentFile(base):
+	"""
+	Find the segment file for a segment path without an extension, trying each
+	of the segment file endings
+	"""
+	
+	for ending in SEGMENT_FILE_ENDINGS:
+		if (os.path.exists(base + ending)):
+			return base + ending
+	
+	return None
+
+def findRoomSegments(path):
+	"""
+	Find the segment files for a room.
+	
+	The path can be a room Lua file, in which case the segments named in its
+	confSegment calls are found in the assets folder it belongs to. Otherwise,
+	every segment file in the path's folder is used, in order of name.
+	"""
+	
+	# Room file
+	if (path.endswith(".lua") or path.endswith(".lua.mp3")):
+		# Rooms are at assets/rooms/<level>/<room>.lua.mp3
+		assets = pathlib.Path(path).parent.parent.parent
+		
+		with open(path, "r") as f:
+			names = re.findall(r"confSegment\(\s*\"([^\"]+)\"", f.read())
+		
+		result = []
+		
+		for name in names:
+			segment = findSegmentFile(str(assets / "segments" / name))
+			
+			if (segment and segment not in result):
+				result.append(segment)
+			elif (not segment):
+				print(f"Smash Hit Tools: Room import: Could not find segment \"{name}\".")
+		
+		return result
+	
+	# Folder of segments
+	folder = path if os.path.isdir(path) else os.path.dirname(path)
+	
+	return [os.path.join(folder, name) for name in sorted(os.listdir(folder)) if name.endswith(SEGMENT_FILE_ENDINGS)]
+
+def parseSegmentFileSafe(path):
+	"""
+	Parse a segment file for a room import, returning None for the segment if
+	it cannot be imported instead of raising an exception
+	"""
+	
+	try:
+		return parseSegmentFile(path, isCompressedSegment(path))
+	except ImportNotAllowed:
+		print(f"Smash Hit Tools: Room import: Skipping \"{path}\" since its creator has asked for it to not be imported.")
+	except Exception as e:
+		print(f"Smash Hit Tools: Room import: Failed to parse \"{path}\": {e}")
+	
+	return (None, [])
+
+def sh_import_room(path, context, workers = None):
+	"""
+	Import all segments in a room side by side
+	
+	The segments are parsed in a thread pool (parsing is plain python and is
+	mostly waiting on reading and decompressing the files), then the objects
+	for each segment are created in its own collection. Each segment is placed
+	after the one before it along the length of the room.
+	"""
+	
+	import time
+	from concurrent.futures import ThreadPoolExecutor
+	
+	start = time.perf_counter()
+	
+	paths = findRoomSegments(path)
+	
+	with ThreadPoolExecutor(max_workers = workers) as pool:
+		parsed = list(pool.map(parseSegmentFileSafe, paths))
+	
+	offset = 0.0
+	count = 0
+	
+	for segment_path, (segment, records) in zip(paths, parsed):
+		if (segment == None):
+			continue
+		
+		# Segment collection, named after the segment file
+		name = os.path.basename(segment_path)
+		name = name[:name.index(".")] if "." in name else name
+		
+		collection = bpy.data.collections.new(name)
+		context.scene.collection.children.link(collection)
+		
+		for record in records:
+			pos = record["pos"]
+			record["pos"] = (pos[0] + offset, pos[1], pos[2])
+			sh_create_object(record, collection)
+		
+		# Segments go towards -Z in Smash Hit, which is -X in Blender
+		offset -= segment["sh_len"][2]
+		count += 1
+	
+	total = time.perf_counter() - start
+	
+	print(f"Smash Hit Tools: Imported {count} segments from \"{path}\" in {total:.3f}s")
+	
+	return (count, total)
+
+def benchmarkSegmentParse(fp, compressed = False, repeat = 5):
+	"""
+	Time parsing a segment file for import and measure the peak memory it
+	takes. This needs to be run inside of Blender, for example:
+	
+	blender -b --python-expr "import segment_import; segment_import.benchmarkSegmentParse('path/to/segment.xml')"
+	
+	Memory is only measured if tracemalloc is not already tracing, so that
+	tracing someone else started is left alone.
+	"""
+	
+	import time
+	import tracemalloc
+	
+	start = time.perf_counter()
+	
+	for i in range(repeat):
+		segment, records = parseSegmentFile(fp, compressed)
+	
+	parse_time = (time.perf_counter() - start) / repeat
+	peak = None
+	
+	# Tracing slows down parsing, so it is done in a separate run
+	if (not tracemalloc.is_tracing()):
+		tracemalloc.start()
+		
+		try:
+			parseSegmentFile(fp, compressed)
+			peak = tracemalloc.get_traced_memory()[1]
+		finally:
+			tracemalloc.stop()
+	
+	print(f"Smash Hit Tools: Benchmark: {len(records)} elements parsed in {parse_time:.3f}s ({len(records) / max(parse_time, 1e-9):.0f} elements/s), peak memory " + (f"{peak / 1024:.0f} KiB" if peak != None else "not measured since tracemalloc is already tracing"))
+	
+	return (parse_time, peak)
+
+def benchmarkBoxImport(count = 3000):
+	"""
+	Compare adding boxes with the cube operator and with bpy.data. This needs
+	to be run inside of Blender, for example:
+	
+	blender -b --python-expr "import segment_import; segment_import.benchmarkBoxImport()"
+	"""
+	
+	import time
+	
+	results = {}
+	
+	for name, add in (("operator", sh_add_box_op), ("bpy.data", sh_add_box)):
+		start = time.perf_counter()
+		
+		boxes = [add(((i % 7) - 3.0, (i % 5) - 2.0, -(i * 0.1)), (0.5, 0.5, 0.5)) for i in range(count)]
+		
+		results[name] = time.perf_counter() - start
+		
+		# Clean up
+		meshes = set(b.data for b in boxes)
+		
+		for b in boxes:
+			bpy.data.objects.remove(b)
+		
+		# The shared unit cube is still used by any boxes that were imported
+		# before, so only remove meshes that nothing uses any more
+		for m in meshes:
+			if (m.users == 0):
+				bpy.data.meshes.remove(m)
+	
+	print(f"Smash Hit Tools: Benchmark: {count} boxes, operator {results['operator']:.3f}s, bpy.data {results['bpy.data']:.3f}s ({results['operator'] / results['bpy.data']:.1f}x)")
+	
+	return results
@@ -7,13 +7,25 @@ Notes:
    excludes the port. We have to fix that.
 """
 
-from http.server import BaseHTTPRequestHandler, HTTPServer
-from multiprocessing import Process
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import Process, Pipe
+import asyncio
+import http.client
+import io
+import signal
 import socket
+import sys
+import hashlib
+import gzip
+import time
+import email.utils
+import json
 import tempfile
+import threading
 import xml.etree.ElementTree as et
 import common
-from urllib.parse import parse_qs
+import bake_mesh
+from urllib.parse import parse_qs, quote
 import pathlib
 import os
 import os.path
@@ -24,6 +36,25 @@ CONTENT_LEVEL = """<level>
 
 TEMPDIR = tempfile.gettempdir() + "/shbt-testserver/"
 
+# Compress text responses with gzip for clients that accept it
+GZIP_ENABLED = True
+
+# Use the asyncio server instead of the threaded one
+ASYNC_SERVER = True
+
+# Close idle keep-alive connections after this many seconds
+IDLE_TIMEOUT = 30
+
+# How long to wait for requests in progress to finish when shutting down
+SHUTDOWN_TIMEOUT = 5
+
+# Requests that take longer than this many milliseconds are logged as slow
+SLOW_REQUEST_MS = 100
+
+# Upper bounds in milliseconds of the request latency histogram buckets, the
+# last bucket has everything slower than these
+LATENCY_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000]
+
 def parsePath(url):
 	"""
 	Parse the path into parameters and the real URL
@@ -40,34 +71,304 @@ def parsePath(url):
 	
 	return (url, params)
 
+class FileCache:
+	"""
+	Cache of file contents and values computed from them, which are thrown
+	away when the file's modification time or size changes. This is shared
+	between all of the request threads.
+	"""
+	
+	def __init__(self):
+		self.entries = {}
+		self.lock = threading.Lock()
+	
+	def get(self, path, compute = None, depends = ()):
+		"""
+		Get a file's bytes, or the result of compute(bytes) if compute is given.
+		depends are other files that compute reads, which may not exist, and
+		the result is also thrown away when one of them changes.
+		"""
+		
+		stat = os.stat(path)
+		key = (path, compute)
+		version = (stat.st_mtime_ns, stat.st_size, tuple(self.getVersion(p) for p in depends))
+		
+		with self.lock:
+			entry = self.entries.get(key, None)
+			
+			if (entry and entry[0] == version):
+				return entry[1]
+		
+		# Not cached or out of date, so load it outside of the lock
+		value = pathlib.Path(path).read_bytes()
+		
+		if (compute):
+			value = compute(value)
+		
+		with self.lock:
+			self.entries[key] = (version, value)
+		
+		return value
+	
+	def getVersion(self, path):
+		"""
+		Get the modification time and size of a file, or None if it does not
+		exist
+		"""
+		
+		try:
+			stat = os.stat(path)
+			return (stat.st_mtime_ns, stat.st_size)
+		except FileNotFoundError:
+			return None
+
+FILE_CACHE = FileCache()
+
+def getEndpoint(path, params):
+	"""
+	Get the name of the endpoint that a request is for, which is what request
+	stats are grouped by
+	"""
+	
+	for name in ["level", "room", "menu", "stats"]:
+		if (path.endswith(name)):
+			return name
+	
+	if (path.endswith("segment")):
+		return {".xml": "segment", ".mesh": "mesh"}.get(params.get("filetype", None), "other")
+	
+	return "other"
+
+class RequestStats:
+	"""
+	Request counts, bytes and latency histograms for each endpoint, which are
+	shared between all of the request threads
+	"""
+	
+	def __init__(self):
+		self.endpoints = {}
+		self.started = time.time()
+		self.lock = threading.Lock()
+	
+	def record(self, endpoint, code, size, saved, duration):
+		"""
+		Record a request that was answered, duration is in milliseconds
+		"""
+		
+		bucket = len(LATENCY_BUCKETS)
+		
+		for i, bound in enumerate(LATENCY_BUCKETS):
+			if (duration <= bound):
+				bucket = i
+				break
+		
+		with self.lock:
+			stats = self.endpoints.get(endpoint, None)
+			
+			if (not stats):
+				stats = {"count": 0, "errors": 0, "not_modified": 0, "bytes": 0, "bytes_saved": 0, "total_ms": 0.0, "max_ms": 0.0, "histogram": [0] * (len(LATENCY_BUCKETS) + 1)}
+				self.endpoints[endpoint] = stats
+			
+			stats["count"] += 1
+			stats["errors"] += 1 if code >= 400 else 0
+			stats["not_modified"] += 1 if code == 304 else 0
+			stats["bytes"] += size
+			stats["bytes_saved"] += saved
+			stats["total_ms"] += duration
+			stats["max_ms"] = max(stats["max_ms"], duration)
+			stats["histogram"][bucket] += 1
+	
+	def toDict(self):
+		"""
+		Get the stats in a form that can be written as JSON
+		"""
+		
+		result = {"uptime": time.time() - self.started, "slow_request_ms": SLOW_REQUEST_MS, "endpoints": {}}
+		labels = [f"<={b}ms" for b in LATENCY_BUCKETS] + [f">{LATENCY_BUCKETS[-1]}ms"]
+		
+		with self.lock:
+			for endpoint, stats in self.endpoints.items():
+				result["endpoints"][endpoint] = {
+					**{k: v for k, v in stats.items() if k != "histogram"},
+					"mean_ms": stats["total_ms"] / stats["count"],
+					"histogram": dict(zip(labels, stats["histogram"])),
+				}
+		
+		return result
+
+REQUEST_STATS = RequestStats()
+
 def loadFileBytes(path):
 	"""
 	Load a file's bytes.
 	"""
 	
-	return pathlib.Path(path).read_bytes()
+	return FILE_CACHE.get(path)
 
-def getSegmentOptions(path):
+def parseSegmentOptions(data):
 	"""
-	Get the segment fog colour, music, particles, reverb strings
+	Parse the segment fog colour, music, particles, reverb strings from the
+	segment's bytes
 	
 	TODO: This would break if there are spacing errors. Unlikely, but maybe fix that?
 	"""
 	
-	root = et.fromstring(loadFileBytes(path).decode("utf-8"))
+	root = et.fromstring(data.decode("utf-8"))
 	
 	fog = root.attrib.get("fogcolor", "0 0 0 1 1 1").replace(" ", ", ")
 	music = root.attrib.get("qt-music", None)
 	particles = root.attrib.get("qt-particles", None)
 	reverb = root.attrib.get("qt-reverb", "").replace(" ", ", ")
 	
-	return {"fog": fog, "music": music, "particles": particles, "reverb": reverb}
+	try:
+		length = float(root.attrib.get("size", "12 10 8").split()[2])
+	except (IndexError, ValueError):
+		length = 8.0
+	
+	return {"fog": fog, "music": music, "particles": particles, "reverb": reverb, "length": length}
+
+def makeEtag(data):
+	"""
+	Make a strong ETag for some bytes
+	"""
+	
+	return "\"" + hashlib.sha1(data).hexdigest()[:16] + "\""
+
+def getGzipEtag(etag):
+	"""
+	Get the ETag for the gzip compressed version of something, which needs to
+	be different from the uncompressed one since it is not the same bytes
+	"""
+	
+	return etag[:-1] + "-gz\""
+
+class Segment:
+	"""
+	A segment that the server can serve, with its mesh (None if it does not
+	have one) and the options for the room
+	"""
+	
+	def __init__(self, xml, mesh = None, modified = None):
+		self.xml = xml
+		self.mesh = mesh
+		self.options = parseSegmentOptions(xml)
+		self.xml_etag = makeEtag(xml)
+		self.mesh_etag = makeEtag(mesh) if mesh != None else None
+		self.modified = modified if modified else time.time()
+		self.xml_gzip = None
+	
+	def getGzipXml(self):
+		"""
+		Get the gzip compressed XML, compressing it the first time it's needed
+		"""
+		
+		if (self.xml_gzip == None):
+			self.xml_gzip = gzip.compress(self.xml)
+		
+		return self.xml_gzip
+
+class SegmentStore:
+	"""
+	The segments most recently pushed to the server by Blender Tools, which
+	are served straight from memory. This is either the one segment from a
+	test export or every segment from a batch export, by segment id.
+	"""
+	
+	def __init__(self):
+		self.segments = {}
+		self.version = 0
+		self.lock = threading.Lock()
+	
+	def update(self, segments):
+		"""
+		Replace the stored segments with a list of (id, xml, mesh) tuples
+		"""
+		
+		segments = {name: Segment(xml, mesh) for name, xml, mesh in segments}
+		
+		with self.lock:
+			self.segments = segments
+			self.version += 1
+			return self.version
+	
+	def get(self):
+		with self.lock:
+			return self.segments
+
+SEGMENT_STORE = SegmentStore()
+
+def loadSegmentFiles(xml):
+	"""
+	Make a segment from the files in TEMPDIR given the bytes of the XML file
+	"""
+	
+	mesh_path = TEMPDIR + "segment.mesh"
+	modified = os.stat(TEMPDIR + "segment.xml").st_mtime
+	mesh = None
+	
+	if (os.path.exists(mesh_path)):
+		mesh = pathlib.Path(mesh_path).read_bytes()
+		modified = max(modified, os.stat(mesh_path).st_mtime)
+	
+	return Segment(xml, mesh, modified)
+
+def getSegments():
+	"""
+	Get a dict of the segments to serve by id. These are the last ones that
+	were pushed to the server if there are any, or the one in TEMPDIR
+	otherwise.
+	"""
+	
+	segments = SEGMENT_STORE.get()
+	
+	if (segments):
+		return segments
+	
+	return {"segment": FILE_CACHE.get(TEMPDIR + "segment.xml", loadSegmentFiles, [TEMPDIR + "segment.mesh"])}
+
+def getSegment(name = None):
+	"""
+	Get the segment with the given id, or the first segment if no id is
+	given. Raises KeyError if there is no such segment.
+	"""
+	
+	segments = getSegments()
+	
+	if (name == None):
+		return next(iter(segments.values()))
+	
+	return segments[name]
+
+def receiveSegments(connection, on_stop = None):
+	"""
+	Receive segments pushed over the connection until it is closed or None is
+	sent, then call on_stop to shut down the server
+	"""
+	
+	while (True):
+		try:
+			segments = connection.recv()
+		except (EOFError, OSError):
+			segments = None
+		
+		if (segments == None):
+			if (on_stop):
+				on_stop()
+			
+			return
+		
+		version = SEGMENT_STORE.update(segments)
+		
+		print(f"SegServ: Got {len(segments)} segments, version {version} ({sum(len(s[1]) for s in segments)} bytes xml, {sum(len(s[2]) for s in segments if s[2])} bytes mesh)")
 
-def generateRoomText(hostname, options):
+def generateRoomText(hostname, segments):
 	"""
-	Generate the content for a room file
+	Generate the content for a room file that cycles through the given dict of
+	segments by id, in order. The room options come from the first segment.
 	"""
 	
+	options = next(iter(segments.values())).options
+	
 	music = options["music"]
 	particles = options["particles"]
 	reverb = options["reverb"]
@@ -75,19 +376,30 @@ def generateRoomText(hostname, options):
 	music = ("\"" + music + "\"") if music else "tostring(math.random(0, 28))"
 	particles = (f"\n\tmgParticles(\"{particles}\")") if particles else ""
 	reverb = (f"\n\tmgReverb({reverb})") if reverb else ""
-	length = 90
+	
+	# Long enough that every segment is used at least once
+	length = max(90, int(sum(s.options["length"] for s in segments.values())) + 1)
+	
+	urls = "".join(f"\n\t\t\"http://{hostname}:8000/segment?id={quote(name, safe = '')}&filetype=\"," for name in segments)
 	
 	room = f"""function init()
 	mgMusic({music})
 	mgFogColor({options["fog"]}){reverb}{particles}
 	
-	confSegment("http://{hostname}:8000/segment?filetype=", 1)
+	local segments = {{{urls}
+	}}
+	
+	for i = 1, #segments do
+		confSegment(segments[i], 1)
+	end
 	
 	l = 0
+	i = 0
 	
 	local targetLen = {length}
 	while l < targetLen do
-		s = nextSegment()
+		s = segments[i % #segments + 1]
+		i = i + 1
 		l = l + mgSegment(s, -l)
 	end
 	
@@ -99,75 +411,358 @@ end"""
 	
 	return bytes(room, "utf-8")
 
-def doError(self):
-	data = bytes("404 File Not Found", "utf-8")
-	self.send_response(404)
-	self.send_header("Content-Length", str(len(data)))
-	self.send_header("Content-Type", "text/plain")
-	self.end_headers()
-	self.wfile.write(data)
+def isNotModified(headers, etag, modified):
+	"""
+	Check if a conditional request can be answered with 304 Not Modified
+	"""
+	
+	# If-None-Match takes priority over If-Modified-Since
+	none_match = headers.get("If-None-Match", None)
+	
+	if (none_match):
+		return etag != None and (none_match.strip() == "*" or etag in [t.strip() for t in none_match.split(",")])
+	
+	modified_since = headers.get("If-Modified-Since", None)
+	
+	if (modified_since and modified):
+		try:
+			return int(modified) <= email.utils.parsedate_to_datetime(modified_since).timestamp()
+		except (TypeError, ValueError):
+			return False
+	
+	return False
+
+def getHost(headers):
+	"""
+	Get the host's name (that is us!) from the request headers
+	"""
+	
+	# Taking only the IP makes nonbugged clients (e.g. not SH) work.
+	return headers.get("Host", "localhost").split(":")[0]
+
+def getContent(path, params, host):
+	"""
+	Get the content for a request as a tuple of (data, content type, etag,
+	last modified time, gzipped data), or None if there is nothing at the path.
+	This is shared between both servers.
+	"""
+	
+	# Set data
+	data = b""
+	contenttype = "text/xml"
+	etag = None
+	modified = None
+	gzipped = None
+	
+	# Handle what data to return
+	try:
+		### LEVEL ###
+		if (path.endswith("level")):
+			data = bytes(CONTENT_LEVEL.format(host), "utf-8")
+		
+		### ROOM ###
+		elif (path.endswith("room")):
+			segments = getSegments()
+			data = generateRoomText(host, segments)
+			contenttype = "text/plain"
+			etag = makeEtag(bytes(host + "".join(name + s.xml_etag for name, s in segments.items()), "utf-8"))
+			modified = max(s.modified for s in segments.values())
+		
+		### SEGMENT ###
+		elif (path.endswith("segment") and (params["filetype"] == ".xml")):
+			segment = getSegment(params.get("id", None))
+			data = segment.xml
+			etag = segment.xml_etag
+			modified = segment.modified
+			gzipped = segment.getGzipXml() if GZIP_ENABLED else None
+		
+		### MESH ###
+		elif (path.endswith("segment") and (params["filetype"] == ".mesh")):
+			segment = getSegment(params.get("id", None))
+			
+			if (segment.mesh == None):
+				raise FileNotFoundError("Segment does not have a mesh")
+			
+			data = segment.mesh
+			contenttype = "application/octet-stream"
+			etag = segment.mesh_etag
+			modified = segment.modified
+		
+		### MENU UI ###
+		elif (path.endswith("menu")):
+			data = bytes(f'''<ui texture="menu/start.png" selected="menu/button_select.png"><rect coords="0 0 294 384" cmd="level.start level:http://{host}:8000/level?ignore="/></ui>''', "utf-8")
+		
+		### STATS ###
+		elif (path.endswith("stats")):
+			data = bytes(json.dumps(REQUEST_STATS.toDict(), indent = "\t"), "utf-8")
+			contenttype = "application/json"
+	except:
+		# Error on other files
+		return None
+	
+	return (data, contenttype, etag, modified, gzipped)
+
+def makeResponse(headers, content):
+	"""
+	Make the response to a request for the given content as a tuple of
+	(status code, headers, body, bytes saved). Conditional requests are
+	answered with 304 Not Modified if possible, and text is gzip compressed if
+	the client accepts it.
+	"""
+	
+	if (content == None):
+		data = bytes("404 File Not Found", "utf-8")
+		return (404, [("Content-Length", str(len(data))), ("Content-Type", "text/plain")], data, 0)
+	
+	data, contenttype, etag, modified, gzipped = content
+	
+	# Compression for text
+	use_gzip = GZIP_ENABLED and contenttype.startswith("text/") and "gzip" in headers.get("Accept-Encoding", "")
+	
+	if (use_gzip and etag):
+		etag = getGzipEtag(etag)
+	
+	# Conditional requests
+	if (isNotModified(headers, etag, modified)):
+		return (304, [("ETag", etag)] if etag else [], b"", len(data))
+	
+	body = data
+	result = []
+	
+	if (use_gzip):
+		body = gzipped if gzipped else gzip.compress(data)
+		result.append(("Content-Encoding", "gzip"))
+	
+	result.append(("Content-Length", str(len(body))))
+	result.append(("Content-Type", contenttype))
+	if (GZIP_ENABLED and contenttype.startswith("text/")): result.append(("Vary", "Accept-Encoding"))
+	if (etag): result.append(("ETag", etag))
+	if (modified): result.append(("Last-Modified", email.utils.formatdate(modified, usegmt = True)))
+	
+	return (200, result, body, len(data) - len(body))
+
+def logResponse(client, method, path, endpoint, code, size, saved, start_time):
+	"""
+	Log a request with the bytes that were sent and saved by caching and
+	compression, and record it in the request stats
+	"""
+	
+	duration = (time.perf_counter() - start_time) * 1000
+	
+	REQUEST_STATS.record(endpoint, code, size, saved, duration)
+	
+	print(client[0] + ":" + str(client[1]), method, path, code, f"{size} bytes" + (f" ({saved} saved)" if saved else "") + f" {duration:.1f}ms")
+	
+	if (duration > SLOW_REQUEST_MS):
+		print(f"SegServ: Slow request: {path} took {duration:.1f}ms (over {SLOW_REQUEST_MS}ms)")
 
 class AdServer(BaseHTTPRequestHandler):
 	"""
-	The request handler for the test server
+	The request handler for the threaded test server
 	"""
 	
+	# Keep connections alive between requests, the game fetches several
+	# things in a row
+	protocol_version = "HTTP/1.1"
+	
+	# Close idle connections after this many seconds
+	timeout = IDLE_TIMEOUT
+	
 	def log_request(self, code = '-', size = '-'):
 		pass
 	
 	def do_GET(self):
-		# Log the request
-		print(self.client_address[0] + ":" + str(self.client_address[1]), self.command, self.path)
-		
-		# Set data
-		data = b""
-		contenttype = "text/xml"
+		start_time = time.perf_counter()
 		
 		# Parsing parameters
 		path, params = parsePath(self.path)
 		
-		# Get the host's name (that is us!)
-		# Taking only the IP makes nonbugged clients (e.g. not SH) work.
-		host = self.headers["Host"].split(":")[0]
+		code, headers, body, saved = makeResponse(self.headers, getContent(path, params, getHost(self.headers)))
+		
+		# Send response
+		self.send_response(code)
+		
+		for name, value in headers:
+			self.send_header(name, value)
+		
+		self.end_headers()
+		self.wfile.write(body)
+		
+		logResponse(self.client_address, self.command, self.path, getEndpoint(path, params), code, len(body), saved, start_time)
+
+class AsyncServer:
+	"""
+	The test server using asyncio, which handles every connection on one
+	thread. Reading the segment files is done in a thread so it doesn't hold
+	up other connections.
+	"""
+	
+	def __init__(self, address = ("0.0.0.0", 8000)):
+		self.address = address
+		self.connections = {}
+		self.busy = set()
+		self.stopping = None
+		self.loop = None
+	
+	async def handleConnection(self, reader, writer):
+		"""
+		Answer requests on a connection until it is closed, times out or the
+		server is stopped
+		"""
+		
+		task = asyncio.current_task()
+		client = writer.get_extra_info("peername")[:2]
+		
+		self.connections[task] = writer
 		
-		# Handle what data to return
 		try:
-			### LEVEL ###
-			if (path.endswith("level")):
-				data = bytes(CONTENT_LEVEL.format(host), "utf-8")
-			
-			### ROOM ###
-			elif (path.endswith("room")):
-				data = generateRoomText(host, getSegmentOptions(TEMPDIR + "segment.xml"))
-				contenttype = "text/plain"
-			
-			### SEGMENT ###
-			elif (path.endswith("segment") and (params["filetype"] == ".xml")):
-				data = loadFileBytes(TEMPDIR + "segment.xml")
+			while (not self.stopping.is_set()):
+				# Wait for the next request
+				try:
+					head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), IDLE_TIMEOUT)
+				except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+					break
+				
+				# Busy until the response is sent
+				self.busy.add(task)
+				
+				if (not await self.handleRequest(client, head, reader, writer)):
+					break
+				
+				self.busy.discard(task)
+		except ConnectionError:
+			pass
+		finally:
+			self.busy.discard(task)
+			del self.connections[task]
+			writer.close()
+	
+	async def handleRequest(self, client, head, reader, writer):
+		"""
+		Answer one request, returning True if the connection can be kept open
+		"""
+		
+		start_time = time.perf_counter()
+		
+		request_line, _, header_data = head.partition(b"\r\n")
+		
+		try:
+			method, target, version = request_line.decode("latin-1").split()
+		except ValueError:
+			await self.sendResponse(writer, 400, [("Content-Length", "0"), ("Connection", "close")], b"")
+			return False
+		
+		try:
+			headers = http.client.parse_headers(io.BytesIO(header_data))
+			length = int(headers.get("Content-Length", "0") or "0")
 			
-			### MESH ###
-			elif (path.endswith("segment") and (params["filetype"] == ".mesh")):
-				data = loadFileBytes(TEMPDIR + "segment.mesh")
-				contenttype = "application/octet-stream"
+			if (length < 0):
+				raise ValueError("Negative Content-Length")
+		except (ValueError, http.client.HTTPException):
+			await self.sendResponse(writer, 400, [("Content-Length", "0"), ("Connection", "close")], b"")
+			return False
+		
+		# Skip any body so it isn't read as the next request, the client might
+		# go away before sending all of it
+		if (length):
+			try:
+				await reader.readexactly(length)
+			except asyncio.IncompleteReadError:
+				return False
+		
+		# Work out if the client wants to keep the connection open
+		connection = headers.get("Connection", "").lower()
+		keep_alive = (connection != "close") if version == "HTTP/1.1" else (connection == "keep-alive")
+		
+		if (method != "GET"):
+			await self.sendResponse(writer, 501, [("Content-Length", "0"), ("Connection", "close")], b"")
+			return False
+		
+		path, params = parsePath(target)
+		endpoint = getEndpoint(path, params)
+		host = getHost(headers)
+		
+		# Segments that weren't pushed to the server are read from files
+		if (endpoint in ["room", "segment", "mesh"] and not SEGMENT_STORE.get()):
+			content = await self.loop.run_in_executor(None, getContent, path, params, host)
+		else:
+			content = getContent(path, params, host)
+		
+		code, response_headers, body, saved = makeResponse(headers, content)
+		
+		if (not keep_alive):
+			response_headers.append(("Connection", "close"))
+		
+		await self.sendResponse(writer, code, response_headers, body)
+		
+		logResponse(client, method, target, endpoint, code, len(body), saved, start_time)
+		
+		return keep_alive
+	
+	async def sendResponse(self, writer, code, headers, body):
+		"""
+		Write a response and wait for it to be sent
+		"""
+		
+		head = f"HTTP/1.1 {code} {http.client.responses.get(code, '')}\r\nServer: SegServ\r\nDate: {email.utils.formatdate(usegmt = True)}\r\n"
+		head += "".join(f"{name}: {value}\r\n" for name, value in headers)
+		
+		writer.write(bytes(head + "\r\n", "latin-1") + body)
+		await writer.drain()
+	
+	def stop(self):
+		"""
+		Stop the server, this can be called from any thread
+		"""
+		
+		self.loop.call_soon_threadsafe(self.stopping.set)
+	
+	async def serve(self, connection = None):
+		"""
+		Serve until stopped, receiving pushed segments over connection if given
+		"""
+		
+		self.loop = asyncio.get_running_loop()
+		self.stopping = asyncio.Event()
+		
+		server = await asyncio.start_server(self.handleConnection, self.address[0], self.address[1])
+		
+		if (connection):
+			threading.Thread(target = receiveSegments, args = (connection, self.stop), daemon = True).start()
+		
+		# Signals are not supported on all platforms
+		for sig in [signal.SIGINT, signal.SIGTERM]:
+			try:
+				self.loop.add_signal_handler(sig, self.stopping.set)
+			except (NotImplementedError, RuntimeError, ValueError):
+				pass
+		
+		await self.stopping.wait()
+		
+		print("SegServ: Shutting down...")
+		
+		# Stop taking new connections, close idle connections then give the
+		# ones in the middle of a request a bit of time to finish
+		server.close()
+		
+		for task, writer in list(self.connections.items()):
+			if (task not in self.busy):
+				writer.close()
+		
+		if (self.connections):
+			done, pending = await asyncio.wait(list(self.connections), timeout = SHUTDOWN_TIMEOUT)
 			
-			### MENU UI ###
-			elif (path.endswith("menu")):
-				data = bytes(f'''<ui texture="menu/start.png" selected="menu/button_select.png"><rect coords="0 0 294 384" cmd="level.start level:http://{host}:8000/level?ignore="/></ui>''', "utf-8")
-		except:
-			# Error on other files
-			doError(self)
-			return
+			for task in pending:
+				self.connections[task].transport.abort()
 		
-		# Send response
-		self.send_response(200)
-		self.send_header("Content-Length", str(len(data)))
-		self.send_header("Content-Type", contenttype)
-		self.end_headers()
-		self.wfile.write(data)
+		await server.wait_closed()
+
+TEST_SEGMENT = '<segment size="12 10 16"><box pos="0 -1 -1" size="0.5 0.5 0.5" visible="1" color="0.3 0.6 0.9" tile="63"/></segment>'
 
 def makeTestFiles():
 	"""
-	Create test files
+	Create test files. The mesh is baked in this process, and the segment is
+	put in the file cache so the first request doesn't have to load it again.
 	"""
 	
 	print("SegServ: Creating test files...")
@@ -176,42 +771,164 @@ def makeTestFiles():
 	os.makedirs(TEMPDIR, exist_ok = True)
 	
 	# Make test segment
-	pathlib.Path(TEMPDIR + "segment.xml").write_text('<segment size="12 10 16"><box pos="0 -1 -1" size="0.5 0.5 0.5" visible="1" color="0.3 0.6 0.9" tile="63"/></segment>')
+	pathlib.Path(TEMPDIR + "segment.xml").write_text(TEST_SEGMENT)
 	
 	# Cook mesh for it
-	r = os.system(f"python3 ./bake_mesh.py {TEMPDIR + 'segment.xml'} {TEMPDIR + 'segment.mesh'}")
+	pathlib.Path(TEMPDIR + "segment.mesh").write_bytes(bake_mesh.bakeMesh(TEST_SEGMENT))
 	
-	# windows
-	if (r):
-		os.system(f"py ./bake_mesh.py {TEMPDIR + 'segment.xml'} {TEMPDIR + 'segment.mesh'}")
+	FILE_CACHE.get(TEMPDIR + "segment.xml", loadSegmentFiles)
 
-def runServer(no_blender = False):
+def checkTestMesh():
 	"""
-	Run the server
+	Check that the mesh served for the test segment is the same as the one
+	baked by running bake_mesh.py, returning 0 if it is and 1 otherwise.
+	
+	python3 server.py --check
 	"""
 	
-	server = HTTPServer(("0.0.0.0", 8000), AdServer)
+	import subprocess
 	
-	if (no_blender):
-		makeTestFiles()
+	makeTestFiles()
+	
+	served = getSegment().mesh
+	
+	cli_path = TEMPDIR + "segment-cli.mesh"
+	subprocess.run([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "bake_mesh.py"), TEMPDIR + "segment.xml", cli_path], check = True)
+	expected = pathlib.Path(cli_path).read_bytes()
+	os.remove(cli_path)
+	
+	if (served != expected):
+		print(f"SegServ: Check failed: the served mesh ({len(served)} bytes) is different from the bake_mesh.py mesh ({len(expected)} bytes)")
+		return 1
+	
+	print(f"SegServ: Check passed: the served mesh is the same as the bake_mesh.py mesh ({len(served)} bytes)")
+	return 0
+
+def runThreadedServer(connection = None):
+	"""
+	Run the threaded server, receiving pushed segments over connection if given
+	"""
+	
+	server = ThreadingHTTPServer(("0.0.0.0", 8000), AdServer)
 	
-	print("** SegServ v1.0 - Smash Hit Quick Test Server **")
+	if (connection):
+		threading.Thread(target = receiveSegments, args = (connection, server.shutdown), daemon = True).start()
 	
 	try:
 		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
 	except Exception as e:
 		print("SegServ has crashed!!\n", e)
 	
 	server.server_close()
 
+def runServer(no_blender = False, connection = None, use_async = None, sender = None):
+	"""
+	Run the server, receiving pushed segments over connection if given. This
+	uses the asyncio server unless use_async is False, or ASYNC_SERVER is
+	False if it is not given.
+	
+	sender is the other end of connection's pipe if this process has a copy of
+	it, like when it was forked. It is closed so that the pipe closes when the
+	process that pushes segments closes its end or exits.
+	"""
+	
+	if (sender):
+		sender.close()
+	
+	if (use_async == None):
+		use_async = ASYNC_SERVER
+	
+	if (no_blender):
+		makeTestFiles()
+	
+	print("** SegServ v1.0 - Smash Hit Quick Test Server **" + ("" if use_async else " (threaded)"))
+	
+	if (not use_async):
+		runThreadedServer(connection)
+		return
+	
+	try:
+		asyncio.run(AsyncServer().serve(connection))
+	except KeyboardInterrupt:
+		pass
+	except Exception as e:
+		print("SegServ has crashed!!\n", e)
+
+# Connection used to push segments to the server process, if it was started
+# from this process
+g_push_connection = None
+
 def runServerProcess():
 	"""
 	Run the server in a different process
 	"""
 	
-	p = Process(target = runServer, args = ())
+	global g_push_connection
+	
+	receiver, g_push_connection = Pipe(duplex = False)
+	
+	p = Process(target = runServer, args = (False, receiver, None, g_push_connection))
 	p.start()
+	
+	# Only the server process reads from the pipe
+	receiver.close()
+	
 	return p
 
+def stopServerProcess(process):
+	"""
+	Shut down the server process started by runServerProcess, letting requests
+	that are in progress finish. The process is terminated if it does not stop
+	in time.
+	"""
+	
+	global g_push_connection
+	
+	if (g_push_connection):
+		try:
+			g_push_connection.send(None)
+		except OSError:
+			pass
+		
+		g_push_connection.close()
+		g_push_connection = None
+	
+	process.join(SHUTDOWN_TIMEOUT + 1)
+	
+	if (process.is_alive()):
+		process.terminate()
+
+def pushSegments(segments):
+	"""
+	Send a list of (id, xml, mesh) tuples with each segment's XML and mesh
+	bytes straight to the server process started by runServerProcess. These
+	replace any segments that were sent before, and the room cycles through
+	them in order. Returns False if there is no server process to send them to.
+	"""
+	
+	if (not g_push_connection):
+		return False
+	
+	try:
+		g_push_connection.send(list(segments))
+	except OSError:
+		return False
+	
+	return True
+
+def pushSegment(xml, mesh = None):
+	"""
+	Send a single segment's XML and mesh bytes to the server process. Returns
+	False if there is no server process to send it to, in which case the files
+	should be written to TEMPDIR instead.
+	"""
+	
+	return pushSegments([("segment", xml, mesh)])
+
 if (__name__ == "__main__"):
-	runServer(no_blender = True)
+	if ("--check" in sys.argv):
+		sys.exit(checkTestMesh())
+	
+	runServer(no_blender = True, use_async = "--threaded" not in sys.argv)
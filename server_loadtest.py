@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+Load test for the quick test server
+
+Usage: server_loadtest.py [host] [requests] [threads] [--keep-alive]
+       server_loadtest.py compare [requests] [threads]
+
+This requests the same things the game does when loading a test segment from
+many threads at once, then prints the requests per second and latency.
+
+compare starts the asyncio and threaded servers one after the other and runs
+the load test against each of them, both with a new connection for every
+request and with keep-alive connections.
+"""
+
+import sys
+import os
+import time
+import socket
+import threading
+import subprocess
+import http.client
+import urllib.request
+
+PATHS = [
+	"/level?ignore=",
+	"/room?ignore=",
+	"/segment?filetype=.xml",
+	"/segment?filetype=.mesh",
+]
+
+def runWorker(host, count, latencies, errors, keep_alive = False):
+	"""
+	Make count requests, adding the latency of each to latencies
+	"""
+	
+	connection = http.client.HTTPConnection(host, 8000) if keep_alive else None
+	
+	for i in range(count):
+		path = PATHS[i % len(PATHS)]
+		start = time.perf_counter()
+		
+		try:
+			if (keep_alive):
+				connection.request("GET", path)
+				connection.getresponse().read()
+			else:
+				with urllib.request.urlopen(f"http://{host}:8000{path}") as r:
+					r.read()
+		except Exception:
+			errors.append(path)
+			
+			if (keep_alive):
+				connection.close()
+			
+			continue
+		
+		latencies.append(time.perf_counter() - start)
+	
+	if (keep_alive):
+		connection.close()
+
+def percentile(values, p):
+	"""
+	Get the p-th percentile of a sorted list
+	"""
+	
+	return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+def main(host = "127.0.0.1", requests = 2000, threads = 8, keep_alive = False):
+	latencies = []
+	errors = []
+	
+	workers = [threading.Thread(target = runWorker, args = (host, requests // threads, latencies, errors, keep_alive)) for _ in range(threads)]
+	
+	start = time.perf_counter()
+	
+	for w in workers:
+		w.start()
+	
+	for w in workers:
+		w.join()
+	
+	total = time.perf_counter() - start
+	
+	latencies.sort()
+	
+	if (not latencies):
+		print("All requests failed! Is the server running?")
+		return 1
+	
+	print(f"{len(latencies)} requests in {total:.3f}s with {threads} threads{' (keep-alive)' if keep_alive else ''} ({len(errors)} errors)")
+	print(f"{len(latencies) / total:.1f} requests/s")
+	print(f"latency: p50 {percentile(latencies, 50) * 1000:.2f}ms, p99 {percentile(latencies, 99) * 1000:.2f}ms, max {latencies[-1] * 1000:.2f}ms")
+	
+	return 0
+
+def waitForServer(timeout = 10):
+	"""
+	Wait until something is listening on the test server's port
+	"""
+	
+	end = time.time() + timeout
+	
+	while (time.time() < end):
+		try:
+			socket.create_connection(("127.0.0.1", 8000), 0.5).close()
+			return True
+		except OSError:
+			time.sleep(0.1)
+	
+	return False
+
+def compare(requests = 2000, threads = 32):
+	"""
+	Run the load test against both server implementations
+	"""
+	
+	folder = os.path.dirname(os.path.abspath(__file__))
+	
+	for name, args in [("asyncio", []), ("threaded", ["--threaded"])]:
+		process = subprocess.Popen([sys.executable, "server.py"] + args, cwd = folder, stdout = subprocess.DEVNULL)
+		
+		try:
+			if (not waitForServer()):
+				print(f"The {name} server did not start!")
+				return 1
+			
+			for keep_alive in [False, True]:
+				print(f"** {name} server **")
+				main("127.0.0.1", requests, threads, keep_alive)
+		finally:
+			process.terminate()
+			process.wait()
+	
+	return 0
+
+if (__name__ == "__main__"):
+	args = [a for a in sys.argv[1:] if not a.startswith("--")]
+	
+	if (args and args[0] == "compare"):
+		sys.exit(compare(
+			int(args[1]) if len(args) >= 2 else 2000,
+			int(args[2]) if len(args) >= 3 else 32,
+		))
+	
+	sys.exit(main(
+		args[0] if len(args) >= 1 else "127.0.0.1",
+		int(args[1]) if len(args) >= 2 else 2000,
+		int(args[2]) if len(args) >= 3 else 8,
+		"--keep-alive" in sys.argv,
+	))
@@ -7,7 +7,18 @@ import bpy, functools
 import requests
 import json
 import rsa
+import os
+import time
+import shutil
+import hashlib
+import threading
+import urllib.parse
+import ntpath
+import posixpath
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 PublicKey = rsa.PublicKey
 
 from hashlib import sha3_384
@@ -19,24 +30,502 @@ TOOLS_HOME_FOLDER = common.TOOLS_HOME_FOLDER
 LEGACY_UPDATE_MESSAGES = True
 BLENDER_TOOLS_PATH = common.BLENDER_TOOLS_PATH
 
+# Size of the chunks that downloads are written and hashed in
+DOWNLOAD_CHUNK_SIZE = 1 << 16
+
+# Seconds to wait for the server to connect or send more data
+DOWNLOAD_TIMEOUT = 30
+
+# How many times to resume a download after the connection drops
+DOWNLOAD_RETRIES = 5
+
+# How many connections to keep open to each host, which is also how many
+# components are downloaded at once
+HTTP_POOL_SIZE = 8
+
+# How many times to retry requests that fail to connect or get a server error.
+# Reads are not retried, since download_file resumes those itself and the
+# update check should give up on a slow server.
+HTTP_RETRIES = 3
+
+# Where changed files are put until all of them have been downloaded and
+# checked, inside the add-on's folder so they can be moved into place atomically
+UPDATE_STAGING_FOLDER = ".update-staging"
+
+# Where the files that a delta update replaces or deletes are kept until it is
+# done, and the journal that says how to put them back if it isn't
+UPDATE_BACKUP_FOLDER = ".update-backup"
+UPDATE_JOURNAL = ".update-journal.json"
+
+# The manifest of the release that was last installed by a delta update, which
+# says which files belong to the release and can be deleted when the next one
+# no longer has them
+UPDATE_MANIFEST = ".update-manifest.json"
+
+# Seconds to wait for the update info before giving up on checking this time
+UPDATE_CHECK_TIMEOUT = 5
+
+# Where the update info is kept between startups, and for how many seconds it
+# is used before it is downloaded again
+UPDATE_CACHE_PATH = TOOLS_HOME_FOLDER + "/update-cache.json"
+UPDATE_CACHE_TTL = 6 * 60 * 60
+
+g_session = None
+g_session_pid = None
+g_session_lock = threading.Lock()
+
+def get_session():
+	"""
+	Get the requests session that all of the updater's requests go through, so
+	that connections to the same host are kept open and reused
+	"""
+	
+	global g_session, g_session_pid
+	
+	with g_session_lock:
+		# Connections can't be shared with a process we were forked from
+		if (g_session == None or g_session_pid != os.getpid()):
+			retries = Retry(total = HTTP_RETRIES, read = 0, backoff_factor = 0.5, status_forcelist = (500, 502, 503, 504), allowed_methods = ("GET",))
+			adapter = HTTPAdapter(pool_connections = HTTP_POOL_SIZE, pool_maxsize = HTTP_POOL_SIZE, max_retries = retries)
+			
+			g_session = requests.Session()
+			g_session.mount("http://", adapter)
+			g_session.mount("https://", adapter)
+			g_session_pid = os.getpid()
+		
+		return g_session
+
 class Update():
 	"""
 	Class representing an update
 	"""
 	
-	def __init__(self, release_channel, version, download):
+	def __init__(self, release_channel, version, download, manifest = None):
 		self.release_channel = release_channel
 		self.version = version
 		self.download = download
+		self.manifest = manifest
 
-def download_json(source):
+def download_json(source, timeout = DOWNLOAD_TIMEOUT):
 	"""
 	Download JSON file
 	"""
 	
-	return json.loads(requests.get(source).content)
+	return json.loads(get_session().get(source, timeout = timeout).content)
+
+def get_update_info():
+	"""
+	Get the update info, from the cache if it was downloaded less than
+	UPDATE_CACHE_TTL seconds ago so that most startups don't need the network
+	"""
+	
+	try:
+		cache = json.loads(Path(UPDATE_CACHE_PATH).read_text())
+		
+		if (cache["source"] == UPDATE_INFO and 0 <= time.time() - cache["checked"] < UPDATE_CACHE_TTL):
+			return cache["info"]
+	except (OSError, ValueError, KeyError, TypeError):
+		pass
+	
+	info = download_json(UPDATE_INFO, UPDATE_CHECK_TIMEOUT)
+	
+	try:
+		Path(UPDATE_CACHE_PATH + ".tmp").write_text(json.dumps({"source": UPDATE_INFO, "checked": time.time(), "info": info}))
+		os.replace(UPDATE_CACHE_PATH + ".tmp", UPDATE_CACHE_PATH)
+	except OSError as e:
+		print(f"Smash Hit Tools: Could not cache update info: {e}")
+	
+	return info
+
+def print_progress(name):
+	"""
+	Make a download progress callback that prints every 10%
+	"""
+	
+	last = [-1]
+	
+	def progress(done, total):
+		if (total and done * 10 // total != last[0]):
+			last[0] = done * 10 // total
+			print(f"Smash Hit Tools: Downloading {name}: {done * 100 // total}% ({done} of {total} bytes)")
+	
+	return progress
+
+def download_file(url, path, progress = None, hash_function = None):
+	"""
+	Download a file to path in chunks, without keeping all of it in memory.
+	
+	The data goes to path + ".part" first. If that already exists then the
+	download carries on from where it stopped using a HTTP Range request, and
+	if the connection drops it is resumed up to DOWNLOAD_RETRIES times.
+	
+	progress(done, total) is called after each chunk. If hash_function is given
+	(like hashlib.sha256) then the file is hashed as it is downloaded, so it
+	never needs to be read again.
+	
+	Returns a tuple of (size, hasher or None).
+	"""
+	
+	part = path + ".part"
+	hasher = hash_function() if hash_function else None
+	done = 0
+	
+	# Carry on from a partial download, which needs to be hashed first
+	if (os.path.exists(part)):
+		with open(part, "rb") as f:
+			for block in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b""):
+				if (hasher): hasher.update(block)
+				done += len(block)
+	
+	failures = 0
+	
+	while (True):
+		try:
+			with get_session().get(url, headers = {"Range": f"bytes={done}-"} if done else {}, stream = True, timeout = DOWNLOAD_TIMEOUT) as response:
+				# Range not satisfiable, the part is either all of the file or
+				# is not from this file at all
+				if (response.status_code == 416):
+					if (response.headers.get("Content-Range", "").endswith(f"/{done}")):
+						break
+					
+					os.remove(part)
+					hasher = hash_function() if hash_function else None
+					done = 0
+					continue
+				
+				response.raise_for_status()
+				
+				# The server might not support Range and send all of it
+				if (done and response.status_code != 206):
+					hasher = hash_function() if hash_function else None
+					done = 0
+				
+				if (response.status_code == 206):
+					total = response.headers.get("Content-Range", "/*").split("/")[-1]
+					total = int(total) if total.isdigit() else None
+				else:
+					total = int(response.headers["Content-Length"]) if "Content-Length" in response.headers else None
+				
+				with open(part, "ab" if done else "wb") as f:
+					for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+						f.write(chunk)
+						if (hasher): hasher.update(chunk)
+						done += len(chunk)
+						
+						if (progress):
+							progress(done, total)
+				
+				if (total == None or done >= total):
+					break
+				
+				raise requests.exceptions.ConnectionError(f"Connection closed after {done} of {total} bytes")
+		except requests.exceptions.RequestException as e:
+			failures += 1
+			
+			# Only retry things that might work next time, and not errors
+			# like 404 that will happen again
+			server_error = isinstance(e, requests.exceptions.HTTPError) and e.response != None and e.response.status_code >= 500
+			retryable = server_error or isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.ChunkedEncodingError, requests.exceptions.RetryError))
+			
+			if (not retryable or failures > DOWNLOAD_RETRIES):
+				raise
+			
+			print(f"Smash Hit Tools: Download of {url} interrupted at {done} bytes, resuming: {e}")
+	
+	os.replace(part, path)
+	
+	return (done, hasher)
+
+def verify_hash(digest, signature, public):
+	"""
+	Check that an RSA signature is for a file with the given digest, which
+	needs to have been made with the hash function the signature uses (see
+	rsa.pkcs1.find_signature_hash). This is the same as rsa.verify, except that
+	the file can be hashed in pieces as it is downloaded.
+	
+	Raises rsa.VerificationError if it does not match, otherwise returns the
+	name of the hash method.
+	"""
+	
+	keylength = rsa.common.byte_size(public.n)
+	
+	if (len(signature) != keylength):
+		raise rsa.VerificationError("Verification failed")
+	
+	clearsig = rsa.transform.int2bytes(rsa.core.decrypt_int(rsa.transform.bytes2int(signature), public.e, public.n), keylength)
+	method = rsa.pkcs1._find_method_hash(clearsig)
+	
+	if (rsa.pkcs1._pad_for_signing(rsa.pkcs1.HASH_ASN1[method] + digest, keylength) != clearsig):
+		raise rsa.VerificationError("Verification failed")
+	
+	return method
+
+def verify_file(path, signature, public):
+	"""
+	Check the signature of a file that is already on disk, reading it in fixed
+	size blocks instead of all at once.
+	"""
+	
+	method = rsa.pkcs1.find_signature_hash(signature, public)
+	hasher = rsa.pkcs1.HASH_METHODS[method]()
+	
+	# rsa.verify can take a file too, but reads it 1 KiB at a time
+	with open(path, "rb") as f:
+		for block in rsa.pkcs1.yield_fixedblocks(f, DOWNLOAD_CHUNK_SIZE):
+			hasher.update(block)
+	
+	return verify_hash(hasher.digest(), signature, public)
+
+def hash_file(path):
+	"""
+	Get the SHA-256 of a file as hex, reading it in chunks
+	"""
+	
+	hasher = hashlib.sha256()
+	
+	with open(path, "rb") as f:
+		for block in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b""):
+			hasher.update(block)
+	
+	return hasher.hexdigest()
+
+def list_files(folder):
+	"""
+	List the files that are part of a release, as paths relative to folder
+	"""
+	
+	files = []
+	
+	for root, dirs, names in os.walk(folder):
+		dirs[:] = sorted(d for d in dirs if not d.startswith(".") and d != "__pycache__")
+		
+		for name in sorted(names):
+			if (not name.startswith(".") and not name.endswith(".pyc")):
+				files.append(os.path.relpath(os.path.join(root, name), folder).replace(os.sep, "/"))
+	
+	return files
+
+def make_manifest(folder, version, base = ""):
+	"""
+	Make the manifest for a release in folder. The files are expected to be at
+	base + path, relative to where the manifest is. The manifest needs to be
+	signed like the release ZIP is, with the signature at manifest URL + ".sig",
+	and its URL goes in the "manifest" field of the release channel in the
+	update info.
+	"""
+	
+	return {
+		"version": version,
+		"base": base,
+		"files": {path: {"size": os.path.getsize(os.path.join(folder, path)), "sha256": hash_file(os.path.join(folder, path))} for path in list_files(folder)},
+	}
+
+def find_changed_files(manifest, folder):
+	"""
+	Find the files in the manifest that are missing or different in folder
+	"""
+	
+	changed = []
+	
+	for path, info in manifest["files"].items():
+		local = os.path.join(folder, path)
+		
+		if (not os.path.isfile(local) or os.path.getsize(local) != info["size"] or hash_file(local) != info["sha256"]):
+			changed.append(path)
+	
+	return changed
+
+def is_release_path(path):
+	"""
+	Check that a path from a manifest stays inside the add-on's folder. Windows
+	paths are checked on every platform, since manifests are the same on all of
+	them.
+	"""
+	
+	if (not path or os.path.isabs(path) or ntpath.isabs(path) or os.path.splitdrive(path)[0] or ntpath.splitdrive(path)[0]):
+		return False
+	
+	first = posixpath.normpath(path.replace("\\", "/")).split("/")[0]
+	
+	return first not in (".", "..", UPDATE_STAGING_FOLDER, UPDATE_BACKUP_FOLDER, UPDATE_JOURNAL, UPDATE_MANIFEST)
+
+def load_installed_manifest(folder = BLENDER_TOOLS_PATH):
+	"""
+	Load the manifest that the last delta update installed, or None if there
+	wasn't one
+	"""
+	
+	try:
+		with open(os.path.join(folder, UPDATE_MANIFEST), "r") as f:
+			return json.load(f)
+	except (OSError, ValueError):
+		return None
+
+def rollback_delta_update(folder = BLENDER_TOOLS_PATH):
+	"""
+	Undo a delta update that did not finish, using its journal. Each replaced or
+	deleted file that was backed up is put back and each added file is deleted,
+	so the folder is the old release again. This is safe to run more than once,
+	and does nothing if there is no journal. Returns True if there was one.
+	"""
+	
+	journal = os.path.join(folder, UPDATE_JOURNAL)
+	backup = os.path.join(folder, UPDATE_BACKUP_FOLDER)
+	
+	if (not os.path.isfile(journal)):
+		return False
+	
+	with open(journal, "r") as f:
+		entries = json.load(f)
+	
+	for path in entries["paths"]:
+		dest = os.path.join(folder, path)
+		saved = os.path.join(backup, path)
+		
+		if (os.path.isfile(saved)):
+			os.replace(saved, dest)
+		elif (path in entries["added"] and os.path.isfile(dest)):
+			os.remove(dest)
+	
+	os.remove(journal)
+	shutil.rmtree(backup, ignore_errors = True)
+	shutil.rmtree(os.path.join(folder, UPDATE_STAGING_FOLDER), ignore_errors = True)
+	
+	return True
 
-def download_update(source):
+def apply_delta_update(url, public, folder = BLENDER_TOOLS_PATH):
+	"""
+	Update the files in folder to the release described by the manifest at url,
+	downloading only the files that changed. Files that were in the installed
+	release's manifest but are not in the new one are deleted, and any other
+	files in folder are left alone.
+	
+	The manifest's signature is checked first, then every changed file is
+	downloaded to the staging folder and checked against its size and hash in
+	the manifest. Nothing in folder is touched until all of them are there.
+	Staged files are kept if this fails, so the next try only downloads the
+	files that are missing and resumes the ones that were part way done.
+	
+	Then a journal is written, and each file that is replaced or deleted is
+	moved to the backup folder before the new one is moved into place, along
+	with the new manifest. If that fails, or Blender is closed before it is
+	done, rollback_delta_update puts the old files back, so the folder is never
+	left with a mix of releases. The journal is deleted once every file is in
+	place, which is the point where the update has happened.
+	
+	Returns a tuple of (bytes downloaded, size of the release, changed paths,
+	removed paths).
+	"""
+	
+	# Finish undoing an update that was stopped part way
+	rollback_delta_update(folder)
+	
+	data = get_session().get(url, timeout = DOWNLOAD_TIMEOUT).content
+	signature = get_session().get(url + ".sig", timeout = DOWNLOAD_TIMEOUT).content
+	rsa.verify(data, signature, public)
+	
+	manifest = json.loads(data)
+	base = urllib.parse.urljoin(url, manifest.get("base", ""))
+	
+	# The paths must stay inside the add-on's folder
+	for path in manifest["files"]:
+		if (not is_release_path(path)):
+			raise rsa.VerificationError(f"Bad path in update manifest: {path}")
+	
+	changed = find_changed_files(manifest, folder)
+	staging = os.path.join(folder, UPDATE_STAGING_FOLDER)
+	backup = os.path.join(folder, UPDATE_BACKUP_FOLDER)
+	
+	# Only files that the installed release had are removed, so files that
+	# were added by the user are kept
+	installed = load_installed_manifest(folder)
+	removed = []
+	
+	if (installed != None):
+		removed = [path for path in installed["files"] if path not in manifest["files"] and is_release_path(path) and os.path.isfile(os.path.join(folder, path))]
+	
+	# Without a journal, a backup folder is left over from an update that did
+	# finish
+	shutil.rmtree(backup, ignore_errors = True)
+	
+	def download(path):
+		info = manifest["files"][path]
+		dest = os.path.join(staging, path)
+		
+		# Already downloaded by an earlier try
+		if (os.path.isfile(dest) and os.path.getsize(dest) == info["size"] and hash_file(dest) == info["sha256"]):
+			return 0
+		
+		os.makedirs(os.path.dirname(dest), exist_ok = True)
+		
+		# download_file carries on from this much of an earlier try
+		resumed = os.path.getsize(dest + ".part") if os.path.isfile(dest + ".part") else 0
+		
+		size, hasher = download_file(base + urllib.parse.quote(path), dest, None, hashlib.sha256)
+		
+		if (size != info["size"] or hasher.hexdigest() != info["sha256"]):
+			os.remove(dest)
+			raise rsa.VerificationError(f"Downloaded {path} does not match the update manifest")
+		
+		return size - resumed
+	
+	with ThreadPoolExecutor(max_workers = HTTP_POOL_SIZE) as executor:
+		downloaded = sum(executor.map(download, changed))
+	
+	if (not changed and not removed and installed == manifest):
+		shutil.rmtree(staging, ignore_errors = True)
+		return (downloaded, sum(info["size"] for info in manifest["files"].values()), changed, removed)
+	
+	# The new manifest is installed with the files
+	os.makedirs(staging, exist_ok = True)
+	
+	with open(os.path.join(staging, UPDATE_MANIFEST), "wb") as f:
+		f.write(data)
+	
+	paths = changed + removed + [UPDATE_MANIFEST]
+	
+	# Write the journal before anything in folder changes, and make sure it is
+	# on disk first
+	journal = os.path.join(folder, UPDATE_JOURNAL)
+	
+	with open(journal + ".new", "w") as f:
+		json.dump({"version": manifest.get("version", None), "paths": paths, "added": [path for path in paths if not os.path.lexists(os.path.join(folder, path))]}, f)
+		f.flush()
+		os.fsync(f.fileno())
+	
+	os.replace(journal + ".new", journal)
+	
+	try:
+		for path in paths:
+			dest = os.path.join(folder, path)
+			
+			if (os.path.lexists(dest)):
+				os.makedirs(os.path.dirname(os.path.join(backup, path)), exist_ok = True)
+				os.replace(dest, os.path.join(backup, path))
+			
+			if (path not in removed):
+				os.makedirs(os.path.dirname(dest), exist_ok = True)
+				os.replace(os.path.join(staging, path), dest)
+	except:
+		rollback_delta_update(folder)
+		raise
+	
+	# Every file is in place, so the update is done
+	os.remove(journal)
+	shutil.rmtree(backup, ignore_errors = True)
+	shutil.rmtree(staging, ignore_errors = True)
+	
+	# Remove folders that only had old files in them
+	for path in removed:
+		parent = os.path.dirname(path)
+		
+		while (parent and not os.listdir(os.path.join(folder, parent))):
+			os.rmdir(os.path.join(folder, parent))
+			parent = os.path.dirname(parent)
+	
+	return (downloaded, sum(info["size"] for info in manifest["files"].values()), changed, removed)
+
+def download_update(source, manifest = None):
 	"""
 	Download an update
 	
@@ -44,49 +533,77 @@ def download_update(source):
 	the hood (and until that is implemented)
 	
 	ALSO WE DON'T EVER EVER EVER EVER ENABLE THIS BY DEFAULT
+	
+	If the release has a manifest then only the files that changed are
+	downloaded, and the whole ZIP is only used if that fails.
 	"""
 	
-	def update_downloader(url):
+	def update_downloader(url, manifest):
 		import shutil, pathlib, os
 		
-		# Download data and signature
-		data = requests.get(url).content
-		signature = requests.get(url + ".sig").content
+		# Get the local file path
+		path = TOOLS_HOME_FOLDER + "/" + url.split("/")[-1].replace("/", "").replace("\\", "")
 		
 		# Load the public key
 		public = eval(Path(BLENDER_TOOLS_PATH + "/shbt-public.key").read_text())
 		
+		# Only download what changed, if we can
+		if (manifest):
+			try:
+				start = time.time()
+				downloaded, total, changed, removed = apply_delta_update(manifest, public)
+				print(f"Smash Hit Tools: Updated {len(changed)} changed files and removed {len(removed)} old files in {time.time() - start:.1f}s, downloaded {downloaded} of {total} bytes ({100 - downloaded * 100 // max(total, 1)}% saved).")
+				os._exit(0)
+			except Exception as e:
+				print(f"Smash Hit Tools: Could not update only the changed files, downloading the whole update instead: {e}")
+		
+		# Get the signature first so we know what to hash the update with, then
+		# download the data straight to the file while hashing it
+		try:
+			signature = get_session().get(url + ".sig", timeout = DOWNLOAD_TIMEOUT).content
+			method = rsa.pkcs1.find_signature_hash(signature, public)
+			size, hasher = download_file(url, path, print_progress("update"), rsa.pkcs1.HASH_METHODS[method])
+		except Exception as e:
+			print(f"Smash Hit Tools: Failed to download update: {e}")
+			os._exit(0)
+		
 		# Verify the signature
 		try:
-			result = rsa.verify(data, signature, public)
+			verify_hash(hasher.digest(), signature, public)
 		except:
+			print(f"Smash Hit Tools: Update signature does not match, not installing it.")
+			os.remove(path)
 			os._exit(0)
 		
-		# Get the local file path
-		path = TOOLS_HOME_FOLDER + "/" + url.split("/")[-1].replace("/", "").replace("\\", "")
-		
-		# Write the data
-		pathlib.Path(path).write_bytes(data)
-		
-		print("Smash Hit Tools: Downloaded latest update to " + path + ", preparing to extract.")
+		print(f"Smash Hit Tools: Downloaded latest update to {path} ({size} bytes, {method} {hasher.hexdigest()}), preparing to extract.")
 		
 		# Extract the files (installs update)
 		shutil.unpack_archive(path, BLENDER_TOOLS_PATH, "zip")
 		
 		os._exit(0)
 	
-	p = Process(target = update_downloader, args = (source,))
+	p = Process(target = update_downloader, args = (source, manifest))
 	
 	p.start()
 
 def download_component(source):
 	"""
-	Download a component of Blender Tools
+	Download a component of Blender Tools, returning where it was saved
 	"""
 	
-	import pathlib
+	path = TOOLS_HOME_FOLDER + "/" + source.split("/")[-1]
+	
+	download_file(source, path)
+	
+	return path
+
+def download_components(sources):
+	"""
+	Download several components at once over the pooled connections
+	"""
 	
-	pathlib.Path(TOOLS_HOME_FOLDER + "/" + source.split("/")[-1]).write_bytes(requests.get(source).content)
+	with ThreadPoolExecutor(max_workers = HTTP_POOL_SIZE) as executor:
+		return list(executor.map(download_component, sources))
 
 def show_message(title = "Info", message = "", icon = "INFO"):
 	"""
@@ -134,7 +651,7 @@ def get_latest_version(current_version, release_channel):
 	"""
 	
 	try:
-		info = download_json(UPDATE_INFO).get(release_channel, None)
+		info = get_update_info().get(release_channel, None)
 		
 		# No info on release channel
 		if (info == None):
@@ -157,7 +674,7 @@ def get_latest_version(current_version, release_channel):
 			return None
 		
 		# Create the update object, if we need to use it
-		update = Update(release_channel, new_version, info["download"])
+		update = Update(release_channel, new_version, info["download"], info.get("manifest", None))
 		
 		return update
 	
@@ -166,21 +683,57 @@ def get_latest_version(current_version, release_channel):
 		
 		return None
 
+def start_update_check(current_version, release_channel, callback):
+	"""
+	Look for a new version on a background thread so that Blender does not have
+	to wait for the network. callback(update) is called from a timer on the
+	main thread once it is done, or with None if it took longer than
+	UPDATE_CHECK_TIMEOUT seconds.
+	
+	Returns the timer function, which returns None once it has finished.
+	"""
+	
+	result = []
+	deadline = time.time() + UPDATE_CHECK_TIMEOUT
+	thread = threading.Thread(target = lambda: result.append(get_latest_version(current_version, release_channel)), daemon = True)
+	
+	def poll():
+		if (not result and time.time() < deadline):
+			return 0.1
+		
+		if (not result):
+			print(f"Smash Hit Tools: Update check took longer than {UPDATE_CHECK_TIMEOUT} seconds, skipping it this time.")
+		
+		callback(result[0] if result else None)
+		
+		return None
+	
+	thread.start()
+	bpy.app.timers.register(poll, first_interval = 0.1)
+	
+	return poll
+
 def check_for_updates(current_version):
 	"""
-	Display a popup if there is an update.
+	Display a popup if there is an update. This returns straight away, the
+	check itself is done in the background.
 	"""
 	
 	if (not bpy.context.preferences.addons["blender_tools"].preferences.enable_update_notifier):
 		return
 	
-	update = get_latest_version(current_version, bpy.context.preferences.addons["blender_tools"].preferences.updater_channel)
+	start_update_check(current_version, bpy.context.preferences.addons["blender_tools"].preferences.updater_channel, show_update)
+
+def show_update(update):
+	"""
+	Tell the user about an update, installing it if they want that
+	"""
 	
 	if (update != None):
 		message = f"Smash Hit Tools v{update.version[0]}.{update.version[1]}.{update.version[2]} (for {update.release_channel} branch) has been released! Download the ZIP file here: {update.download}"
 		
 		if (bpy.context.preferences.addons["blender_tools"].preferences.enable_auto_update):
-			download_update(update.download)
+			download_update(update.download, update.manifest)
 			message = f"Smash Hit Tools update to v{update.version[0]}.{update.version[1]}.{update.version[2]} (for {update.release_channel} branch) has been installed. Please restart Blender to see changes!"
 		
 		print("Smash Hit Tools: " + message)
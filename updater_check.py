@@ -0,0 +1,539 @@
+#!/usr/bin/env python3
+"""
+Checks for the updater's update checks and downloads against a local stand-in
+for the update server, so nothing is downloaded from the internet.
+
+Usage: blender -b --python updater_check.py
+
+The updater needs bpy, so this has to be run with Blender's Python. It prints
+the result of each check and exits with 1 if any of them failed, then compares
+the time and memory taken to verify a 100 MiB update in different ways.
+"""
+
+import sys
+import os
+import time
+import hashlib
+import tempfile
+import threading
+import tracemalloc
+import json
+import shutil
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import updater
+import rsa
+import requests
+
+class StandInHandler(BaseHTTPRequestHandler):
+	"""
+	Serves the files in server.files from memory, with support for Range
+	requests. If server.drop_after is set then the connection is closed after
+	sending that many bytes of the next response, like a dropped connection,
+	and server.delay makes it wait that many seconds before each response.
+	server.connections counts the connections made to it.
+	"""
+	
+	protocol_version = "HTTP/1.1"
+	
+	def setup(self):
+		with self.server.lock:
+			self.server.connections += 1
+		
+		super().setup()
+	
+	def log_message(self, format, *args):
+		pass
+	
+	def do_GET(self):
+		time.sleep(self.server.delay)
+		
+		self.server.requests.append((self.path, self.headers.get("Range", None)))
+		
+		data = self.server.files.get(self.path, None)
+		
+		if (data == None):
+			self.send_response(404)
+			self.send_header("Content-Length", "0")
+			self.end_headers()
+			return
+		
+		start = 0
+		byte_range = self.headers.get("Range", None)
+		
+		if (byte_range and self.server.ranges):
+			start = int(byte_range.split("=")[1].split("-")[0])
+			
+			if (start >= len(data)):
+				self.send_response(416)
+				self.send_header("Content-Range", f"bytes */{len(data)}")
+				self.send_header("Content-Length", "0")
+				self.end_headers()
+				return
+			
+			self.send_response(206)
+			self.send_header("Content-Range", f"bytes {start}-{len(data) - 1}/{len(data)}")
+		else:
+			self.send_response(200)
+		
+		body = memoryview(data)[start:]
+		
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		
+		# Drop the connection part of the way through
+		if (self.server.drop_after):
+			self.wfile.write(body[:self.server.drop_after])
+			self.wfile.flush()
+			self.server.drop_after = None
+			self.close_connection = True
+			return
+		
+		self.wfile.write(body)
+
+def startStandIn(files):
+	"""
+	Start the stand-in server on a free port, returning it and its base URL
+	"""
+	
+	server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+	server.files = files
+	server.ranges = True
+	server.drop_after = None
+	server.delay = 0
+	server.requests = []
+	server.connections = 0
+	server.lock = threading.Lock()
+	
+	# Clients that gave up waiting are expected
+	server.handle_error = lambda request, client_address: None
+	
+	threading.Thread(target = server.serve_forever, daemon = True).start()
+	
+	return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+def check(name, passed, detail = ""):
+	print(f"{'PASS' if passed else 'FAIL'}: {name}" + (f" ({detail})" if detail else ""))
+	return passed
+
+def checkDownload(folder, size = 8 << 20):
+	"""
+	Check streaming, resuming and hashing downloads
+	"""
+	
+	data = os.urandom(size)
+	digest = hashlib.sha256(data).hexdigest()
+	server, url = startStandIn({"/update.zip": data})
+	path = os.path.join(folder, "update.zip")
+	results = []
+	
+	# Plain download
+	start = time.perf_counter()
+	done, hasher = updater.download_file(url + "/update.zip", path, None, hashlib.sha256)
+	total = time.perf_counter() - start
+	results.append(check("download", open(path, "rb").read() == data and hasher.hexdigest() == digest, f"{size / total / 1e6:.1f} MB/s"))
+	os.remove(path)
+	
+	# Dropped connection is resumed with a Range request
+	server.requests.clear()
+	server.drop_after = size // 3
+	done, hasher = updater.download_file(url + "/update.zip", path, updater.print_progress("check"), hashlib.sha256)
+	results.append(check("resume after dropped connection", open(path, "rb").read() == data and hasher.hexdigest() == digest, f"requests: {server.requests}"))
+	os.remove(path)
+	
+	# Part left over from an earlier run
+	open(path + ".part", "wb").write(data[:size // 2])
+	server.requests.clear()
+	done, hasher = updater.download_file(url + "/update.zip", path, None, hashlib.sha256)
+	results.append(check("resume from earlier part", open(path, "rb").read() == data and hasher.hexdigest() == digest and server.requests[0][1] == f"bytes={size // 2}-"))
+	os.remove(path)
+	
+	# Part that is already the whole file
+	open(path + ".part", "wb").write(data)
+	done, hasher = updater.download_file(url + "/update.zip", path, None, hashlib.sha256)
+	results.append(check("complete part", open(path, "rb").read() == data and hasher.hexdigest() == digest))
+	os.remove(path)
+	
+	# Client errors fail straight away instead of being retried
+	server.requests.clear()
+	
+	try:
+		updater.download_file(url + "/missing.zip", path)
+		results.append(check("404 is not retried", False))
+	except requests.exceptions.HTTPError:
+		results.append(check("404 is not retried", len(server.requests) == 1 and not os.path.exists(path)))
+	
+	# Server that ignores Range sends the whole file again
+	server.ranges = False
+	open(path + ".part", "wb").write(data[:1000])
+	done, hasher = updater.download_file(url + "/update.zip", path, None, hashlib.sha256)
+	results.append(check("server without Range support", open(path, "rb").read() == data and hasher.hexdigest() == digest))
+	os.remove(path)
+	
+	server.shutdown()
+	
+	return all(results)
+
+def checkConnections(folder, count = 32):
+	"""
+	Check that requests reuse pooled connections, including when downloading
+	components at once
+	"""
+	
+	files = {f"/component{i}.bin": os.urandom(256 << 10) for i in range(count)}
+	files["/update.zip"] = os.urandom(1 << 20)
+	files["/update.zip.sig"] = os.urandom(128)
+	server, url = startStandIn(files)
+	results = []
+	
+	updater.TOOLS_HOME_FOLDER = folder
+	
+	# What the update download used to do
+	for path in ["/update.zip", "/update.zip.sig"]:
+		requests.get(url + path, timeout = updater.DOWNLOAD_TIMEOUT).content
+	
+	print(f"Update and signature with requests.get: {server.connections} connections")
+	
+	server.connections = 0
+	updater.download_file(url + "/update.zip", os.path.join(folder, "update.zip"))
+	updater.get_session().get(url + "/update.zip.sig", timeout = updater.DOWNLOAD_TIMEOUT).content
+	results.append(check("update and signature share a connection", server.connections == 1, f"{server.connections} connections"))
+	
+	server.connections = 0
+	start = time.perf_counter()
+	paths = updater.download_components([url + path for path in files if path.startswith("/component")])
+	total = time.perf_counter() - start
+	
+	correct = all(open(os.path.join(folder, f"component{i}.bin"), "rb").read() == files[f"/component{i}.bin"] for i in range(count))
+	results.append(check(f"{count} components at once", correct and len(paths) == count and server.connections <= updater.HTTP_POOL_SIZE, f"{server.connections} connections, {total:.3f}s"))
+	
+	server.shutdown()
+	
+	return all(results)
+
+def checkDelta(folder, public, private):
+	"""
+	Check delta updates using a copy of this folder as the installed version
+	and the same with a change to bake_mesh.py as the new release
+	"""
+	
+	here = os.path.dirname(os.path.abspath(__file__))
+	old = os.path.join(folder, "old")
+	new = os.path.join(folder, "new")
+	results = []
+	
+	for path in updater.list_files(here):
+		for dest in [old, new]:
+			os.makedirs(os.path.dirname(os.path.join(dest, path)), exist_ok = True)
+			shutil.copyfile(os.path.join(here, path), os.path.join(dest, path))
+	
+	with open(os.path.join(new, "bake_mesh.py"), "a") as f:
+		f.write("\n# Changed in the new release\n")
+	
+	manifest = json.dumps(updater.make_manifest(new, [9, 9, 9], "files/")).encode()
+	files = {"/manifest.json": manifest, "/manifest.json.sig": rsa.sign(manifest, private, "SHA-256")}
+	
+	for path in updater.list_files(new):
+		files["/files/" + path] = open(os.path.join(new, path), "rb").read()
+	
+	# What a full update downloads
+	archive = shutil.make_archive(os.path.join(folder, "release"), "zip", new)
+	archive_size = os.path.getsize(archive)
+	
+	server, url = startStandIn(files)
+	
+	start = time.perf_counter()
+	downloaded, total, changed, removed = updater.apply_delta_update(url + "/manifest.json", public, old)
+	taken = time.perf_counter() - start
+	
+	same = all(open(os.path.join(old, path), "rb").read() == open(os.path.join(new, path), "rb").read() for path in updater.list_files(new))
+	results.append(check("delta update", same and changed == ["bake_mesh.py"] and not os.path.exists(os.path.join(old, updater.UPDATE_STAGING_FOLDER)), f"{downloaded} bytes in {taken:.3f}s instead of a {archive_size} byte ZIP, {len(files) - 2} files in the release"))
+	
+	# Nothing to do once it is up to date
+	server.requests.clear()
+	downloaded, total, changed, removed = updater.apply_delta_update(url + "/manifest.json", public, old)
+	results.append(check("up to date", downloaded == 0 and not changed and not removed and len(server.requests) == 2))
+	
+	# A release that adds, changes and drops files
+	def snapshot(folder):
+		return {path: updater.hash_file(os.path.join(folder, path)) for path in updater.list_files(folder)}
+	
+	def publish(version):
+		manifest = json.dumps(updater.make_manifest(new, version, "files/")).encode()
+		files["/manifest.json"] = manifest
+		files["/manifest.json.sig"] = rsa.sign(manifest, private, "SHA-256")
+		
+		for path in updater.list_files(new):
+			files["/files/" + path] = open(os.path.join(new, path), "rb").read()
+		
+		return manifest
+	
+	os.remove(os.path.join(new, "server_loadtest.py"))
+	os.makedirs(os.path.join(new, "extra"))
+	
+	with open(os.path.join(new, "extra", "added.py"), "w") as f:
+		f.write("# Added in the new release\n")
+	
+	with open(os.path.join(new, "bake_mesh.py"), "a") as f:
+		f.write("\n# Changed again in the new release\n")
+	
+	publish([9, 9, 9, 1])
+	
+	# A file the user added, which is not part of any release
+	with open(os.path.join(old, "notes.txt"), "w") as f:
+		f.write("Not part of the release\n")
+	
+	before = snapshot(old)
+	
+	# Fail part way through moving the files into place, after bake_mesh.py
+	replace = os.replace
+	
+	def failing_replace(source, dest):
+		if (dest == os.path.join(old, "extra", "added.py")):
+			raise OSError("Stand-in failure")
+		
+		replace(source, dest)
+	
+	os.replace = failing_replace
+	
+	try:
+		updater.apply_delta_update(url + "/manifest.json", public, old)
+		results.append(check("roll back failed update", False))
+	except OSError:
+		results.append(check("roll back failed update", snapshot(old) == before and not os.path.exists(os.path.join(old, updater.UPDATE_JOURNAL)) and updater.load_installed_manifest(old)["version"] == [9, 9, 9]))
+	finally:
+		os.replace = replace
+	
+	# Stop part way through like Blender was closed, then roll back on startup
+	rollback = updater.rollback_delta_update
+	updater.rollback_delta_update = lambda folder = None: False
+	os.replace = failing_replace
+	
+	try:
+		updater.apply_delta_update(url + "/manifest.json", public, old)
+	except OSError:
+		pass
+	finally:
+		os.replace = replace
+		updater.rollback_delta_update = rollback
+	
+	stopped = snapshot(old) != before and os.path.exists(os.path.join(old, updater.UPDATE_JOURNAL))
+	results.append(check("roll back stopped update", stopped and updater.rollback_delta_update(old) and snapshot(old) == before and not updater.rollback_delta_update(old)))
+	
+	# A download that fails keeps what was already staged
+	staging = os.path.join(old, updater.UPDATE_STAGING_FOLDER)
+	served = files["/files/bake_mesh.py"]
+	files["/files/bake_mesh.py"] = b"print('Not the real update')\n"
+	
+	try:
+		updater.apply_delta_update(url + "/manifest.json", public, old)
+		kept = False
+	except rsa.VerificationError:
+		kept = os.path.isfile(os.path.join(staging, "extra", "added.py")) and snapshot(old) == before
+	
+	# The next try resumes a part way download and does not download the
+	# staged file again
+	files["/files/bake_mesh.py"] = served
+	half = len(served) // 2
+	
+	with open(os.path.join(staging, "bake_mesh.py.part"), "wb") as f:
+		f.write(served[:half])
+	
+	server.requests.clear()
+	downloaded, total, changed, removed = updater.apply_delta_update(url + "/manifest.json", public, old)
+	results.append(check("resume staged downloads", kept and server.requests[2:] == [("/files/bake_mesh.py", f"bytes={half}-")] and downloaded == len(served) - half and not os.path.exists(staging), f"requests: {server.requests[2:]}"))
+	
+	user_file = os.path.isfile(os.path.join(old, "notes.txt"))
+	os.remove(os.path.join(old, "notes.txt"))
+	results.append(check("remove dropped files", user_file and snapshot(old) == snapshot(new) and removed == ["server_loadtest.py"] and sorted(changed) == ["bake_mesh.py", "extra/added.py"], f"changed {changed}, removed {removed}"))
+	
+	# Paths that leave the add-on's folder
+	bad = ["C:foo.py", "C:/foo.py", "c:\\foo.py", "/etc/foo.py", "\\\\server\\share\\foo.py", "../foo.py", "extra/../../foo.py", "..\\foo.py", "", ".update-backup/foo.py", updater.UPDATE_JOURNAL]
+	good = ["foo.py", "extra/foo.py", "extra/../foo.py"]
+	results.append(check("reject paths outside the add-on", not any(updater.is_release_path(p) for p in bad) and all(updater.is_release_path(p) for p in good)))
+	
+	# A file that does not match the manifest must not be installed
+	with open(os.path.join(new, "server.py"), "a") as f:
+		f.write("\n# Changed in the new release\n")
+	
+	manifest = json.dumps(updater.make_manifest(new, [9, 9, 10], "files/")).encode()
+	files["/manifest.json"] = manifest
+	files["/manifest.json.sig"] = rsa.sign(manifest, private, "SHA-256")
+	files["/files/server.py"] = b"print('Not the real update')\n"
+	before = open(os.path.join(old, "server.py"), "rb").read()
+	
+	try:
+		updater.apply_delta_update(url + "/manifest.json", public, old)
+		results.append(check("reject file that does not match the manifest", False))
+	except rsa.VerificationError:
+		results.append(check("reject file that does not match the manifest", open(os.path.join(old, "server.py"), "rb").read() == before))
+	
+	# A manifest that is not signed by us must not be used
+	files["/manifest.json"] = manifest.replace(b"9, 9, 10", b"9, 9, 11")
+	
+	try:
+		updater.apply_delta_update(url + "/manifest.json", public, old)
+		results.append(check("reject unsigned manifest", False))
+	except rsa.VerificationError:
+		results.append(check("reject unsigned manifest", True))
+	
+	server.shutdown()
+	
+	return all(results)
+
+def checkVerify(folder, public, private, size = 1 << 20):
+	"""
+	Check that signatures are verified from the download stream and from disk
+	"""
+	
+	data = os.urandom(size)
+	signature = rsa.sign(data, private, "SHA-256")
+	server, url = startStandIn({"/update.zip": data})
+	path = os.path.join(folder, "update.zip")
+	results = []
+	
+	method = rsa.pkcs1.find_signature_hash(signature, public)
+	size, hasher = updater.download_file(url + "/update.zip", path, None, rsa.pkcs1.HASH_METHODS[method])
+	results.append(check("verify while downloading", updater.verify_hash(hasher.digest(), signature, public) == "SHA-256"))
+	results.append(check("verify file", updater.verify_file(path, signature, public) == "SHA-256"))
+	
+	# A changed file must not pass
+	tampered = bytearray(data)
+	tampered[size // 2] ^= 1
+	
+	try:
+		updater.verify_hash(hashlib.sha256(tampered).digest(), signature, public)
+		results.append(check("reject tampered file", False))
+	except rsa.VerificationError:
+		results.append(check("reject tampered file", True))
+	
+	os.remove(path)
+	server.shutdown()
+	
+	return all(results)
+
+def measure(function):
+	"""
+	Run function, returning how long it took and the peak memory it allocated
+	"""
+	
+	tracemalloc.start()
+	start = time.perf_counter()
+	function()
+	total = time.perf_counter() - start
+	peak = tracemalloc.get_traced_memory()[1]
+	tracemalloc.stop()
+	
+	return total, peak
+
+def benchmarkVerify(folder, public, private, size = 100 << 20):
+	"""
+	Compare verifying an update in memory, from disk and while downloading it
+	"""
+	
+	data = os.urandom(size)
+	signature = rsa.sign(data, private, "SHA-256")
+	server, url = startStandIn({"/update.zip": data})
+	path = os.path.join(folder, "update.zip")
+	
+	with open(path, "wb") as f:
+		f.write(data)
+	
+	def streamed():
+		method = rsa.pkcs1.find_signature_hash(signature, public)
+		_, hasher = updater.download_file(url + "/update.zip", path + ".new", None, rsa.pkcs1.HASH_METHODS[method])
+		updater.verify_hash(hasher.digest(), signature, public)
+	
+	def downloaded():
+		updater.download_file(url + "/update.zip", path + ".new")
+	
+	print(f"Verifying a {size >> 20} MiB update:")
+	
+	for name, function in [
+		("in memory", lambda: rsa.verify(open(path, "rb").read(), signature, public)),
+		("from disk", lambda: updater.verify_file(path, signature, public)),
+		("download only", downloaded),
+		("download and verify", streamed),
+	]:
+		total, peak = measure(function)
+		print(f"  {name}: {total:.3f}s, peak {peak / (1 << 20):.2f} MiB allocated")
+	
+	os.remove(path)
+	os.remove(path + ".new")
+	server.shutdown()
+
+def runUpdateCheck():
+	"""
+	Start an update check and run its timer until it is done, like Blender
+	would. Returns the time start_update_check blocked for, the time until
+	there was a result and the result.
+	"""
+	
+	results = []
+	
+	start = time.perf_counter()
+	poll = updater.start_update_check((2, 0, 0), "stable", results.append)
+	blocked = time.perf_counter() - start
+	
+	while (poll() != None):
+		time.sleep(0.1)
+	
+	return blocked, time.perf_counter() - start, results[0]
+
+def checkStartup(folder, delay = 8):
+	"""
+	Check that a slow update server does not hold up startup, and that a cached
+	result means there are no requests at all
+	"""
+	
+	info = json.dumps({"stable": {"version": [9, 9, 9], "blender_version": [2, 80, 0], "download": "https://example.com/update.zip"}}).encode()
+	server, url = startStandIn({"/update.json": info})
+	results = []
+	
+	updater.UPDATE_INFO = url + "/update.json"
+	updater.UPDATE_CACHE_PATH = os.path.join(folder, "update-cache.json")
+	
+	# What startup used to do, which waits for as long as the server does
+	server.delay = delay
+	start = time.perf_counter()
+	requests.get(updater.UPDATE_INFO)
+	print(f"Startup with a {delay}s slow server, old synchronous check: blocked for {time.perf_counter() - start:.3f}s")
+	
+	blocked, total, update = runUpdateCheck()
+	print(f"Startup with a {delay}s slow server, background check: blocked for {blocked * 1000:.2f}ms, gave up after {total:.3f}s")
+	results.append(check("slow server does not block startup", blocked < 0.1 and total < updater.UPDATE_CHECK_TIMEOUT + 1 and update == None))
+	
+	server.delay = 0
+	server.requests.clear()
+	blocked, total, update = runUpdateCheck()
+	results.append(check("update found", update != None and update.version == [9, 9, 9] and len(server.requests) == 1, f"result after {total:.3f}s"))
+	
+	server.delay = delay
+	server.requests.clear()
+	blocked, total, update = runUpdateCheck()
+	results.append(check("cached update info is used", update != None and not server.requests, f"result after {total:.3f}s"))
+	
+	server.shutdown()
+	
+	return all(results)
+
+def main():
+	with tempfile.TemporaryDirectory() as folder:
+		passed = checkDownload(folder)
+		passed = checkStartup(folder) and passed
+		passed = checkConnections(folder) and passed
+		
+		public, private = rsa.newkeys(1024)
+		passed = checkVerify(folder, public, private) and passed
+		passed = checkDelta(folder, public, private) and passed
+		
+		benchmarkVerify(folder, public, private)
+	
+	print("All checks passed" if passed else "Some checks failed")
+	
+	return 0 if passed else 1
+
+if (__name__ == "__main__"):
+	sys.exit(main())